@@ -0,0 +1,61 @@
+"""
+Benchmark: event-loop latency while logins are hashing passwords.
+
+Every Socket.IO event is handled on the eventlet hub, so how late a green
+thread wakes up from a 10 ms sleep is the delay any socket message sees.
+The ticker measures that while CONCURRENCY green threads verify passwords,
+first inline on the hub (the old api_login) and then through passwords.py
+(eventlet.tpool).
+
+    python bench_login.py [logins] [concurrency]
+    PASSWORD_HASH_METHOD=pbkdf2:sha256:600000 python bench_login.py
+"""
+import sys
+import time
+
+import eventlet
+from werkzeug.security import check_password_hash
+
+import passwords
+
+LOGINS = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+CONCURRENCY = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+TICK = 0.01
+
+
+def ticker(lags, stop):
+    while not stop:
+        started = time.perf_counter()
+        eventlet.sleep(TICK)
+        lags.append(time.perf_counter() - started - TICK)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def run(label, verify, stored):
+    lags, stop = [], []
+    tick = eventlet.spawn(ticker, lags, stop)
+    eventlet.sleep(TICK * 3)
+    del lags[:]
+
+    pool = eventlet.GreenPool(CONCURRENCY)
+    started = time.perf_counter()
+    results = list(pool.imap(lambda _: verify(stored, 'correct horse'), range(LOGINS)))
+    elapsed = time.perf_counter() - started
+    stop.append(True)
+    tick.wait()
+
+    assert all(results)
+    print(f"  {label:<22} {LOGINS / elapsed:7.1f} logins/s   hub lag "
+          f"p50 {percentile(lags, 0.5) * 1000:6.1f} ms  p99 {percentile(lags, 0.99) * 1000:6.1f} ms  "
+          f"max {max(lags or [0]) * 1000:6.1f} ms")
+
+
+if __name__ == '__main__':
+    print(f"[*] {passwords.HASH_METHOD}: {LOGINS} logins, {CONCURRENCY} at a time")
+    stored = passwords.hash_password('correct horse')
+    run('inline on the hub', check_password_hash, stored)
+    run('eventlet.tpool', passwords.verify_password, stored)
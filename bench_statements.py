@@ -0,0 +1,116 @@
+"""
+Benchmark: per-query cost of the statement registry in db.py.
+
+SQLite (default): placeholder translation on every call vs. the cached form.
+Postgres (DATABASE_URL set): plain execute vs. PREPARE once + EXECUTE for the
+role lookup check_auth runs on every request.
+
+    python bench_statements.py [iterations]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import db
+import queries
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+QUERY = """
+    SELECT dm.id, dm.content, dm.timestamp, u.username, u.avatar
+    FROM dm_messages dm
+    JOIN users u ON u.id = dm.author_id
+    WHERE dm.dm_id = %s AND dm.id < %s
+    ORDER BY dm.id DESC LIMIT %s
+"""
+
+
+def report(label, seconds):
+    print(f"  {label:<28} {seconds / ITERATIONS * 1e6:8.2f} us/query")
+
+
+def bench_translation():
+    print(f"[*] Placeholder translation ({ITERATIONS} calls)")
+    started = time.perf_counter()
+    for _ in range(ITERATIONS):
+        QUERY.replace('%s', '?')
+    report('str.replace per call', time.perf_counter() - started)
+
+    stmt = db.Statement('q_bench', QUERY)
+    registry = {QUERY: stmt}
+    started = time.perf_counter()
+    for _ in range(ITERATIONS):
+        registry.get(QUERY).sqlite_sql
+    report('registry lookup', time.perf_counter() - started)
+
+
+def seed(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, username TEXT, avatar TEXT)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS dm_messages (id INTEGER PRIMARY KEY, dm_id INTEGER, author_id INTEGER, content TEXT, timestamp REAL)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bench_dm ON dm_messages(dm_id, id)")
+    cursor.execute("INSERT INTO users (id, username, avatar) VALUES (1, 'bench', NULL)")
+    rows = [(i, 1 + i % 20, 1, f"message {i}", time.time()) for i in range(1, 5001)]
+    cursor.executemany("INSERT INTO dm_messages (id, dm_id, author_id, content, timestamp) VALUES (?, ?, ?, ?, ?)", rows)
+
+
+def bench_sqlite():
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    conn = sqlite3.connect(path, isolation_level=None)
+    cur = conn.cursor()
+    seed(cur)
+    params = (7, 4000, 50)
+
+    print(f"[*] SQLite end-to-end ({ITERATIONS} queries)")
+    started = time.perf_counter()
+    for _ in range(ITERATIONS):
+        cur.execute(QUERY.replace('%s', '?'), params)
+        cur.fetchall()
+    report('translate every call', time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for _ in range(ITERATIONS):
+        cur.execute(db._to_sqlite(QUERY), params)
+        cur.fetchall()
+    report('cached translation', time.perf_counter() - started)
+    conn.close()
+
+
+def bench_postgres():
+    import psycopg2
+    conn = psycopg2.connect(db.get_database_url())
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE users (id INTEGER PRIMARY KEY, username TEXT, avatar TEXT, role TEXT DEFAULT 'user')")
+    cur.execute("INSERT INTO users (id, username) SELECT g, 'user' || g FROM generate_series(1, 10000) g")
+    cur.execute("ANALYZE users")
+
+    stmt = db.Statement('q_bench_role', queries.USER_ROLE)
+    cur.execute(stmt.prepare_sql)
+    print(f"[*] Postgres point lookup ({ITERATIONS} queries): {queries.USER_ROLE}")
+    # Alternate rounds so cache warm-up doesn't favour either side
+    plain = prepared = 0.0
+    for _ in range(2):
+        started = time.perf_counter()
+        for i in range(ITERATIONS // 2):
+            cur.execute(queries.USER_ROLE, (i % 10000 + 1,))
+            cur.fetchone()
+        plain += time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i in range(ITERATIONS // 2):
+            cur.execute(stmt.execute_sql, (i % 10000 + 1,))
+            cur.fetchone()
+        prepared += time.perf_counter() - started
+    report('plain execute', plain)
+    report('prepared (EXECUTE)', prepared)
+    conn.close()
+
+
+if __name__ == '__main__':
+    bench_translation()
+    if db.is_postgres():
+        bench_postgres()
+    else:
+        bench_sqlite()
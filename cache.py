@@ -0,0 +1,223 @@
+"""
+In-process caches and write-behind buffers for the per-request auth sync.
+
+check_auth runs before almost every request. The user's role is served from
+a TTL cache (invalidated locally when a role is changed through the admin
+API; other workers pick the change up within ROLE_CACHE_TTL seconds), and
+last_seen touches are coalesced in memory and written in one batch every
+LAST_SEEN_FLUSH_INTERVAL seconds.
+
+users.status is written the same way for socket connects and disconnects
+(STATUS_FLUSH_INTERVAL), so a reconnect storm after a deploy doesn't put a
+write into every handshake; rows left 'online' by a restart or a crashed
+worker are reconciled against the users actually online.
+
+Public profiles (name, avatar, bio, public key) for /api/users/batch are
+cached per user and dropped when the user edits them; edits made through
+another worker show up within PROFILE_CACHE_TTL seconds.
+"""
+import os
+import threading
+import time
+
+import db
+import queries
+import repositories
+
+ROLE_CACHE_TTL = float(os.environ.get('ROLE_CACHE_TTL', 30))
+LAST_SEEN_FLUSH_INTERVAL = float(os.environ.get('LAST_SEEN_FLUSH_INTERVAL', 5))
+STATUS_FLUSH_INTERVAL = float(os.environ.get('STATUS_FLUSH_INTERVAL', 2))
+STATUS_RECONCILE_INTERVAL = float(os.environ.get('STATUS_RECONCILE_INTERVAL', 300))
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', 60))
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', 5000))
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Dict with per-entry expiry and a size bound (oldest entries go first)."""
+
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._data) >= self.maxsize:
+                self._evict()
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [k for k, (expires, _) in self._data.items() if expires < now]:
+            del self._data[key]
+        # Still full: drop the oldest tenth (dicts keep insertion order)
+        while len(self._data) >= self.maxsize * 0.9:
+            del self._data[next(iter(self._data))]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0,
+        }
+
+
+# --- Roles ---
+roles = TTLCache(ROLE_CACHE_TTL)
+
+
+def user_role(user_id):
+    """Role of a user from the cache, loading it on a miss. None if the user
+    doesn't exist."""
+    key = str(user_id)
+    role = roles.get(key, _MISSING)
+    if role is _MISSING:
+        row = db.execute_query(queries.USER_ROLE, (user_id,), fetch_one=True)
+        role = row[0] if row else None
+        roles.set(key, role)
+    return role
+
+
+def invalidate_role(user_id):
+    roles.invalidate(str(user_id))
+
+
+# --- Public profiles ---
+profiles = TTLCache(PROFILE_CACHE_TTL, PROFILE_CACHE_SIZE)
+
+
+def user_profiles(user_ids):
+    """{id: PublicProfile or None} with one query for all cache misses."""
+    found, missing = {}, []
+    for uid in set(user_ids):
+        profile = profiles.get(uid, _MISSING)
+        if profile is _MISSING:
+            missing.append(uid)
+        else:
+            found[uid] = profile
+    if missing:
+        loaded = repositories.users.public_profiles(missing)
+        for uid in missing:
+            found[uid] = loaded.get(uid)
+            profiles.set(uid, found[uid])
+    return found
+
+
+def invalidate_profile(user_id):
+    profiles.invalidate(int(user_id))
+
+
+# --- last_seen ---
+class LastSeenBuffer:
+    """Keeps only the newest last_seen per user and writes them all with one
+    executemany() per flush instead of one UPDATE per request."""
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.flushes = 0
+        self.written = 0
+
+    def touch(self, user_id, timestamp=None):
+        self._pending[user_id] = timestamp or time.time()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            db.execute_many(queries.TOUCH_LAST_SEEN, [(ts, uid) for uid, ts in pending.items()])
+        except Exception:
+            # Put them back unless a newer touch arrived meanwhile
+            with self._lock:
+                for uid, ts in pending.items():
+                    if self._pending.get(uid, 0) < ts:
+                        self._pending[uid] = ts
+            raise
+        self.flushes += 1
+        self.written += len(pending)
+        return len(pending)
+
+    def stats(self):
+        return {'pending': len(self._pending), 'flushes': self.flushes, 'written': self.written}
+
+
+last_seen = LastSeenBuffer()
+
+
+# --- users.status ---
+class StatusBuffer:
+    """Keeps only the latest online/offline status per user and writes them
+    all with one executemany() per flush."""
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.flushes = 0
+        self.written = 0
+
+    def set(self, user_id, status):
+        self._pending[str(user_id)] = status
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            db.execute_many(queries.SET_USER_STATUS, [(status, uid) for uid, status in pending.items()])
+        except Exception:
+            # Put them back unless a newer status arrived meanwhile
+            with self._lock:
+                for uid, status in pending.items():
+                    self._pending.setdefault(uid, status)
+            raise
+        self.flushes += 1
+        self.written += len(pending)
+        return len(pending)
+
+    def reconcile(self, online_ids):
+        """Queue the rows that disagree with online_ids() (the users online
+        right now): stale 'online' ones go offline, missing ones online.
+        Returns how many were queued."""
+        rows = db.execute_query(queries.ONLINE_USER_IDS, fetch_all=True)
+        marked = {str(row[0]) for row in rows or ()}
+        # Read after the query: no yield between here and the set() calls,
+        # so a connect or disconnect can't slip in and be overwritten
+        online = online_ids()
+        for uid in marked - online:
+            self.set(uid, 'offline')
+        for uid in online - marked:
+            self.set(uid, 'online')
+        return len(marked ^ online)
+
+    def stats(self):
+        return {'pending': len(self._pending), 'flushes': self.flushes, 'written': self.written}
+
+
+statuses = StatusBuffer()
@@ -0,0 +1,194 @@
+"""
+Cross-worker check for SOCKETIO_MESSAGE_QUEUE.
+
+Starts the message queue stand-in (unless --mq is given) and WORKERS web.py
+processes on consecutive ports, all on the same queue and database. It then
+creates two throwaway users and connects a Socket.IO client for each on a
+different worker. Finally it checks that:
+    - a DM sent through the first worker reaches the recipient's socket on
+      the last worker as new_dm_message
+    - the last worker sees the sender online, and offline once they leave
+
+    python check_cluster.py [--workers=3] [--port=8100] [--mq=redis://host:6379/0]
+                            [--db=postgresql://.../scratch]
+
+The workers run on a fresh SQLite file in the temp directory, removed
+afterwards, whatever DATABASE_URL says, so the check never writes to the
+deployment's database. --db points them at a scratch Postgres database
+instead; the test users and their DM are deleted there at the end. Worker
+output goes to check_cluster_<port>.log in the temp directory.
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+import socketio
+from werkzeug.security import generate_password_hash
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STARTUP_TIMEOUT = 90
+DELIVERY_TIMEOUT = 10
+
+
+def option(argv, name, default):
+    prefix = f'--{name}='
+    return next((a[len(prefix):] for a in argv if a.startswith(prefix)), default)
+
+
+def wait_for_port(port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.3)
+    return False
+
+
+def wait_until(check, timeout=DELIVERY_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if check():
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def start(args, env, log_name):
+    log = open(os.path.join(tempfile.gettempdir(), log_name), 'w')
+    return subprocess.Popen([sys.executable] + args, cwd=BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def login(url, username, password):
+    http = requests.Session()
+    r = http.post(f'{url}/api/auth/login', json={'username': username, 'password': password}).json()
+    if not r.get('success'):
+        raise RuntimeError(f"login as {username} on {url} failed: {r}")
+    return http
+
+
+def connect(url, http):
+    client = socketio.Client()
+    cookie = '; '.join(f'{k}={v}' for k, v in http.cookies.items())
+    client.connect(url, headers={'Cookie': cookie}, transports=['polling'])
+    return client
+
+
+def status(url, http, user_id):
+    return http.get(f'{url}/api/users/batch?ids={user_id}').json()['users'][str(user_id)]['status']
+
+
+def main(argv):
+    workers = int(option(argv, 'workers', 3))
+    port = int(option(argv, 'port', 8100))
+    mq = option(argv, 'mq', None)
+    db_url = option(argv, 'db', None)
+    processes = []
+    failures = []
+
+    # Set before db is imported below, so this process uses the same database
+    sqlite_path = None
+    for name in ('DATABASE_URL', 'DATABASE_REPLICA_URLS', 'SQLITE_PATH'):
+        os.environ.pop(name, None)
+    if db_url:
+        os.environ['DATABASE_URL'] = db_url
+    else:
+        sqlite_path = os.path.join(tempfile.gettempdir(), f'check_cluster_{uuid.uuid4().hex[:8]}.db')
+        os.environ['SQLITE_PATH'] = sqlite_path
+
+    def check(ok, label):
+        print(f"  [{'OK' if ok else '!'}] {label}")
+        if not ok:
+            failures.append(label)
+
+    try:
+        if mq is None:
+            mq_port = port - 1
+            processes.append(start(['mq_standin.py', str(mq_port)], os.environ.copy(), 'check_cluster_mq.log'))
+            if not wait_for_port(mq_port, 10):
+                print("[!] Message queue stand-in did not start")
+                return 1
+            mq = f'redis://127.0.0.1:{mq_port}/0'
+        print(f"[*] {workers} workers on ports {port}-{port + workers - 1}, queue {mq}, "
+              f"database {db_url.rsplit('@', 1)[-1] if db_url else sqlite_path}")
+
+        env = dict(os.environ, SOCKETIO_MESSAGE_QUEUE=mq, PRESENCE_HEARTBEAT='2')
+        urls = [f'http://127.0.0.1:{port + i}' for i in range(workers)]
+        # The first worker alone, so only one process runs the migrations
+        for i in range(workers):
+            processes.append(start(['web.py'], dict(env, PORT=str(port + i)), f'check_cluster_{port + i}.log'))
+            if i == 0 and not wait_for_port(port, STARTUP_TIMEOUT):
+                print(f"[!] Worker on port {port} did not start")
+                return 1
+        for i in range(1, workers):
+            if not wait_for_port(port + i, STARTUP_TIMEOUT):
+                print(f"[!] Worker on port {port + i} did not start")
+                return 1
+
+        # web.py imports the same modules once the schema is in place
+        import repositories
+        tag = uuid.uuid4().hex[:8]
+        password = uuid.uuid4().hex
+        names = [f'mqcheck_{tag}_a', f'mqcheck_{tag}_b']
+        ids = [repositories.users.create(name, generate_password_hash(password), None, time.time()) for name in names]
+        sender_url, recipient_url = urls[0], urls[-1]
+        sender_http = login(sender_url, names[0], password)
+        recipient_http = login(recipient_url, names[1], password)
+
+        received = []
+        delivered = threading.Event()
+        recipient = connect(recipient_url, recipient_http)
+
+        @recipient.on('new_dm_message')
+        def on_message(data):
+            received.append(data)
+            delivered.set()
+
+        sender = connect(sender_url, sender_http)
+        check(wait_until(lambda: status(recipient_url, recipient_http, ids[0]) == 'online'),
+              f"worker {recipient_url} sees the sender (connected to {sender_url}) online")
+
+        dm_id = sender_http.post(f'{sender_url}/api/dms/get_or_create/{ids[1]}').json()['dm_id']
+        text = f'cluster check {tag}'
+        sent = sender_http.post(f'{sender_url}/api/dms/by_id/{dm_id}/send', json={'content': text}).json()
+        check(sent.get('success'), f"DM sent through {sender_url}")
+        delivered.wait(DELIVERY_TIMEOUT)
+        check(any(m.get('content') == text for m in received),
+              f"new_dm_message delivered to the recipient's socket on {recipient_url}")
+
+        sender.disconnect()
+        check(wait_until(lambda: status(recipient_url, recipient_http, ids[0]) == 'offline'),
+              f"worker {recipient_url} sees the sender offline after they disconnect")
+        recipient.disconnect()
+
+        import db
+        db.execute_query('DELETE FROM dm_messages WHERE dm_id = %s', (dm_id,), commit=True)
+        db.execute_query('DELETE FROM direct_messages WHERE id = %s', (dm_id,), commit=True)
+        for user_id in ids:
+            db.execute_query('DELETE FROM users WHERE id = %s', (user_id,), commit=True)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        if sqlite_path:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(sqlite_path + suffix):
+                    os.remove(sqlite_path + suffix)
+
+    if failures:
+        print(f"[!] {len(failures)} check(s) failed; worker logs in {tempfile.gettempdir()}")
+        return 1
+    print("[OK] Cross-worker delivery works")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
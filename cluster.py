@@ -0,0 +1,198 @@
+"""
+Running the realtime layer on more than one worker process or node.
+
+Socket.IO emits go through SOCKETIO_MESSAGE_QUEUE when it is set, e.g.
+redis://localhost:6379/0. Every worker publishes its emits there and delivers
+the ones for its own sockets, so an emit to a user's room reaches them
+whichever worker holds their connection. Load balancer setup (sticky
+sessions) is in SCALING.md. mq_standin.py is a Redis-compatible stand-in for
+local runs, and check_cluster.py checks cross-worker delivery end to end.
+
+The other shared state is who is online. OnlineUsers keeps this worker's
+sockets per user plus a replica of every other worker's online users. The
+replica is kept over the same Redis server: each worker publishes its first
+connect / last disconnect per user on PRESENCE_CHANNEL, and a full snapshot
+every PRESENCE_HEARTBEAT seconds. A worker that misses three heartbeats is
+forgotten. Lookups stay local dict reads. Without a message queue
+OnlineUsers only knows this worker, which is then all there is.
+
+A user whose last socket here closes while another worker still holds them
+is kept as pending. If that other worker's copy goes away without it
+announcing the user offline (both closed at once, or it died), on_offline
+is called here for them instead. A dead worker's users are announced by one
+worker only, the one with the lowest id.
+"""
+import json
+import os
+import socket
+import threading
+import time
+
+import eventlet
+
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
+PRESENCE_CHANNEL = os.environ.get('PRESENCE_CHANNEL', 'octave-presence')
+PRESENCE_HEARTBEAT = float(os.environ.get('PRESENCE_HEARTBEAT', 10))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class OnlineUsers:
+    def __init__(self, on_offline=None):
+        self._local = {}     # user id -> {sid: info}, this worker's sockets
+        self._remote = {}    # worker id -> {user id}
+        self._seen = {}      # worker id -> time of its last message
+        self._pending = set()  # users that left here while online elsewhere
+        self._lock = threading.Lock()
+        self._redis = None
+        self.on_offline = on_offline  # called with user ids gone from every worker
+
+    # --- This worker's sockets ---
+    def connect(self, user_id, sid, info):
+        """Returns True for the user's first socket on this worker."""
+        with self._lock:
+            sockets = self._local.setdefault(user_id, {})
+            first = not sockets
+            sockets[sid] = info
+            self._pending.discard(user_id)
+        if first:
+            self._publish('+', user_id)
+        return first
+
+    def disconnect(self, user_id, sid):
+        """(info, offline): the socket's info, and whether the user has no
+        socket left on any worker."""
+        with self._lock:
+            sockets = self._local.get(user_id)
+            if sockets is None:
+                return None, False
+            info = sockets.pop(sid, None)
+            last = not sockets
+            if last:
+                del self._local[user_id]
+            offline = last and not any(user_id in users for users in self._remote.values())
+            if last and not offline:
+                self._pending.add(user_id)
+        if last:
+            self._publish('-', user_id, offline=offline)
+        return info, offline
+
+    def get(self, user_id):
+        """Info of one of the user's sockets on this worker, or None."""
+        sockets = self._local.get(user_id)
+        return next(iter(sockets.values()), None) if sockets else None
+
+    # --- Every worker ---
+    def __contains__(self, user_id):
+        return user_id in self._local or any(user_id in users for users in self._remote.values())
+
+    def __len__(self):
+        return len(self.user_ids())
+
+    def user_ids(self):
+        with self._lock:
+            return set(self._local).union(*self._remote.values())
+
+    # --- Replication ---
+    def attach(self, url):
+        """Replicate through the Redis server at url (starts two green threads)."""
+        if not url.startswith(('redis://', 'rediss://', 'unix://')):
+            print(f"[!] Online users are not shared: {url.split('://')[0]}:// is not a Redis URL")
+            return
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        eventlet.spawn(self._listen)
+        eventlet.spawn(self._heartbeat)
+
+    def _publish(self, op, users, offline=False):
+        if self._redis is None:
+            return
+        message = {'w': WORKER_ID, 'op': op, 'u': users}
+        if offline:
+            message['off'] = True
+        try:
+            self._redis.publish(PRESENCE_CHANNEL, json.dumps(message))
+        except Exception as e:
+            print(f"[Presence Error] publish: {e}")
+
+    def _snapshot(self):
+        self._publish('*', list(self._local))
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(PRESENCE_CHANNEL)
+                # Ask the other workers for their snapshots instead of
+                # waiting for the next heartbeat
+                self._publish('?', None)
+                for message in pubsub.listen():
+                    self._apply(json.loads(message['data']))
+            except Exception as e:
+                print(f"[Presence Error] {e}")
+                eventlet.sleep(PRESENCE_HEARTBEAT)
+
+    def _apply(self, message):
+        worker, op, users = message['w'], message['op'], message['u']
+        if worker == WORKER_ID:
+            return
+        gone = []
+        with self._lock:
+            self._seen[worker] = time.time()
+            if op == '*':
+                self._remote[worker] = set(users)
+                gone = self._settle()
+            elif op == '+':
+                self._remote.setdefault(worker, set()).add(users)
+            elif op == '-':
+                self._remote.get(worker, set()).discard(users)
+                if message.get('off'):
+                    # The other worker already announced them
+                    self._pending.discard(users)
+                else:
+                    gone = self._settle()
+        if op == '?':
+            self._snapshot()
+        self._announce(gone)
+
+    def _settle(self):
+        """Pending users no longer online on any worker (call under the lock)."""
+        gone = [u for u in self._pending
+                if u not in self._local and not any(u in users for users in self._remote.values())]
+        self._pending.difference_update(gone)
+        return gone
+
+    def _announce(self, user_ids):
+        if user_ids and self.on_offline is not None:
+            try:
+                self.on_offline(user_ids)
+            except Exception as e:
+                print(f"[Presence Error] offline: {e}")
+
+    def _heartbeat(self):
+        while True:
+            eventlet.sleep(PRESENCE_HEARTBEAT)
+            self._snapshot()
+            cutoff = time.time() - 3 * PRESENCE_HEARTBEAT
+            gone = []
+            with self._lock:
+                dead = [w for w, seen in self._seen.items() if seen < cutoff]
+                orphans = set()
+                for worker in dead:
+                    del self._seen[worker]
+                    orphans |= self._remote.pop(worker, set())
+                if dead:
+                    gone = self._settle()
+                    # Every live worker sees the dead one go; the lowest id speaks
+                    if all(WORKER_ID < w for w in self._seen):
+                        gone += [u for u in orphans if u not in self._local and u not in gone
+                                 and not any(u in users for users in self._remote.values())]
+            self._announce(gone)
+
+    def stats(self):
+        return {
+            'worker': WORKER_ID,
+            'shared': self._redis is not None,
+            'local': len(self._local),
+            'online': len(self),
+            'workers': 1 + len(self._remote),
+        }
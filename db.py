@@ -0,0 +1,1013 @@
+"""
+Database access layer for the web dashboard.
+
+Postgres is used when DATABASE_URL is set, otherwise the local SQLite file.
+Connections come from a bounded pool; inside a Flask request the first query
+checks a connection out and keeps it until the request is torn down.
+Writes that belong together go through `with transaction():` so they share
+one connection and one commit.
+
+SQLite runs in "production" mode by default (SQLITE_MODE=simple turns it
+off): WAL journaling with tuned pragmas, long-lived pooled readers, and a
+single writer green thread that serializes writes and group-commits them.
+
+On Postgres, reads marked read_only=True can be spread over streaming
+replicas listed in DATABASE_REPLICA_URLS.
+
+Large result sets should be iterated with stream_query() instead of
+execute_query(fetch_all=True) so memory stays flat.
+"""
+import os
+import queue
+import sqlite3
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SQLITE_PATH = os.environ.get('SQLITE_PATH') or os.path.join(BASE_DIR, 'users.db')
+
+# Pool tuning (see /api/admin/db/pool for live numbers when sizing)
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+POOL_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTHCHECK_INTERVAL', 30))
+POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800))
+
+# SQLite engine tuning
+SQLITE_MODE = os.environ.get('SQLITE_MODE', 'production')
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+SQLITE_CACHE_KB = int(os.environ.get('SQLITE_CACHE_KB', 32 * 1024))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+# Shared cache uses table-level locks between connections of this process,
+# which serializes WAL readers behind the writer - keep it opt-in.
+SQLITE_SHARED_CACHE = os.environ.get('SQLITE_SHARED_CACHE', '0') == '1'
+SQLITE_WRITER_BATCH = int(os.environ.get('SQLITE_WRITER_BATCH', 256))
+
+# Read replicas (Postgres streaming replicas), comma separated DSNs
+REPLICA_URLS = [u.strip() for u in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if u.strip()]
+# After a write, this session reads from the primary for this long
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# A replica that failed is skipped for this long before it is tried again
+REPLICA_RETRY_AFTER = float(os.environ.get('REPLICA_RETRY_AFTER', 30))
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get('REPLICA_CONNECT_TIMEOUT', 3))
+# A saturated replica is not waited on: after this long the read goes to the primary
+REPLICA_ACQUIRE_TIMEOUT = float(os.environ.get('REPLICA_ACQUIRE_TIMEOUT', 0.05))
+
+# Rows per round trip for stream_query()
+STREAM_BATCH_SIZE = int(os.environ.get('DB_STREAM_BATCH_SIZE', 500))
+
+
+def get_database_url():
+    return os.environ.get('DATABASE_URL')
+
+
+def is_postgres():
+    return bool(get_database_url())
+
+
+def get_db_connection():
+    """Open a fresh, unpooled connection (used by schema/maintenance code)."""
+    db_url = get_database_url()
+    if not db_url:
+        return sqlite3.connect(SQLITE_PATH)
+    return psycopg2.connect(db_url)
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection frees up within the wait timeout."""
+
+
+class PooledConnection:
+    __slots__ = ('conn', 'created_at', 'last_used', 'broken', 'prepared')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.broken = False
+        # Names of server-side prepared statements living on this connection
+        self.prepared = set()
+
+
+class ConnectionPool:
+    """Bounded connection pool with a FIFO wait queue.
+
+    Uses threading primitives, which eventlet.monkey_patch() turns green, so
+    waiting for a connection yields to other green threads instead of
+    blocking the hub.
+    """
+
+    def __init__(self, connect, size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                 healthcheck_interval=POOL_HEALTHCHECK_INTERVAL,
+                 max_lifetime=POOL_MAX_LIFETIME, name='primary'):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.max_lifetime = max_lifetime
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._idle = deque()
+        self._waiters = deque()
+        self._open = 0
+        self._in_use = 0
+
+        # Counters for /api/admin/db/pool
+        self._checkouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._timeouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+
+    def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        started = time.time()
+        waited = False
+
+        while True:
+            pc = None
+            create = False
+            with self._lock:
+                if self._idle:
+                    pc = self._idle.pop()
+                elif self._open < self.size:
+                    self._open += 1
+                    create = True
+                else:
+                    waiter = threading.Event()
+                    self._waiters.append(waiter)
+
+            if pc is not None:
+                if not self._is_healthy(pc):
+                    self._discard(pc)
+                    continue
+                break
+
+            if create:
+                try:
+                    pc = PooledConnection(self._connect())
+                except Exception:
+                    with self._lock:
+                        self._open -= 1
+                        self._wake_one()
+                    raise
+                with self._lock:
+                    self._created += 1
+                break
+
+            # Pool exhausted: wait for a release (or a discard) to wake us
+            waited = True
+            remaining = timeout - (time.time() - started)
+            if remaining <= 0 or not waiter.wait(remaining):
+                with self._lock:
+                    try:
+                        self._waiters.remove(waiter)
+                    except ValueError:
+                        pass
+                    self._timeouts += 1
+                raise PoolTimeout(f"No database connection available in pool '{self.name}' after {timeout}s")
+
+        waited_for = time.time() - started
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+                self._wait_time += waited_for
+                self._max_wait = max(self._max_wait, waited_for)
+        pc.last_used = time.time()
+        return pc
+
+    def release(self, pc):
+        if not pc.broken:
+            pc.broken = not self._reset(pc)
+        with self._lock:
+            self._in_use -= 1
+        if pc.broken or (time.time() - pc.created_at) > self.max_lifetime:
+            self._discard(pc)
+            return
+        pc.last_used = time.time()
+        with self._lock:
+            self._idle.append(pc)
+            self._wake_one()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'size': self.size,
+                'open': self._open,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': len(self._waiters),
+                'checkouts': self._checkouts,
+                'created': self._created,
+                'discarded': self._discarded,
+                'timeouts': self._timeouts,
+                'waits': self._waits,
+                'avg_wait_ms': round(self._wait_time / self._waits * 1000, 2) if self._waits else 0,
+                'max_wait_ms': round(self._max_wait * 1000, 2),
+            }
+
+    def close(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._open -= len(idle)
+        for pc in idle:
+            try:
+                pc.conn.close()
+            except Exception:
+                pass
+
+    # --- internals ---
+    def _wake_one(self):
+        # Caller holds self._lock
+        if self._waiters:
+            self._waiters.popleft().set()
+
+    def _discard(self, pc):
+        try:
+            pc.conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._open -= 1
+            self._discarded += 1
+            self._wake_one()
+
+    def _is_healthy(self, pc):
+        if (time.time() - pc.created_at) > self.max_lifetime:
+            return False
+        if getattr(pc.conn, 'closed', 0):
+            return False
+        if (time.time() - pc.last_used) < self.healthcheck_interval:
+            return True
+        try:
+            cur = pc.conn.cursor()
+            cur.execute('SELECT 1')
+            cur.fetchone()
+            cur.close()
+            return True
+        except Exception:
+            return False
+
+    def _reset(self, pc):
+        """Roll back anything left open so the next borrower starts clean."""
+        conn = pc.conn
+        try:
+            if isinstance(conn, sqlite3.Connection):
+                if conn.in_transaction:
+                    conn.rollback()
+            elif not conn.autocommit or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+                conn.autocommit = True
+            return True
+        except Exception:
+            return False
+
+
+def _connect_postgres(url=None, connect_timeout=None):
+    if connect_timeout:
+        conn = psycopg2.connect(url or get_database_url(), connect_timeout=connect_timeout)
+    else:
+        conn = psycopg2.connect(url or get_database_url())
+    # Each statement commits on its own; transactions are opened explicitly
+    conn.autocommit = True
+    return conn
+
+
+def sqlite_production():
+    return not is_postgres() and SQLITE_MODE == 'production'
+
+
+def _connect_sqlite():
+    # isolation_level=None: autocommit, same semantics as the Postgres pool
+    if sqlite_production() and SQLITE_SHARED_CACHE:
+        conn = sqlite3.connect(f'file:{SQLITE_PATH}?cache=shared', uri=True,
+                               check_same_thread=False, isolation_level=None)
+    else:
+        conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False, isolation_level=None)
+    if sqlite_production():
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        conn.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_KB}')
+        conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+
+class _WriteJob:
+    __slots__ = ('query', 'params', 'done', 'result', 'error')
+
+    def __init__(self, query, params):
+        self.query = query
+        self.params = params
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SQLiteWriter:
+    """Single writer for SQLite: autocommit writes are queued and applied by
+    one green thread on its own connection, many per COMMIT. Explicit
+    transactions borrow the same connection under `lock`, so there is only
+    ever one writer in the process and no SQLITE_BUSY between our own
+    connections."""
+
+    def __init__(self, batch_size=SQLITE_WRITER_BATCH):
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.pc = PooledConnection(_connect_sqlite())
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+        self._thread.start()
+
+        self._writes = 0
+        self._batches = 0
+        self._errors = 0
+        self._max_batch = 0
+
+    def submit(self, query, params):
+        job = _WriteJob(query, params)
+        self._queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'writes': self._writes,
+            'batches': self._batches,
+            'errors': self._errors,
+            'avg_batch': round(self._writes / self._batches, 2) if self._batches else 0,
+            'max_batch': self._max_batch,
+        }
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._apply(batch)
+            except Exception as e:
+                print(f"DB Error: SQLite writer batch failed: {e}")
+                for job in batch:
+                    if job.error is None:
+                        job.error = e
+            self._batches += 1
+            self._writes += len(batch)
+            self._max_batch = max(self._max_batch, len(batch))
+            for job in batch:
+                job.done.set()
+
+    def _apply(self, batch):
+        conn = self.pc.conn
+        with self.lock:
+            cursor = conn.cursor()
+            try:
+                cursor.execute('BEGIN IMMEDIATE')
+                for job in batch:
+                    # A savepoint per write keeps one bad statement from
+                    # failing everything else in the group
+                    cursor.execute('SAVEPOINT w')
+                    try:
+                        cursor.execute(job.query, job.params)
+                        job.result = cursor.lastrowid
+                        cursor.execute('RELEASE w')
+                    except Exception as e:
+                        print(f"DB Error: {e} | Query: {job.query}")
+                        job.error = e
+                        self._errors += 1
+                        cursor.execute('ROLLBACK TO w')
+                        cursor.execute('RELEASE w')
+                conn.commit()
+            except Exception:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+
+_pool = None
+_writer = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if is_postgres():
+                    _pool = ConnectionPool(_connect_postgres)
+                elif sqlite_production():
+                    # Readers live as long as the process: nothing to recycle
+                    _pool = ConnectionPool(_connect_sqlite, max_lifetime=float('inf'),
+                                           healthcheck_interval=float('inf'), name='sqlite-readers')
+                else:
+                    _pool = ConnectionPool(_connect_sqlite)
+    return _pool
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _pool_lock:
+            if _writer is None:
+                _writer = SQLiteWriter()
+    return _writer
+
+
+def pool_stats():
+    stats = get_pool().stats()
+    if _writer is not None:
+        stats['sqlite_writer'] = _writer.stats()
+    if _replicas:
+        stats['replicas'] = _replicas.stats()
+    return stats
+
+
+# --- Read replicas ---
+# execute_query(..., read_only=True) is served by a replica when
+# DATABASE_REPLICA_URLS is set, unless it runs inside a transaction or the
+# session wrote within the last REPLICA_STICKY_SECONDS (read-your-writes).
+# A replica that fails to connect or query is taken out of rotation for
+# REPLICA_RETRY_AFTER seconds and the read goes to the primary instead.
+
+class _Replica:
+    __slots__ = ('name', 'pool', 'down_until', 'reads', 'failures', 'last_error')
+
+    def __init__(self, url, index):
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+        host = parsed.hostname or query.get('host', ['localhost'])[0]
+        port = parsed.port or query.get('port', ['5432'])[0]
+        self.name = f"{host}:{port}"
+        self.pool = ConnectionPool(
+            lambda: _connect_postgres(url, connect_timeout=REPLICA_CONNECT_TIMEOUT),
+            name=f'replica-{index}')
+        self.down_until = 0.0
+        self.reads = 0
+        self.failures = 0
+        self.last_error = None
+
+
+class ReplicaSet:
+    """Round-robin over healthy replicas."""
+
+    def __init__(self, urls):
+        self.replicas = [_Replica(url, i) for i, url in enumerate(urls)]
+        self._next = 0
+        self.primary_fallbacks = 0
+
+    def pick(self):
+        now = time.time()
+        count = len(self.replicas)
+        start = self._next
+        self._next = (start + 1) % count
+        for i in range(count):
+            replica = self.replicas[(start + i) % count]
+            if replica.down_until <= now:
+                return replica
+        self.primary_fallbacks += 1
+        return None
+
+    def mark_down(self, replica, exc):
+        replica.down_until = time.time() + REPLICA_RETRY_AFTER
+        replica.failures += 1
+        replica.last_error = str(exc)[:200]
+        self.primary_fallbacks += 1
+        print(f"[DB] Replica {replica.name} out of rotation for {REPLICA_RETRY_AFTER:.0f}s: {exc}")
+
+    def stats(self):
+        now = time.time()
+        return {
+            'primary_fallbacks': self.primary_fallbacks,
+            'replicas': [{
+                'name': r.name,
+                'healthy': r.down_until <= now,
+                'reads': r.reads,
+                'failures': r.failures,
+                'last_error': r.last_error,
+                'pool': r.pool.stats(),
+            } for r in self.replicas],
+        }
+
+
+_replicas = None
+
+
+def get_replicas():
+    """The replica set, or None when reads can only go to the primary."""
+    global _replicas
+    if _replicas is None and REPLICA_URLS and is_postgres():
+        with _pool_lock:
+            if _replicas is None:
+                _replicas = ReplicaSet(REPLICA_URLS)
+    return _replicas
+
+
+def _note_write(query):
+    if REPLICA_URLS:
+        stmt = _statements.get(query)
+        if stmt is None or stmt.sticky:
+            _local.sticky_until = time.time() + REPLICA_STICKY_SECONDS
+
+
+def sticky_until():
+    """Until when this request/green thread must read from the primary.
+    web.py keeps it in the session so the user's next request sticks too."""
+    return getattr(_local, 'sticky_until', 0.0)
+
+
+def _replica_for_read():
+    replicas = get_replicas()
+    if replicas is None or in_transaction() or time.time() < sticky_until():
+        return None
+    return replicas.pick()
+
+
+def _is_connection_error(exc):
+    return psycopg2 is not None and isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+
+def _read_from_replica(replica, query, params, fetch_one, fetch_all):
+    pc = replica.pool.acquire(timeout=REPLICA_ACQUIRE_TIMEOUT)
+    stmt = _statements.get(query)
+    cursor = pc.conn.cursor()
+    try:
+        if stmt and stmt.prepare:
+            query = _prepare(pc, cursor, stmt)
+        cursor.execute(query, params)
+        replica.reads += 1
+        if fetch_one:
+            return cursor.fetchone()
+        if fetch_all:
+            return cursor.fetchall()
+    except Exception as e:
+        _mark_if_broken(pc, e)
+        raise
+    finally:
+        cursor.close()
+        replica.pool.release(pc)
+
+
+# --- Request scope ---
+# threading.local is green-thread local once eventlet has monkey patched.
+_local = threading.local()
+
+
+class _Scope:
+    __slots__ = ('pc',)
+
+    def __init__(self):
+        self.pc = None
+
+
+def open_scope(sticky_until=0.0):
+    """Start a per-request scope: the first query checks out a connection
+    which is then reused by every later query until close_scope().
+    `sticky_until` carries read-your-writes over from the session."""
+    _local.scope = _Scope()
+    _local.sticky_until = sticky_until
+
+
+def close_scope(exc=None):
+    scope = getattr(_local, 'scope', None)
+    _local.scope = None
+    if scope is not None and scope.pc is not None:
+        get_pool().release(scope.pc)
+
+
+class _Transaction:
+    __slots__ = ('pc', 'owned', 'depth')
+
+    def __init__(self, pc, owned):
+        self.pc = pc
+        self.owned = owned
+        self.depth = 0
+
+
+def in_transaction():
+    return getattr(_local, 'tx', None) is not None
+
+
+@contextmanager
+def transaction():
+    """Unit of work: every execute_query() inside the block runs on the same
+    connection and is committed once when the block exits (rolled back if it
+    raises). Nested blocks join the outermost transaction. Also usable as a
+    decorator to make a whole handler one transaction."""
+    tx = getattr(_local, 'tx', None)
+    if tx is not None:
+        tx.depth += 1
+        try:
+            yield
+        finally:
+            tx.depth -= 1
+        return
+
+    writer_lock = None
+    if sqlite_production():
+        # Same connection (and lock) as the writer thread: one writer only
+        writer_lock = get_writer().lock
+        writer_lock.acquire()
+        pc, owned = get_writer().pc, False
+    else:
+        pc, owned = _checkout()
+    conn = pc.conn
+    try:
+        if isinstance(conn, sqlite3.Connection):
+            # IMMEDIATE takes the write lock up front, avoiding busy upgrades
+            conn.execute('BEGIN IMMEDIATE')
+        else:
+            conn.autocommit = False
+    except Exception as e:
+        _mark_if_broken(pc, e)
+        if owned:
+            get_pool().release(pc)
+        if writer_lock is not None:
+            writer_lock.release()
+        raise
+
+    _local.tx = _Transaction(pc, owned)
+    try:
+        yield
+    except BaseException:
+        _local.tx = None
+        try:
+            conn.rollback()
+        except Exception as e:
+            _mark_if_broken(pc, e)
+        raise
+    else:
+        _local.tx = None
+        try:
+            conn.commit()
+        except Exception as e:
+            print(f"DB Error: commit failed: {e}")
+            _mark_if_broken(pc, e)
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+    finally:
+        if not isinstance(conn, sqlite3.Connection) and not pc.broken:
+            try:
+                conn.autocommit = True
+            except Exception:
+                pc.broken = True
+        if owned:
+            get_pool().release(pc)
+        if writer_lock is not None:
+            writer_lock.release()
+
+
+def _checkout():
+    """Return (pooled_connection, owned). Owned connections go back to the
+    pool right after the statement; scoped ones stay with the request or
+    the active transaction."""
+    tx = getattr(_local, 'tx', None)
+    if tx is not None:
+        return tx.pc, False
+    scope = getattr(_local, 'scope', None)
+    if scope is None:
+        return get_pool().acquire(), True
+    if scope.pc is None:
+        scope.pc = get_pool().acquire()
+    return scope.pc, False
+
+
+def _mark_if_broken(pc, exc):
+    if psycopg2 is not None and isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+        pc.broken = True
+    elif isinstance(exc, sqlite3.ProgrammingError) and 'closed' in str(exc):
+        pc.broken = True
+
+
+# --- Statement registry ---
+# Placeholder translation is done once per distinct query string. Hot queries
+# registered with register_statement() additionally become server-side
+# prepared statements on Postgres (PREPARE once per pooled connection, then
+# EXECUTE), which skips parse/plan on every call. Pass prepare=False for
+# shapes where the generic plan is worse than a custom one (LIMIT/range
+# pagination picks the wrong index once the bounds become parameters).
+
+@lru_cache(maxsize=2048)
+def _to_sqlite(query):
+    return query.replace('%s', '?')
+
+
+def _to_numbered(query):
+    parts = query.split('%s')
+    out = [parts[0]]
+    for i, part in enumerate(parts[1:], 1):
+        out.append(f'${i}')
+        out.append(part)
+    return ''.join(out), len(parts) - 1
+
+
+class Statement:
+    __slots__ = ('name', 'sql', 'prepare', 'sample', 'sticky', 'sqlite_sql', 'prepare_sql', 'execute_sql')
+
+    def __init__(self, name, sql, prepare=True, sample=None, sticky=True):
+        self.name = name
+        self.sql = sql
+        self.prepare = prepare
+        # False for bookkeeping writes that later reads never depend on
+        self.sticky = sticky
+        self.sqlite_sql = _to_sqlite(sql)
+        numbered, nparams = _to_numbered(sql)
+        # Representative parameters for EXPLAIN (index_advisor.py)
+        self.sample = tuple(sample) if sample is not None else (1,) * nparams
+        self.prepare_sql = f'PREPARE {name} AS {numbered}'
+        if nparams:
+            self.execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * nparams)})"
+        else:
+            self.execute_sql = f'EXECUTE {name}'
+
+
+_statements = {}
+
+
+def register_statement(name, sql, prepare=True, sample=None, sticky=True):
+    """Register a hot query under a stable name and return the SQL unchanged,
+    so call sites keep passing plain strings to execute_query()."""
+    stmt = Statement(f'q_{name}', sql, prepare, sample, sticky)
+    existing = _statements.get(sql)
+    if existing is not None and existing.name != stmt.name:
+        raise ValueError(f"Query already registered as {existing.name}")
+    _statements[sql] = stmt
+    return sql
+
+
+def registered_statements():
+    return list(_statements.values())
+
+
+def _prepare(pc, cursor, stmt):
+    if stmt.name not in pc.prepared:
+        cursor.execute(stmt.prepare_sql)
+        pc.prepared.add(stmt.name)
+    return stmt.execute_sql
+
+
+def _drop_from_scope(pc):
+    scope = getattr(_local, 'scope', None)
+    if scope is not None and scope.pc is pc:
+        scope.pc = None
+        get_pool().release(pc)
+
+
+# --- Instrumentation ---
+# An observer (query_stats.record) is called with (query, seconds) after
+# every statement, including failed ones.
+_query_observer = None
+
+
+def set_query_observer(observer):
+    global _query_observer
+    _query_observer = observer
+
+
+def execute_query(query, params=(), fetch_one=False, fetch_all=False, commit=False, read_only=False):
+    """Run one statement. Outside a transaction it autocommits; inside
+    `with transaction():` commit=True only returns lastrowid and the actual
+    commit happens once at the end of the block. read_only=True marks a
+    plain read that may be served by a replica (DATABASE_REPLICA_URLS)."""
+    observer = _query_observer
+    if observer is None:
+        return _execute_query(query, params, fetch_one, fetch_all, commit, read_only)
+    start = time.perf_counter()
+    try:
+        return _execute_query(query, params, fetch_one, fetch_all, commit, read_only)
+    finally:
+        observer(query, time.perf_counter() - start)
+
+
+def _execute_query(query, params, fetch_one, fetch_all, commit, read_only):
+    if commit:
+        _note_write(query)
+        if sqlite_production() and not in_transaction():
+            stmt = _statements.get(query)
+            return get_writer().submit(stmt.sqlite_sql if stmt else _to_sqlite(query), params)
+    elif read_only:
+        replica = _replica_for_read()
+        if replica is not None:
+            try:
+                return _read_from_replica(replica, query, params, fetch_one, fetch_all)
+            except PoolTimeout:
+                # Replica busy, not broken: this read goes to the primary
+                _replicas.primary_fallbacks += 1
+            except Exception as e:
+                if not _is_connection_error(e):
+                    print(f"DB Error: {e} | Query: {query}")
+                    raise
+                _replicas.mark_down(replica, e)
+
+    pc, owned = _checkout()
+    conn = pc.conn
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    stmt = _statements.get(query)
+
+    cursor = conn.cursor()
+    try:
+        # Adapting placeholders: %s for PG, ? for SQLite (cached per query)
+        if is_sqlite:
+            query = stmt.sqlite_sql if stmt else _to_sqlite(query)
+        elif stmt and stmt.prepare:
+            query = _prepare(pc, cursor, stmt)
+        cursor.execute(query, params)
+        if fetch_one:
+            return cursor.fetchone()  # also INSERT ... RETURNING
+        if fetch_all:
+            return cursor.fetchall()
+        if commit:
+            return cursor.lastrowid  # Always 0 on Postgres: use insert()
+    except Exception as e:
+        print(f"DB Error: {e} | Query: {query}")
+        _mark_if_broken(pc, e)
+        if pc.broken and not owned:
+            # Don't keep a dead connection for the rest of the request
+            _drop_from_scope(pc)
+        raise e
+    finally:
+        cursor.close()
+        if owned:
+            get_pool().release(pc)
+
+
+def insert(query, params=()):
+    """Run an INSERT and return the new row's id on both dialects
+    (cursor.lastrowid is always 0 with psycopg2)."""
+    if is_postgres():
+        return execute_query(f'{query} RETURNING id', params, fetch_one=True, commit=True)[0]
+    return execute_query(query, params, commit=True)
+
+
+def execute_many(query, seq_of_params):
+    """Run one write statement for every parameter tuple, in one transaction
+    with a single commit. Returns the number of tuples."""
+    seq_of_params = list(seq_of_params)
+    if not seq_of_params:
+        return 0
+    start = time.perf_counter()
+    try:
+        with transaction():
+            _note_write(query)
+            pc = _local.tx.pc
+            cursor = pc.conn.cursor()
+            try:
+                if isinstance(pc.conn, sqlite3.Connection):
+                    stmt = _statements.get(query)
+                    cursor.executemany(stmt.sqlite_sql if stmt else _to_sqlite(query), seq_of_params)
+                else:
+                    # Plain executemany() is one round trip per tuple with psycopg2
+                    psycopg2.extras.execute_batch(cursor, query, seq_of_params)
+            except Exception as e:
+                print(f"DB Error: {e} | Query: {query}")
+                _mark_if_broken(pc, e)
+                raise
+            finally:
+                cursor.close()
+    finally:
+        if _query_observer is not None:
+            _query_observer(query, time.perf_counter() - start)
+    return len(seq_of_params)
+
+
+# --- Streaming ---
+# A server-side named cursor on Postgres, fetchmany() on SQLite. The
+# generator holds its own pooled connection until it is exhausted or closed,
+# so it can safely outlive the request scope (streamed responses).
+
+_stream_ids = itertools.count(1)
+
+
+def stream_query(query, params=(), batch_size=STREAM_BATCH_SIZE, read_only=False):
+    """Yield rows one by one, fetching `batch_size` rows per round trip.
+    Inside `with transaction():` it reads on the transaction's connection.
+
+    SQLite in simple mode has no WAL snapshot between readers and the
+    writer, so an open read cursor would block the caller's own writes;
+    there the result is fetched eagerly and then yielded."""
+    tx = getattr(_local, 'tx', None)
+    if tx is not None:
+        yield from _stream_rows(tx.pc, query, params, batch_size)
+        return
+
+    pool = get_pool()
+    replica = _replica_for_read() if read_only else None
+    pc = None
+    if replica is not None:
+        try:
+            pc = replica.pool.acquire(timeout=REPLICA_ACQUIRE_TIMEOUT)
+            pool = replica.pool
+        except PoolTimeout:
+            _replicas.primary_fallbacks += 1
+        except Exception as e:
+            if not _is_connection_error(e):
+                raise
+            _replicas.mark_down(replica, e)
+    if pc is None:
+        pc = pool.acquire()
+
+    conn = pc.conn
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    try:
+        if is_sqlite:
+            yield from _stream_rows(pc, query, params, batch_size)
+        else:
+            # Named cursors only exist inside a transaction
+            conn.autocommit = False
+            try:
+                yield from _stream_rows(pc, query, params, batch_size)
+            finally:
+                try:
+                    conn.rollback()
+                    conn.autocommit = True
+                except Exception as e:
+                    _mark_if_broken(pc, e)
+                    pc.broken = True
+    finally:
+        pool.release(pc)
+
+
+def _stream_rows(pc, query, params, batch_size):
+    # Observed once per stream with the time spent in execute/fetch only,
+    # not in the consumer between batches
+    observer = _query_observer
+    observed = query
+    db_time = 0.0
+    conn = pc.conn
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    if is_sqlite:
+        stmt = _statements.get(query)
+        query = stmt.sqlite_sql if stmt else _to_sqlite(query)
+        cursor = conn.cursor()
+    else:
+        cursor = conn.cursor(name=f'stream_{next(_stream_ids)}')
+        cursor.itersize = batch_size
+    try:
+        start = time.perf_counter()
+        cursor.execute(query, params)
+        if is_sqlite and not sqlite_production():
+            rows = cursor.fetchall()
+            db_time += time.perf_counter() - start
+            yield from rows
+            return
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            db_time += time.perf_counter() - start
+            if not rows:
+                break
+            yield from rows
+            start = time.perf_counter()
+    except Exception as e:
+        print(f"DB Error: {e} | Query: {query}")
+        _mark_if_broken(pc, e)
+        raise
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+        if observer is not None:
+            observer(observed, db_time)
+
+
+def stream_batches(query, params=(), batch_size=STREAM_BATCH_SIZE, read_only=False):
+    """stream_query() grouped into lists of up to `batch_size` rows, for
+    callers that write or notify per chunk."""
+    rows = stream_query(query, params, batch_size, read_only)
+    try:
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            yield batch
+    finally:
+        rows.close()
@@ -0,0 +1,93 @@
+"""
+Index advisor: EXPLAIN every statement registered in queries.py against the
+configured database and report the ones that still need a full table scan.
+
+Postgres runs each EXPLAIN with enable_seqscan off, so a Seq Scan in the plan
+means no index can serve the query at all (not just that the table is small).
+SQLite reports any "SCAN <table>" step that isn't using an index.
+
+    python index_advisor.py            # report, exit 1 if any scans found
+    python index_advisor.py --apply    # apply pending migrations first
+    python index_advisor.py --verbose  # also print the full plans
+
+Run it after changing a hot query or the index set, before deploying.
+"""
+import json
+import sqlite3
+import sys
+
+import db
+import migrations
+import queries  # noqa: F401  (registers the statements)
+
+
+def _pg_seq_scans(node, found):
+    if node.get('Node Type') == 'Seq Scan':
+        found.append(node.get('Relation Name'))
+    for child in node.get('Plans', []):
+        _pg_seq_scans(child, found)
+    return found
+
+
+def explain_postgres(cursor, stmt):
+    cursor.execute('SAVEPOINT advisor')
+    try:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {stmt.sql}', stmt.sample)
+        raw = cursor.fetchone()[0]
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT advisor')
+        raise
+    plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]['Plan']
+    return _pg_seq_scans(plan, []), json.dumps(plan, indent=2)
+
+
+def explain_sqlite(cursor, stmt):
+    cursor.execute(f'EXPLAIN QUERY PLAN {stmt.sqlite_sql}', stmt.sample)
+    details = [row[3] for row in cursor.fetchall()]
+    scans = [d.split()[1] for d in details
+             if d.startswith('SCAN ') and 'USING' not in d and 'CONSTANT ROW' not in d]
+    return scans, '\n'.join(details)
+
+
+def run(verbose=False):
+    conn = db.get_db_connection()
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    print(f"[*] Schema v{migrations.current_version(conn)} "
+          f"(latest v{migrations.latest_version()}), "
+          f"{'SQLite' if is_sqlite else 'Postgres'}")
+
+    cursor = conn.cursor()
+    if not is_sqlite:
+        cursor.execute('SET LOCAL enable_seqscan = off')
+
+    flagged = 0
+    for stmt in sorted(db.registered_statements(), key=lambda s: s.name):
+        try:
+            if is_sqlite:
+                scans, plan = explain_sqlite(cursor, stmt)
+            else:
+                scans, plan = explain_postgres(cursor, stmt)
+        except Exception as e:
+            print(f"  [!] {stmt.name}: could not explain ({e})")
+            continue
+
+        if scans:
+            flagged += 1
+            print(f"  [SCAN] {stmt.name}: full scan of {', '.join(sorted(set(scans)))}")
+        else:
+            print(f"  [ok]   {stmt.name}")
+        if verbose:
+            print('         ' + plan.replace('\n', '\n         '))
+
+    conn.rollback()
+    cursor.close()
+    conn.close()
+    print(f"[OK] {flagged} statement(s) need a full table scan" if flagged
+          else "[OK] Every registered statement is served by an index")
+    return flagged
+
+
+if __name__ == '__main__':
+    if '--apply' in sys.argv:
+        migrations.migrate()
+    sys.exit(1 if run(verbose='--verbose' in sys.argv) else 0)
@@ -0,0 +1,227 @@
+"""
+Outbound mail queue.
+
+enqueue() stores a message in the mail_queue table and returns at once; a
+background green thread (Mailer.run) drains the queue over one
+authenticated SMTP connection that stays open between messages and is
+closed after SMTP_IDLE_TIMEOUT idle seconds. Failed sends are retried with
+exponential backoff; after MAIL_MAX_ATTEMPTS, or on a permanent refusal,
+the message is marked failed and the on_failure callbacks run. The same
+happens to a message enqueued with expires_at (a verification code's
+expiry) once its next attempt would come after it: nobody can use it then.
+
+Every worker process drains the same table. A message is claimed by an
+UPDATE that also sets a lease, so a worker that dies mid-send only delays
+the messages it held by MAIL_LEASE seconds.
+
+For local testing point the settings at an SMTP sink, e.g.
+    python -m aiosmtpd -n -l localhost:1025
+    SMTP_SERVER=localhost SMTP_PORT=1025 SMTP_STARTTLS=0 python web.py
+"""
+import os
+import random
+import smtplib
+import threading
+import time
+import uuid
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import db
+import queries
+
+MAIL_POLL_INTERVAL = float(os.environ.get('MAIL_POLL_INTERVAL', 5))
+MAIL_BATCH = int(os.environ.get('MAIL_BATCH', 20))
+MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS', 6))
+# Retry delays: 30 s, 1 min, 2 min, ... capped at MAIL_RETRY_MAX, +-20% jitter
+MAIL_RETRY_BASE = float(os.environ.get('MAIL_RETRY_BASE', 30))
+MAIL_RETRY_MAX = float(os.environ.get('MAIL_RETRY_MAX', 3600))
+MAIL_LEASE = 120
+MAIL_KEEP_SENT = 7 * 86400
+SMTP_IDLE_TIMEOUT = float(os.environ.get('SMTP_IDLE_TIMEOUT', 60))
+SMTP_TIMEOUT = 30
+
+_PLACEHOLDERS = ('your_email@mail.ru', 'your_app_password')
+
+
+class PermanentFailure(Exception):
+    pass
+
+
+def retry_delay(attempts):
+    delay = min(MAIL_RETRY_BASE * 2 ** (attempts - 1), MAIL_RETRY_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+class Mailer:
+    def __init__(self, host, port, user, password, sender_name='Octave', starttls=True):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.sender_name = sender_name
+        self.starttls = starttls
+        self._smtp = None
+        self._last_used = 0.0
+        self._wake = threading.Event()
+        # One drain at a time: they share the SMTP connection
+        self._drain_lock = threading.Lock()
+        self._failure_callbacks = []
+        self._last_purge = 0.0
+
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.connects = 0
+
+    @property
+    def configured(self):
+        return bool(self.host) and self.user not in _PLACEHOLDERS and self.password not in _PLACEHOLDERS
+
+    def on_failure(self, callback):
+        """callback(to_addr, subject) for messages that will never be sent."""
+        self._failure_callbacks.append(callback)
+        return callback
+
+    # --- Producer side ---
+    def enqueue(self, to_addr, subject, html, expires_at=None):
+        """Queue a message; returns its id. Delivery happens in run(), and is
+        given up once expires_at passes."""
+        mail_id = db.insert(queries.MAIL_ENQUEUE, (to_addr, subject, html, 0, time.time(), expires_at))
+        self._wake.set()
+        return mail_id
+
+    # --- Worker side ---
+    def run(self):
+        """Worker loop; start once per process with eventlet.spawn()."""
+        while True:
+            self._wake.wait(MAIL_POLL_INTERVAL)
+            self._wake.clear()
+            try:
+                while self.drain() == MAIL_BATCH:
+                    pass
+                if self._smtp is not None and time.time() - self._last_used > SMTP_IDLE_TIMEOUT:
+                    self._close()
+                self._purge()
+            except Exception as e:
+                print(f"[Mailer Error] {e}")
+
+    def drain(self):
+        """Send one batch of due messages; returns how many were claimed."""
+        with self._drain_lock:
+            return self._drain()
+
+    def _drain(self):
+        now = time.time()
+        claim = uuid.uuid4().hex
+        db.execute_query(queries.MAIL_CLAIM, (claim, now + MAIL_LEASE, now, now, MAIL_BATCH), commit=True)
+        rows = db.execute_query(queries.MAIL_CLAIMED, (claim,), fetch_all=True)
+
+        for mail_id, to_addr, subject, html, attempts, expires_at in rows or ():
+            if expires_at is not None and expires_at <= now:
+                self._record_failure(mail_id, to_addr, subject, attempts, "expired before it was sent", True)
+                continue
+            attempts += 1
+            try:
+                self._deliver(to_addr, subject, html)
+            except Exception as e:
+                permanent = isinstance(e, PermanentFailure) or attempts >= MAIL_MAX_ATTEMPTS
+                self._record_failure(mail_id, to_addr, subject, attempts, e, permanent, expires_at)
+                continue
+            db.execute_query(queries.MAIL_SENT, (attempts, time.time(), mail_id), commit=True)
+            self.sent += 1
+        return len(rows or ())
+
+    def _record_failure(self, mail_id, to_addr, subject, attempts, error, permanent, expires_at=None):
+        delay = retry_delay(attempts)
+        if not permanent and expires_at is not None and time.time() + delay >= expires_at:
+            permanent = True
+            error = f"{error}; expires before the next retry"
+        if permanent:
+            db.execute_query(queries.MAIL_FAILED, (attempts, str(error)[:500], mail_id), commit=True)
+            self.failed += 1
+            print(f"[!] Mail to {to_addr} failed for good after {attempts} attempt(s): {error}")
+            for callback in self._failure_callbacks:
+                try:
+                    callback(to_addr, subject)
+                except Exception as e:
+                    print(f"[Mailer Error] failure callback: {e}")
+        else:
+            db.execute_query(queries.MAIL_RETRY, (attempts, time.time() + delay, str(error)[:500], mail_id),
+                             commit=True)
+            self.retried += 1
+            print(f"[*] Mail to {to_addr} failed ({error}), retry {attempts} in {delay:.0f}s")
+
+    def _purge(self):
+        now = time.time()
+        if now - self._last_purge < 3600:
+            return
+        self._last_purge = now
+        db.execute_query(queries.MAIL_PURGE, (now - MAIL_KEEP_SENT,), commit=True)
+
+    # --- SMTP ---
+    def _message(self, to_addr, subject, html):
+        msg = MIMEMultipart()
+        msg['From'] = f"{self.sender_name} <{self.user}>"
+        msg['To'] = to_addr
+        msg['Subject'] = subject
+        msg.attach(MIMEText(html, 'html'))
+        return msg
+
+    def _connection(self):
+        if self._smtp is None:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+            try:
+                if self.starttls:
+                    smtp.starttls()
+                if self.user and self.password:
+                    smtp.login(self.user, self.password)
+            except Exception:
+                smtp.close()
+                raise
+            self._smtp = smtp
+            self.connects += 1
+        return self._smtp
+
+    def _close(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except Exception:
+                smtp.close()
+
+    def _deliver(self, to_addr, subject, html):
+        msg = self._message(to_addr, subject, html)
+        # The server may have dropped the kept-alive connection: reconnect once
+        for retry in (False, True):
+            smtp = self._connection()
+            try:
+                smtp.send_message(msg)
+                self._last_used = time.time()
+                return
+            except smtplib.SMTPRecipientsRefused as e:
+                raise PermanentFailure(f"recipient refused: {e.recipients}")
+            except smtplib.SMTPResponseException as e:
+                # The session is still usable after a rejected message;
+                # 5xx means resending the same message won't help
+                if e.smtp_code >= 500:
+                    raise PermanentFailure(f"{e.smtp_code} {e.smtp_error!r}")
+                raise
+            except smtplib.SMTPServerDisconnected:
+                self._close()
+                if retry:
+                    raise
+            except Exception:
+                self._close()
+                raise
+
+    def stats(self):
+        return {
+            'configured': self.configured,
+            'connected': self._smtp is not None,
+            'connects': self.connects,
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+        }
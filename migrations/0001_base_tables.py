@@ -0,0 +1,76 @@
+"""Core tables (formerly init_db in web.py)."""
+
+
+def up(ctx):
+    pk_type = ctx.pk_type
+    varchar_type = ctx.varchar_type
+
+    ctx.execute(f'''CREATE TABLE IF NOT EXISTS users
+                 (id {pk_type}, 
+                  username TEXT UNIQUE NOT NULL, 
+                  password_hash TEXT NOT NULL, 
+                  avatar TEXT,
+                  created_at REAL,
+                  display_name TEXT,
+                  banner TEXT,
+                  bio TEXT,
+                  email TEXT,
+                  phone TEXT,
+                  role TEXT DEFAULT 'user',
+                  reputation INTEGER DEFAULT 0,
+                  last_seen REAL,
+                  admin_pin TEXT)''')
+
+    ctx.execute(f'''CREATE TABLE IF NOT EXISTS friends
+                 (id {pk_type}, 
+                  user_id_1 INTEGER NOT NULL, 
+                  user_id_2 INTEGER NOT NULL, 
+                  status TEXT DEFAULT 'pending', 
+                  created_at REAL,
+                  UNIQUE(user_id_1, user_id_2))''')
+
+    ctx.execute(f'''CREATE TABLE IF NOT EXISTS direct_messages
+                 (id {pk_type},
+                  user_id_1 INTEGER NOT NULL,
+                  user_id_2 INTEGER NOT NULL,
+                  last_message_at REAL,
+                  UNIQUE(user_id_1, user_id_2))''')
+
+    ctx.execute(f'''CREATE TABLE IF NOT EXISTS dm_messages
+                 (id {pk_type},
+                  dm_id INTEGER NOT NULL,
+                  author_id INTEGER NOT NULL,
+                  content TEXT,
+                  timestamp REAL,
+                  reply_to_id INTEGER,
+                  is_pinned INTEGER DEFAULT 0,
+                  edited_at REAL,
+                  attachments TEXT,
+                  expires_at REAL)''')
+
+    ctx.execute(f'''CREATE TABLE IF NOT EXISTS reports
+                 (id {pk_type},
+                  message_id INTEGER NOT NULL,
+                  reporter_id INTEGER NOT NULL,
+                  reason TEXT NOT NULL,
+                  timestamp REAL)''')
+
+    ctx.execute(f'''CREATE TABLE IF NOT EXISTS message_reactions
+                 (id {pk_type},
+                  message_id INTEGER NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  emoji {varchar_type} NOT NULL,
+                  created_at REAL,
+                  UNIQUE(message_id, user_id, emoji))''')
+
+    ctx.execute(f'''CREATE TABLE IF NOT EXISTS server_members
+                 (id {pk_type},
+                  server_id TEXT NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  role TEXT DEFAULT 'member',
+                  joined_at REAL,
+                  UNIQUE(server_id, user_id))''')
+
+    ctx.execute('CREATE INDEX IF NOT EXISTS idx_dm_messages_timestamp ON dm_messages(timestamp)')
+    ctx.execute('CREATE INDEX IF NOT EXISTS idx_message_reactions_message_id ON message_reactions(message_id)')
+    ctx.execute('CREATE INDEX IF NOT EXISTS idx_direct_messages_last_message_at ON direct_messages(last_message_at)')
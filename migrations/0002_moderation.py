@@ -0,0 +1,25 @@
+"""Moderation columns and staff-only tables (formerly run_db_migration)."""
+
+
+def up(ctx):
+    pk_type = ctx.pk_type
+
+    ctx.add_column("users", "ip_address", "TEXT")
+    ctx.add_column("users", "device_id", "TEXT")
+    ctx.add_column("users", "is_banned", "INTEGER DEFAULT 0")
+    ctx.add_column("users", "ban_expires", "REAL")
+    ctx.add_column("users", "ban_reason", "TEXT")
+    ctx.add_column("users", "is_muted", "INTEGER DEFAULT 0")
+    ctx.add_column("users", "mute_expires", "REAL")
+    ctx.add_column("users", "risk_score", "INTEGER DEFAULT 0")  # 0-100
+    ctx.add_column("users", "is_verified", "INTEGER DEFAULT 0")
+    ctx.add_column("users", "status", "TEXT DEFAULT 'offline'")
+
+    ctx.add_column("reports", "status", "TEXT DEFAULT 'pending'")  # pending, in_review, resolved
+    ctx.add_column("reports", "assigned_to", "INTEGER")
+    ctx.add_column("reports", "staff_note", "TEXT")
+
+    ctx.execute(f"CREATE TABLE IF NOT EXISTS admin_logs (id {pk_type}, admin_id INTEGER, ip_address TEXT, action TEXT, details TEXT, timestamp REAL)")
+    ctx.execute(f"CREATE TABLE IF NOT EXISTS risk_alerts (id {pk_type}, user_id INTEGER, type TEXT, details TEXT, risk_level TEXT, timestamp REAL)")
+    ctx.execute(f"CREATE TABLE IF NOT EXISTS read_receipts (id {pk_type}, dm_id INTEGER, user_id INTEGER, last_read_message_id INTEGER, updated_at REAL, UNIQUE(dm_id, user_id))")
+    ctx.execute("CREATE TABLE IF NOT EXISTS verification_codes (email TEXT PRIMARY KEY, code TEXT, expires_at REAL)")
@@ -0,0 +1,24 @@
+"""Columns and tables the messaging features use but init_db never created
+(they only existed on databases patched by hand)."""
+
+
+def up(ctx):
+    pk_type = ctx.pk_type
+
+    ctx.add_column("users", "custom_status", "TEXT")
+    ctx.add_column("users", "status_emoji", "TEXT")
+    ctx.add_column("users", "public_key", "TEXT")
+
+    ctx.add_column("dm_messages", "is_encrypted", "INTEGER DEFAULT 0")
+    ctx.add_column("dm_messages", "encryption_metadata", "TEXT")
+    ctx.add_column("dm_messages", "cloud_folder_id", "INTEGER")
+    ctx.add_column("dm_messages", "tags", "TEXT")
+
+    ctx.execute(f"CREATE TABLE IF NOT EXISTS cloud_folders (id {pk_type}, user_id INTEGER NOT NULL, name TEXT NOT NULL, color TEXT, icon TEXT, created_at REAL)")
+    ctx.execute("CREATE INDEX IF NOT EXISTS idx_cloud_folders_user_id ON cloud_folders(user_id)")
+
+    ctx.execute(f"CREATE TABLE IF NOT EXISTS file_uploads (id {pk_type}, message_id INTEGER, file_size INTEGER, created_at REAL)")
+    ctx.execute("CREATE INDEX IF NOT EXISTS idx_file_uploads_message_id ON file_uploads(message_id)")
+
+    ctx.execute(f"CREATE TABLE IF NOT EXISTS photo_albums (id {pk_type}, message_id INTEGER, photo_count INTEGER, created_at REAL)")
+    ctx.execute("CREATE TABLE IF NOT EXISTS link_previews (url TEXT PRIMARY KEY, title TEXT, description TEXT, image_url TEXT, site_name TEXT, cached_at REAL)")
@@ -0,0 +1,9 @@
+"""Composite indexes for the hot messaging queries (schema.py, set v1)."""
+import schema
+
+# CREATE INDEX CONCURRENTLY can't run inside a transaction on Postgres
+TRANSACTIONAL = False
+
+
+def up(ctx):
+    schema.create_index_set(ctx.cursor, ctx.is_sqlite, 1)
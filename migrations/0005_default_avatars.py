@@ -0,0 +1,12 @@
+"""One-time reset of every avatar to the local default silhouette.
+
+This used to run on every start of web.py (fix_existing_avatars). The value
+is copied from web.DEFAULT_AVATAR so the migration stays fixed if that
+constant changes later.
+"""
+
+DEFAULT_AVATAR = "data:image/svg+xml,%3Csvg xmlns='http://www.w3.org/2000/svg' width='128' height='128' viewBox='0 0 128 128'%3E%3Crect width='128' height='128' fill='%235865F2'/%3E%3Ccircle cx='64' cy='50' r='22' fill='%23fff'/%3E%3Cellipse cx='64' cy='112' rx='36' ry='28' fill='%23fff'/%3E%3C/svg%3E"
+
+
+def up(ctx):
+    ctx.execute("UPDATE users SET avatar = %s", (DEFAULT_AVATAR,))
@@ -0,0 +1,9 @@
+"""Index for the admin risk-alert lookup (schema.py, set v2)."""
+import schema
+
+# CREATE INDEX CONCURRENTLY can't run inside a transaction on Postgres
+TRANSACTIONAL = False
+
+
+def up(ctx):
+    schema.create_index_set(ctx.cursor, ctx.is_sqlite, 2)
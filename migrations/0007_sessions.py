@@ -0,0 +1,11 @@
+"""Server-side session store (sessions.py)."""
+
+
+def up(ctx):
+    time_type = "REAL" if ctx.is_sqlite else "DOUBLE PRECISION"
+    ctx.execute(f'''CREATE TABLE IF NOT EXISTS sessions
+                 (sid TEXT PRIMARY KEY,
+                  data TEXT NOT NULL,
+                  expires_at {time_type} NOT NULL)''')
+    # Periodic purge of expired sessions
+    ctx.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions(expires_at)")
@@ -0,0 +1,12 @@
+"""Shared counters for RATE_LIMIT_STORE=db (ratelimit.py)."""
+
+
+def up(ctx):
+    time_type = "REAL" if ctx.is_sqlite else "DOUBLE PRECISION"
+    ctx.execute(f'''CREATE TABLE IF NOT EXISTS rate_limits
+                 (key TEXT NOT NULL,
+                  window_index BIGINT NOT NULL,
+                  count INTEGER NOT NULL,
+                  expires_at {time_type} NOT NULL,
+                  PRIMARY KEY (key, window_index))''')
+    ctx.execute("CREATE INDEX IF NOT EXISTS idx_rate_limits_expires_at ON rate_limits(expires_at)")
@@ -0,0 +1,20 @@
+"""Outbound mail queue drained by mailer.py."""
+
+
+def up(ctx):
+    time_type = "REAL" if ctx.is_sqlite else "DOUBLE PRECISION"
+    ctx.execute(f'''CREATE TABLE IF NOT EXISTS mail_queue
+                 (id {ctx.pk_type},
+                  to_addr TEXT NOT NULL,
+                  subject TEXT NOT NULL,
+                  html TEXT NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'pending',
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  next_attempt_at {time_type} NOT NULL,
+                  claim TEXT,
+                  last_error TEXT,
+                  created_at {time_type},
+                  sent_at {time_type})''')
+    # Worker poll: due messages in a given status
+    ctx.execute("CREATE INDEX IF NOT EXISTS idx_mail_queue_status_next ON mail_queue(status, next_attempt_at)")
+    ctx.execute("CREATE INDEX IF NOT EXISTS idx_mail_queue_claim ON mail_queue(claim)")
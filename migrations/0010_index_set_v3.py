@@ -0,0 +1,9 @@
+"""Prefix index for username generation (schema.py, set v3)."""
+import schema
+
+# CREATE INDEX CONCURRENTLY can't run inside a transaction on Postgres
+TRANSACTIONAL = False
+
+
+def up(ctx):
+    schema.create_index_set(ctx.cursor, ctx.is_sqlite, 3)
@@ -0,0 +1,9 @@
+"""Partial index over banned/muted users for sanctions.py (schema.py, set v4)."""
+import schema
+
+# CREATE INDEX CONCURRENTLY can't run inside a transaction on Postgres
+TRANSACTIONAL = False
+
+
+def up(ctx):
+    schema.create_index_set(ctx.cursor, ctx.is_sqlite, 4)
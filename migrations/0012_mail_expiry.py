@@ -0,0 +1,6 @@
+"""Optional send deadline for queued mail, e.g. verification codes (mailer.py)."""
+
+
+def up(ctx):
+    time_type = "REAL" if ctx.is_sqlite else "DOUBLE PRECISION"
+    ctx.add_column("mail_queue", "expires_at", time_type)
@@ -0,0 +1,248 @@
+"""
+Versioned schema migrations.
+
+Each migration is a module in this package named NNNN_description.py with an
+up(ctx) function. Applied versions are recorded in the schema_version table.
+A run holds an advisory lock (session-level on Postgres, BEGIN IMMEDIATE
+on SQLite), so when several workers boot at once only one of them migrates
+and the rest find the schema already current.
+
+    python -m migrations            # apply pending migrations
+    python -m migrations status     # show current / latest version
+
+The web process only calls startup_check(): one query when the schema is
+current. Set MIGRATE_ON_STARTUP=0 to make it report a stale schema instead
+of migrating (for deploys with a release phase, see Procfile).
+"""
+import importlib
+import os
+import pkgutil
+import re
+import sqlite3
+import time
+
+import db
+
+# Arbitrary constant shared by every process of this app
+LOCK_KEY = 72_910_426
+LOCK_POLL_INTERVAL = 0.5
+MIGRATE_ON_STARTUP = os.environ.get('MIGRATE_ON_STARTUP', '1') == '1'
+
+_MODULE_RE = re.compile(r'^(\d{4})_(\w+)$')
+
+
+class Migration:
+    __slots__ = ('version', 'name', 'module', 'transactional')
+
+    def __init__(self, version, name, module):
+        self.version = version
+        self.name = name
+        self.module = module
+        # Postgres DDL that can't run in a transaction (CREATE INDEX
+        # CONCURRENTLY) sets TRANSACTIONAL = False in its module
+        self.transactional = getattr(module, 'TRANSACTIONAL', True)
+
+
+_migrations = None
+
+
+def discover():
+    global _migrations
+    if _migrations is None:
+        found = []
+        for info in pkgutil.iter_modules(__path__):
+            match = _MODULE_RE.match(info.name)
+            if not match:
+                continue
+            module = importlib.import_module(f'{__name__}.{info.name}')
+            found.append(Migration(int(match.group(1)), info.name, module))
+        found.sort(key=lambda m: m.version)
+        versions = [m.version for m in found]
+        if len(versions) != len(set(versions)):
+            raise RuntimeError(f"Duplicate migration versions: {versions}")
+        _migrations = found
+    return _migrations
+
+
+def latest_version():
+    migrations = discover()
+    return migrations[-1].version if migrations else 0
+
+
+class Context:
+    """What a migration's up() gets: a cursor plus dialect helpers."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.is_sqlite = isinstance(conn, sqlite3.Connection)
+        self.pk_type = "INTEGER PRIMARY KEY AUTOINCREMENT" if self.is_sqlite else "SERIAL PRIMARY KEY"
+        self.varchar_type = "TEXT" if self.is_sqlite else "VARCHAR(50)"
+        self._columns = {}
+
+    def execute(self, sql, params=()):
+        if self.is_sqlite:
+            sql = sql.replace('%s', '?')
+        self.cursor.execute(sql, params)
+        return self.cursor
+
+    def add_column(self, table, column, col_type):
+        if not self.is_sqlite:
+            # No catalog round trip needed
+            self.cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {col_type}")
+            return
+        cols = self._columns.get(table)
+        if cols is None:
+            self.cursor.execute(f"PRAGMA table_info({table})")
+            cols = self._columns[table] = {row[1] for row in self.cursor.fetchall()}
+        if column not in cols:
+            self.cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type}")
+            cols.add(column)
+            print(f"  [+] Added {column} to {table}")
+
+
+def _ensure_version_table(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schema_version
+                      (version INTEGER PRIMARY KEY,
+                       name TEXT NOT NULL,
+                       applied_at REAL)""")
+
+
+def _read_version(cursor):
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    row = cursor.fetchone()
+    return row[0] or 0
+
+
+def current_version(conn=None):
+    """Highest applied version, 0 for a database that was never migrated."""
+    own = conn is None
+    if own:
+        conn = db.get_db_connection()
+    cursor = conn.cursor()
+    try:
+        return _read_version(cursor)
+    except Exception:
+        conn.rollback()
+        return 0
+    finally:
+        cursor.close()
+        if own:
+            conn.close()
+
+
+def _lock(conn, is_sqlite):
+    cursor = conn.cursor()
+    if is_sqlite:
+        # Held until the final COMMIT; other writers wait on busy_timeout
+        cursor.execute("BEGIN IMMEDIATE")
+    else:
+        # Poll instead of blocking in pg_advisory_lock(): a blocked call holds
+        # a snapshot, and CREATE INDEX CONCURRENTLY in the winning process
+        # waits for every open snapshot -> deadlock.
+        while True:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (LOCK_KEY,))
+            if cursor.fetchone()[0]:
+                break
+            time.sleep(LOCK_POLL_INTERVAL)
+    cursor.close()
+
+
+def _unlock(conn, is_sqlite):
+    if is_sqlite:
+        return
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY,))
+    cursor.close()
+
+
+def _record(ctx, migration):
+    ctx.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (%s, %s, %s)",
+                (migration.version, migration.name, time.time()))
+
+
+def migrate(target=None):
+    """Apply pending migrations up to `target` (default: all).
+    Returns the list of applied migration names."""
+    migrations = discover()
+    target = latest_version() if target is None else target
+
+    conn = db.get_db_connection()
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    if is_sqlite:
+        conn.isolation_level = None
+        conn.execute(f"PRAGMA busy_timeout = {db.SQLITE_BUSY_TIMEOUT_MS}")
+    else:
+        conn.autocommit = True
+
+    applied = []
+    _lock(conn, is_sqlite)
+    try:
+        ctx = Context(conn)
+        _ensure_version_table(ctx.cursor)
+        # Re-read under the lock: another worker may have just finished
+        current = _read_version(ctx.cursor)
+        pending = [m for m in migrations if current < m.version <= target]
+        if not pending:
+            if is_sqlite:
+                ctx.execute("COMMIT")
+            return applied
+
+        print(f"[*] Migrating database schema v{current} -> v{pending[-1].version}...")
+        for migration in pending:
+            print(f"[*] Applying {migration.name}")
+            if is_sqlite:
+                # The whole run is one transaction (SQLite has no CONCURRENTLY)
+                migration.module.up(ctx)
+                _record(ctx, migration)
+            elif migration.transactional:
+                conn.autocommit = False
+                try:
+                    migration.module.up(ctx)
+                    _record(ctx, migration)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.autocommit = True
+            else:
+                migration.module.up(ctx)
+                _record(ctx, migration)
+            applied.append(migration.name)
+
+        if is_sqlite:
+            ctx.execute("COMMIT")
+        print(f"[OK] Database schema at v{pending[-1].version}")
+        return applied
+    except Exception:
+        if is_sqlite and conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        _unlock(conn, is_sqlite)
+        conn.close()
+
+
+def status():
+    current = current_version()
+    return {
+        'current': current,
+        'latest': latest_version(),
+        'pending': [m.name for m in discover() if m.version > current],
+    }
+
+
+def startup_check():
+    """Called once at web startup. Costs a single query when the schema is
+    current; otherwise migrates (or only reports, with MIGRATE_ON_STARTUP=0)."""
+    current = current_version()
+    latest = latest_version()
+    if current >= latest:
+        print(f"[OK] Database schema v{current}")
+        return True
+    if not MIGRATE_ON_STARTUP:
+        print(f"[!] Database schema v{current} is behind v{latest}: run `python -m migrations`")
+        return False
+    migrate()
+    return True
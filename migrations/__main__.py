@@ -0,0 +1,28 @@
+"""
+    python -m migrations [up [VERSION] | status]
+"""
+import sys
+
+import migrations
+
+
+def main(argv):
+    command = argv[0] if argv else 'up'
+    if command == 'status':
+        info = migrations.status()
+        print(f"Schema version: {info['current']} (latest {info['latest']})")
+        for name in info['pending']:
+            print(f"  pending: {name}")
+        return 0
+    if command == 'up':
+        target = int(argv[1]) if len(argv) > 1 else None
+        applied = migrations.migrate(target)
+        if not applied:
+            print(f"[OK] Database schema already at v{migrations.current_version()}")
+        return 0
+    print(__doc__.strip())
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
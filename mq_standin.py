@@ -0,0 +1,131 @@
+"""
+Local stand-in for the Redis server behind SOCKETIO_MESSAGE_QUEUE.
+
+It speaks just enough of the Redis protocol for Socket.IO's RedisManager and
+cluster.OnlineUsers: PUBLISH, SUBSCRIBE/UNSUBSCRIBE, PING, and the
+connection setup commands redis-py sends. Nothing is stored. It is meant for
+development and check_cluster.py; use a real Redis, or a compatible server,
+in production.
+
+    python mq_standin.py [port]          # default 6379, localhost only
+    SOCKETIO_MESSAGE_QUEUE=redis://localhost:6379/0 PORT=8081 python web.py
+"""
+import socketserver
+import sys
+import threading
+
+_subscribers = {}  # channel -> {Client}
+_lock = threading.Lock()
+
+
+def _bulk(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, str):
+        value = value.encode()
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def _array(*items):
+    parts = [b'*%d\r\n' % len(items)]
+    for item in items:
+        parts.append(b':%d\r\n' % item if isinstance(item, int) else _bulk(item))
+    return b''.join(parts)
+
+
+def publish(channel, payload):
+    with _lock:
+        clients = list(_subscribers.get(channel, ()))
+    message = _array(b'message', channel, payload)
+    for client in clients:
+        client.send(message)
+    return len(clients)
+
+
+class Client(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.channels = set()
+        self.write_lock = threading.Lock()
+
+    def send(self, data):
+        try:
+            with self.write_lock:
+                self.wfile.write(data)
+                self.wfile.flush()
+        except OSError:
+            pass
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()  # inline command, e.g. from telnet
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def handle(self):
+        try:
+            while True:
+                args = self.read_command()
+                if args is None:
+                    break
+                if args and not self.execute(args[0].upper(), args[1:]):
+                    break
+        except (OSError, ValueError):
+            pass
+        finally:
+            with _lock:
+                for channel in self.channels:
+                    _subscribers.get(channel, set()).discard(self)
+
+    def execute(self, command, args):
+        """Run one command; False closes the connection."""
+        if command == b'PUBLISH' and len(args) == 2:
+            self.send(b':%d\r\n' % publish(args[0], args[1]))
+        elif command == b'SUBSCRIBE' and args:
+            for channel in args:
+                with _lock:
+                    _subscribers.setdefault(channel, set()).add(self)
+                self.channels.add(channel)
+                self.send(_array(b'subscribe', channel, len(self.channels)))
+        elif command == b'UNSUBSCRIBE':
+            for channel in args or list(self.channels) or [None]:
+                with _lock:
+                    _subscribers.get(channel, set()).discard(self)
+                self.channels.discard(channel)
+                self.send(_array(b'unsubscribe', channel, len(self.channels)))
+        elif command == b'PING':
+            if self.channels:
+                self.send(_array(b'pong', args[0] if args else b''))
+            else:
+                self.send(_bulk(args[0]) if args else b'+PONG\r\n')
+        elif command == b'ECHO' and len(args) == 1:
+            self.send(_bulk(args[0]))
+        elif command in (b'CLIENT', b'SELECT', b'AUTH'):
+            self.send(b'+OK\r\n')
+        elif command == b'QUIT':
+            self.send(b'+OK\r\n')
+            return False
+        else:
+            self.send(b"-ERR unknown command '%s'\r\n" % command)
+        return True
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(port=6379, host='127.0.0.1'):
+    with Server((host, port), Client) as server:
+        print(f"[*] Message queue stand-in on redis://{host}:{port}/0")
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 6379)
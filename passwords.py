@@ -0,0 +1,62 @@
+"""
+Password hashing off the eventlet hub.
+
+werkzeug's KDFs (scrypt, pbkdf2) are deliberately slow; run on the hub they
+stall every green thread, Socket.IO included, for the whole hash. Here they
+run in eventlet's OS thread pool (tpool, sized by EVENTLET_THREADPOOL_SIZE).
+hashlib releases the GIL while it works, so hashes really run in parallel
+with the hub.
+
+The work factor is set by PASSWORD_HASH_METHOD in werkzeug's format, e.g.
+"scrypt:32768:8:1" or "pbkdf2:sha256:600000". Stored hashes made with
+other parameters still verify and are upgraded on the next successful login
+(needs_rehash()).
+
+    python bench_login.py   # hub latency under concurrent logins
+"""
+import os
+
+from eventlet import tpool
+from werkzeug.security import check_password_hash, generate_password_hash
+
+HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+# PASSWORD_HASH_OFFLOAD=0 hashes inline (scripts without a hub)
+OFFLOAD = os.environ.get('PASSWORD_HASH_OFFLOAD', '1') == '1'
+
+_method_prefix = None
+
+
+def _run(func, *args):
+    if OFFLOAD:
+        return tpool.execute(func, *args)
+    return func(*args)
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, HASH_METHOD, SALT_LENGTH)
+
+
+def verify_password(stored_hash, password):
+    """False for anything that isn't a werkzeug hash (OAuth/system users)."""
+    if not stored_hash or not password:
+        return False
+    return _run(check_password_hash, stored_hash, password)
+
+
+def _current_prefix():
+    # werkzeug fills in defaults ("pbkdf2" -> "pbkdf2:sha256:600000"), so the
+    # stored prefix is learned from one throwaway hash instead of parsed
+    global _method_prefix
+    if _method_prefix is None:
+        _method_prefix = _run(generate_password_hash, '', HASH_METHOD, 1).split('$', 1)[0]
+    return _method_prefix
+
+
+def needs_rehash(stored_hash):
+    """True when a hash was made with another method, work factor or salt length."""
+    parts = stored_hash.split('$')
+    if len(parts) != 3:
+        return False
+    method, salt, _ = parts
+    return method != _current_prefix() or len(salt) != SALT_LENGTH
@@ -0,0 +1,93 @@
+"""
+Presence subscriptions: who gets told when a user goes online or offline.
+
+A user's status matters to their accepted friends and to everyone they
+share a DM with, so status changes are emitted to those users' rooms only
+instead of to every socket. The index is symmetric (user id -> set of user
+ids) and lives in memory: load() builds it from friends and direct_messages
+at startup, link() adds a pair as soon as a friendship is accepted or a DM
+is opened, and the periodic reload (PRESENCE_RELOAD_INTERVAL seconds) picks
+up pairs created through other workers and drops pairs nothing connects
+any more.
+
+    for uid, updates in presence.route(status_queue.drain(), online_users).items():
+        socketio.emit('batched_user_status', {'updates': updates}, room=uid)
+"""
+import os
+import threading
+
+import db
+import queries
+
+# Also bounds how long a pair removed in the database keeps receiving updates
+PRESENCE_RELOAD_INTERVAL = float(os.environ.get('PRESENCE_RELOAD_INTERVAL', 300))
+
+_watchers = {}  # user id -> {user id}, both str
+_lock = threading.Lock()
+# link() journal: (generation, user id, user id), see load()
+_generation = 0
+_linked = []
+
+
+def _add(index, a, b):
+    if a != b:
+        index.setdefault(a, set()).add(b)
+        index.setdefault(b, set()).add(a)
+
+
+def link(user1_id, user2_id):
+    """Subscribe two users to each other's status (idempotent)."""
+    global _generation
+    a, b = str(user1_id), str(user2_id)
+    with _lock:
+        _generation += 1
+        _linked.append((_generation, a, b))
+        _add(_watchers, a, b)
+
+
+def watchers(user_id):
+    with _lock:
+        return frozenset(_watchers.get(str(user_id), ()))
+
+
+def load():
+    """Rebuild the index from friends and direct_messages. Reads the primary,
+    and pairs link()'d while the query ran are replayed on top of it."""
+    global _watchers, _linked
+    with _lock:
+        started = _generation
+    rows = db.execute_query(queries.PRESENCE_PAIRS, fetch_all=True)
+    index = {}
+    for user1_id, user2_id in rows or ():
+        _add(index, str(user1_id), str(user2_id))
+    with _lock:
+        # Older entries are in the tables by now; later loads won't need them
+        _linked = [entry for entry in _linked if entry[0] > started]
+        for _, a, b in _linked:
+            _add(index, a, b)
+        _watchers = index
+    return len(index)
+
+
+def route(updates, online):
+    """Group status updates by the online users that should receive them:
+    {user id: [updates]}. Each user also gets their own updates, so other
+    tabs of the same account stay in sync."""
+    by_recipient = {}
+    with _lock:
+        for update in updates:
+            uid = str(update['user_id'])
+            for rid in _watchers.get(uid, ()):
+                if rid in online:
+                    by_recipient.setdefault(rid, []).append(update)
+            if uid in online:
+                by_recipient.setdefault(uid, []).append(update)
+    return by_recipient
+
+
+def stats():
+    with _lock:
+        return {
+            'users': len(_watchers),
+            'pairs': sum(len(w) for w in _watchers.values()) // 2,
+        }
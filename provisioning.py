@@ -0,0 +1,280 @@
+"""
+Bulk user import from CSV or JSON Lines.
+
+    python provisioning.py users.csv [--dry-run] [--role user] [--workers N] [--format csv|jsonl]
+    POST /api/admin/users/import?format=csv|jsonl[&dry_run=1]   (body: the file)
+
+Columns (CSV header) or keys (JSONL): username, email, password or
+password_hash, role, display_name. A row without a username gets one derived
+from its email. password_hash is stored as given (a werkzeug hash exported
+from another install); plain passwords are hashed with PASSWORD_HASH_METHOD.
+
+The import works in passes instead of once per row:
+    1. parse and validate every row, reject duplicates within the file
+    2. one lookup for usernames and emails that are already taken
+    3. hash passwords in parallel
+    4. insert with db.execute_many() in chunks of PROVISION_CHUNK rows
+
+The CLI hashes in a process pool (PROVISION_WORKERS, default: CPU count).
+The web process can't fork a pool from under eventlet, so there passwords go
+through passwords.hash_password (tpool threads; hashlib releases the GIL, so
+they still run on every core).
+
+The report has per-row errors (by line number) and the time and rows/s of
+each pass.
+"""
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import eventlet
+from werkzeug.security import generate_password_hash
+
+import db
+import passwords
+import repositories
+
+PROVISION_CHUNK = int(os.environ.get('PROVISION_CHUNK', 500))
+PROVISION_WORKERS = int(os.environ.get('PROVISION_WORKERS', os.cpu_count() or 1))
+MAX_ROWS = 100000
+# Founders' 'developer' role is never handed out by an import
+ROLES = ('user', 'tester', 'admin')
+MIN_PASSWORD_LENGTH = 6
+
+INSERT_USER = """
+    INSERT INTO users (username, password_hash, email, role, display_name, avatar, created_at, is_verified)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, 1)"""
+
+
+def parse(text, fmt):
+    """[(line number, dict)] from CSV (with a header) or JSON Lines."""
+    if fmt == 'csv':
+        reader = csv.DictReader(io.StringIO(text))
+        return [(reader.line_num, row) for row in reader]
+    if fmt == 'jsonl':
+        rows = []
+        for line_no, line in enumerate(text.splitlines(), 1):
+            if line.strip():
+                try:
+                    rows.append((line_no, json.loads(line)))
+                except ValueError:
+                    rows.append((line_no, None))
+        return rows
+    raise ValueError(f"Unknown format: {fmt}")
+
+
+def _clean(row, default_role):
+    """Normalized row dict, or an error string."""
+    if not isinstance(row, dict):
+        return "not a JSON object"
+    username = str(row.get('username') or '').strip()
+    email = str(row.get('email') or '').strip().lower() or None
+    password = row.get('password') or ''
+    password_hash = row.get('password_hash') or ''
+    role = str(row.get('role') or default_role).strip()
+
+    if not username and not email:
+        return "username or email required"
+    if password_hash:
+        if password_hash.count('$') != 2:
+            return "password_hash is not a werkzeug hash"
+    elif len(str(password)) < MIN_PASSWORD_LENGTH:
+        return f"password must be at least {MIN_PASSWORD_LENGTH} characters"
+    if role not in ROLES:
+        return f"invalid role: {role}"
+    return {'username': username, 'email': email, 'password': str(password), 'password_hash': password_hash,
+            'role': role, 'display_name': str(row.get('display_name') or '').strip() or None}
+
+
+def validate(parsed, default_role='user'):
+    """(rows, errors) with duplicates inside the file rejected."""
+    rows, errors = [], []
+    usernames, emails = set(), set()
+    for line_no, raw in parsed:
+        row = _clean(raw, default_role)
+        if isinstance(row, str):
+            errors.append({'line': line_no, 'error': row})
+            continue
+        if row['username'] and row['username'] in usernames:
+            errors.append({'line': line_no, 'error': f"duplicate username in file: {row['username']}"})
+            continue
+        if row['email'] and row['email'] in emails:
+            errors.append({'line': line_no, 'error': f"duplicate email in file: {row['email']}"})
+            continue
+        usernames.add(row['username'])
+        emails.add(row['email'])
+        row['line'] = line_no
+        rows.append(row)
+    return rows, errors
+
+
+def reject_taken(rows, errors):
+    """Drop rows whose username or email exists, then fill in generated
+    usernames. One lookup per column (per 500 values)."""
+    taken_names = repositories.users.existing('username', [r['username'] for r in rows if r['username']])
+    taken_emails = repositories.users.existing('email', [r['email'] for r in rows if r['email']])
+    kept = []
+    for row in rows:
+        if row['username'] in taken_names:
+            errors.append({'line': row['line'], 'error': f"username taken: {row['username']}"})
+        elif row['email'] in taken_emails:
+            errors.append({'line': row['line'], 'error': f"email taken: {row['email']}"})
+        else:
+            kept.append(row)
+
+    unnamed = [r for r in kept if not r['username']]
+    if unnamed:
+        bases = [repositories.username_base(r['email']) for r in unnamed]
+        # Names given in the file count as taken too
+        given = {r['username'] for r in kept if r['username']}
+        for row, name in zip(unnamed, repositories.users.unique_usernames(bases, reserved=given)):
+            row['username'] = name
+    return kept
+
+
+def _hash(password):
+    return generate_password_hash(password, passwords.HASH_METHOD, passwords.SALT_LENGTH)
+
+
+def hash_in_processes(plain, workers=PROVISION_WORKERS):
+    if workers <= 1 or len(plain) < 2:
+        return [_hash(p) for p in plain]
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(_hash, plain, chunksize=max(1, len(plain) // (workers * 4))))
+
+
+def hash_in_threads(plain):
+    """For the web process: passwords.hash_password in parallel green threads."""
+    pool = eventlet.GreenPool(PROVISION_WORKERS)
+    return list(pool.imap(passwords.hash_password, plain))
+
+
+def insert(rows, avatar, errors, chunk_size=PROVISION_CHUNK):
+    """Insert in chunks; a chunk that fails (e.g. a name registered since
+    the lookup) is retried row by row so only the bad rows are lost."""
+    now = time.time()
+    inserted = 0
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        params = [(r['username'], r['password_hash'], r['email'], r['role'], r['display_name'], avatar, now)
+                  for r in chunk]
+        try:
+            inserted += db.execute_many(INSERT_USER, params)
+            continue
+        except Exception:
+            pass
+        for row, p in zip(chunk, params):
+            try:
+                db.execute_query(INSERT_USER, p, commit=True)
+                inserted += 1
+            except Exception as e:
+                errors.append({'line': row['line'], 'error': f"insert failed: {e}"})
+    return inserted
+
+
+def import_users(text, fmt='csv', default_role='user', dry_run=False, avatar=repositories.DEFAULT_AVATAR,
+                 hasher=hash_in_processes):
+    """Run an import; returns the report dict."""
+    timings = {}
+    started = time.perf_counter()
+
+    parsed = parse(text, fmt)
+    if len(parsed) > MAX_ROWS:
+        raise ValueError(f"At most {MAX_ROWS} rows per import")
+    rows, errors = validate(parsed, default_role)
+    timings['validate'] = time.perf_counter() - started
+
+    mark = time.perf_counter()
+    rows = reject_taken(rows, errors)
+    timings['lookup'] = time.perf_counter() - mark
+
+    mark = time.perf_counter()
+    to_hash = [r for r in rows if not r['password_hash']]
+    if not dry_run and to_hash:
+        for row, hashed in zip(to_hash, hasher([r['password'] for r in to_hash])):
+            row['password_hash'] = hashed
+    timings['hash'] = time.perf_counter() - mark
+
+    mark = time.perf_counter()
+    inserted = 0 if dry_run else insert(rows, avatar, errors)
+    timings['insert'] = time.perf_counter() - mark
+
+    total = time.perf_counter() - started
+    errors.sort(key=lambda e: e['line'])
+    return {
+        'rows': len(parsed),
+        'valid': len(rows),
+        'inserted': inserted,
+        'dry_run': dry_run,
+        'errors': errors,
+        'seconds': {k: round(v, 3) for k, v in timings.items()},
+        'rows_per_second': {
+            'total': round(len(parsed) / total, 1) if total else None,
+            'hash': round(len(to_hash) / timings['hash'], 1) if to_hash and not dry_run else None,
+            'insert': round(inserted / timings['insert'], 1) if timings['insert'] and inserted else None,
+        },
+    }
+
+
+OPTIONS = ('format', 'role', 'workers')  # take a value: --role=admin or --role admin
+FLAGS = ('dry-run',)
+
+
+def parse_args(argv):
+    """(paths, {option: value}); raises ValueError on anything unknown."""
+    paths, options = [], {}
+    args = iter(argv)
+    for arg in args:
+        if not arg.startswith('--'):
+            paths.append(arg)
+            continue
+        name, eq, value = arg[2:].partition('=')
+        if name in FLAGS and not eq:
+            options[name] = True
+        elif name in OPTIONS:
+            if not eq:
+                value = next(args, None)
+                if value is None or value.startswith('--'):
+                    raise ValueError(f"--{name} needs a value")
+            options[name] = value
+        else:
+            raise ValueError(f"Unknown option: {arg}")
+    return paths, options
+
+
+def main(argv):
+    try:
+        paths, options = parse_args(argv)
+        if len(paths) > 1:
+            raise ValueError(f"One file per import, got {len(paths)}")
+        if options.get('role', 'user') not in ROLES:
+            raise ValueError(f"--role must be one of {', '.join(ROLES)}")
+        workers = int(options.get('workers', PROVISION_WORKERS))
+    except ValueError as e:
+        print(f"[!] {e}")
+        return 2
+    if not paths:
+        print(__doc__.strip())
+        return 2
+    path = paths[0]
+    fmt = options.get('format', 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+    with open(path, encoding='utf-8-sig') as f:
+        text = f.read()
+
+    report = import_users(text, fmt, default_role=options.get('role', 'user'), dry_run=options.get('dry-run', False),
+                          hasher=lambda plain: hash_in_processes(plain, workers))
+    for error in report['errors']:
+        print(f"  [!] line {error['line']}: {error['error']}")
+    print(f"[OK] {report['inserted']}/{report['rows']} users imported"
+          f"{' (dry run)' if report['dry_run'] else ''} in {sum(report['seconds'].values()):.2f}s")
+    print(f"  seconds: {report['seconds']}")
+    print(f"  rows/s:  {report['rows_per_second']}")
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
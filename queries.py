@@ -0,0 +1,273 @@
+"""
+Hot SQL statements used by web.py.
+
+Registering a query lets db.py translate it once per dialect and run it as a
+server-side prepared statement on Postgres. Keep the text exactly as it is
+passed to execute_query() - the registry is keyed by the query string.
+"""
+from db import register_statement
+
+# check_auth role sync (role cache misses, see cache.py)
+USER_ROLE = register_statement(
+    'user_role',
+    "SELECT role FROM users WHERE id = %s")
+
+# Flushed in batches by cache.last_seen; must not pin a session to the primary
+TOUCH_LAST_SEEN = register_statement(
+    'touch_last_seen',
+    "UPDATE users SET last_seen = %s WHERE id = %s", sticky=False)
+
+# DM access checks (every message fetch/send/pin)
+DM_PARTICIPANTS = register_statement(
+    'dm_participants',
+    'SELECT user_id_1, user_id_2 FROM direct_messages WHERE id = %s')
+
+# DM message page, newest first. Not server-prepared: with LIMIT/id bounds as
+# parameters the generic plan walks the primary key instead of the dm_id index.
+DM_MESSAGES_PAGE = register_statement(
+    'dm_messages_page', """
+        SELECT dm.id, dm.content, dm.timestamp, u.username, u.avatar,
+               dm.is_pinned, dm.edited_at, dm.reply_to_id, u.id as author_id, dm.attachments,
+               dm.is_encrypted, dm.encryption_metadata, dm.cloud_folder_id, dm.tags
+        FROM dm_messages dm
+        JOIN users u ON u.id = dm.author_id
+        WHERE dm.dm_id = %s
+        ORDER BY dm.id DESC LIMIT %s
+    """, prepare=False)
+
+DM_MESSAGES_PAGE_BEFORE = register_statement(
+    'dm_messages_page_before', """
+        SELECT dm.id, dm.content, dm.timestamp, u.username, u.avatar,
+               dm.is_pinned, dm.edited_at, dm.reply_to_id, u.id as author_id, dm.attachments,
+               dm.is_encrypted, dm.encryption_metadata, dm.cloud_folder_id, dm.tags
+        FROM dm_messages dm
+        JOIN users u ON u.id = dm.author_id
+        WHERE dm.dm_id = %s AND dm.id < %s
+        ORDER BY dm.id DESC LIMIT %s
+    """, prepare=False)
+
+# Reaction counts for one message (after every react toggle)
+MESSAGE_REACTION_COUNTS = register_statement(
+    'message_reaction_counts', '''
+        SELECT emoji, COUNT(*) as count
+        FROM message_reactions
+        WHERE message_id = %s
+        GROUP BY emoji
+    ''')
+
+# Author card attached to every outgoing DM
+USER_NAME_AVATAR = register_statement(
+    'user_name_avatar',
+    'SELECT username, avatar FROM users WHERE id = %s')
+
+# Disappearing-message sweep (every 10s)
+EXPIRED_MESSAGES = register_statement(
+    'expired_messages', '''
+                SELECT id, dm_id FROM dm_messages 
+                WHERE expires_at IS NOT NULL AND expires_at <= %s
+            ''')
+
+# Storage quota check on upload / profile
+USER_STORAGE_USAGE = register_statement(
+    'user_storage_usage', """
+        SELECT SUM(file_size) FROM file_uploads 
+        WHERE message_id IN (SELECT id FROM dm_messages WHERE author_id = %s)
+    """)
+
+# DM lookup by ordered participant pair
+DM_BY_PARTICIPANTS = register_statement(
+    'dm_by_participants',
+    'SELECT id FROM direct_messages WHERE user_id_1 = %s AND user_id_2 = %s')
+
+# DM sidebar list with last message and unread count. The last message is
+# looked up per DM on (dm_id, id) rather than aggregating the whole table.
+DM_LIST = register_statement(
+    'dm_list', """
+        SELECT 
+            dm.id, dm.user_id_1, dm.user_id_2, dm.last_message_at,
+            u.id as other_id, u.username, u.avatar, u.display_name,
+            m.content as last_content, m.timestamp as last_timestamp,
+            (SELECT COUNT(*) FROM dm_messages 
+             WHERE dm_id = dm.id AND author_id != %s
+             AND id > COALESCE((SELECT last_read_message_id FROM read_receipts WHERE dm_id = dm.id AND user_id = %s), 0)
+            ) as unread_count
+        FROM direct_messages dm
+        JOIN users u ON u.id = (CASE WHEN dm.user_id_1 = %s AND dm.user_id_2 != %s THEN dm.user_id_2 ELSE dm.user_id_1 END)
+        LEFT JOIN dm_messages m
+            ON m.id = (SELECT MAX(id) FROM dm_messages WHERE dm_id = dm.id)
+        WHERE dm.user_id_1 = %s OR dm.user_id_2 = %s
+        ORDER BY dm.last_message_at DESC
+    """)
+
+READ_RECEIPT_LAST = register_statement(
+    'read_receipt_last',
+    "SELECT last_read_message_id FROM read_receipts WHERE dm_id = %s AND user_id = %s")
+
+# Friends sidebar (three lists per load)
+FRIENDS_INCOMING = register_statement(
+    'friends_incoming', """
+        SELECT u.id, u.username, u.avatar, u.display_name 
+        FROM friends f 
+        JOIN users u ON u.id = f.user_id_1 
+        WHERE f.user_id_2 = %s AND f.status = 'pending'
+    """)
+
+FRIENDS_OUTGOING = register_statement(
+    'friends_outgoing', """
+        SELECT u.id, u.username, u.avatar, u.display_name 
+        FROM friends f 
+        JOIN users u ON u.id = f.user_id_2 
+        WHERE f.user_id_1 = %s AND f.status = 'pending'
+    """)
+
+FRIENDS_ACCEPTED = register_statement(
+    'friends_accepted', """
+        SELECT u.id, u.username, u.avatar, u.display_name
+        FROM friends f
+        JOIN users u ON (u.id = f.user_id_1 OR u.id = f.user_id_2)
+        WHERE (f.user_id_1 = %s OR f.user_id_2 = %s) 
+        AND f.status = 'accepted'
+        AND u.id != %s
+    """)
+
+# Socket presence, written in batches by cache.statuses
+SET_USER_STATUS = register_statement(
+    'set_user_status',
+    "UPDATE users SET status = %s WHERE id = %s", sticky=False)
+
+ONLINE_USER_IDS = register_statement(
+    'online_user_ids',
+    "SELECT id FROM users WHERE status = 'online'", prepare=False)
+
+# Presence subscriptions (presence.load): accepted friends and DM partners.
+# The system bot (id 0, always user_id_1) has a DM with everyone but is never online
+PRESENCE_PAIRS = register_statement(
+    'presence_pairs', """
+        SELECT user_id_1, user_id_2 FROM friends WHERE status = 'accepted'
+        UNION
+        SELECT user_id_1, user_id_2 FROM direct_messages WHERE user_id_1 != 0
+    """, prepare=False)
+
+# Admin dashboard counters and user list
+NEW_USERS_SINCE = register_statement(
+    'new_users_since',
+    "SELECT COUNT(*) FROM users WHERE created_at >= %s")
+
+PENDING_REPORTS_COUNT = register_statement(
+    'pending_reports_count',
+    "SELECT COUNT(*) FROM reports WHERE status = 'pending'")
+
+RECENT_USERS = register_statement(
+    'recent_users',
+    "SELECT id, username, avatar, role, created_at, ip_address, risk_score, is_banned, is_muted FROM users ORDER BY created_at DESC LIMIT 20")
+
+REPORTS_AGAINST_USER = register_statement(
+    'reports_against_user', """
+            SELECT r.id, r.reason, r.timestamp, u.username as reporter 
+            FROM reports r JOIN users u ON r.reporter_id = u.id 
+            JOIN dm_messages m ON r.message_id = m.id
+            WHERE m.author_id = %s
+        """)
+
+# Admin user inspector
+USER_ADMIN_PROFILE = register_statement(
+    'user_admin_profile',
+    "SELECT id, username, email, phone, role, created_at, ip_address, risk_score, is_banned, ban_expires, is_muted, mute_expires, ban_reason FROM users WHERE id = %s")
+
+RISK_ALERTS_FOR_USER = register_statement(
+    'risk_alerts_for_user',
+    "SELECT id, type, details, risk_level, timestamp FROM risk_alerts WHERE user_id = %s ORDER BY timestamp DESC")
+
+# Server-side sessions (sessions.py): one lookup per request on a cache miss.
+# Session writes never pin the user to the primary.
+SESSION_LOAD = register_statement(
+    'session_load',
+    "SELECT data, expires_at FROM sessions WHERE sid = %s AND expires_at > %s",
+    sample=('x', 0))
+
+SESSION_SAVE = register_statement(
+    'session_save', """
+        INSERT INTO sessions (sid, data, expires_at) VALUES (%s, %s, %s)
+        ON CONFLICT (sid) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at
+    """, sample=('x', '{}', 0), sticky=False)
+
+SESSION_DELETE = register_statement(
+    'session_delete',
+    "DELETE FROM sessions WHERE sid = %s", sample=('x',), sticky=False)
+
+SESSION_PURGE = register_statement(
+    'session_purge',
+    "DELETE FROM sessions WHERE expires_at < %s", prepare=False, sticky=False)
+
+# Shared rate limiter counters (ratelimit.py, RATE_LIMIT_STORE=db)
+RATE_LIMIT_HIT = register_statement(
+    'rate_limit_hit', """
+        INSERT INTO rate_limits (key, window_index, count, expires_at) VALUES (%s, %s, 1, %s)
+        ON CONFLICT (key, window_index) DO UPDATE SET count = rate_limits.count + 1
+    """, sample=('x', 1, 0), sticky=False)
+
+RATE_LIMIT_COUNTS = register_statement(
+    'rate_limit_counts',
+    "SELECT window_index, count FROM rate_limits WHERE key = %s AND window_index >= %s",
+    sample=('x', 1))
+
+RATE_LIMIT_PURGE = register_statement(
+    'rate_limit_purge',
+    "DELETE FROM rate_limits WHERE expires_at < %s", prepare=False, sticky=False)
+
+# Outbound mail queue (mailer.py). Run by the worker, outside any request.
+MAIL_ENQUEUE = """
+    INSERT INTO mail_queue (to_addr, subject, html, status, attempts, next_attempt_at, created_at, expires_at)
+    VALUES (%s, %s, %s, 'pending', 0, %s, %s, %s)"""
+
+# The outer status check is re-evaluated under the row lock on Postgres,
+# so two workers never both claim a message
+MAIL_CLAIM = register_statement(
+    'mail_claim', """
+        UPDATE mail_queue SET status = 'sending', claim = %s, next_attempt_at = %s
+        WHERE status IN ('pending', 'sending') AND next_attempt_at <= %s AND id IN (
+            SELECT id FROM mail_queue
+            WHERE status IN ('pending', 'sending') AND next_attempt_at <= %s
+            ORDER BY id LIMIT %s)
+    """, sample=('x', 0, 0, 0, 1), sticky=False)
+
+MAIL_CLAIMED = register_statement(
+    'mail_claimed',
+    "SELECT id, to_addr, subject, html, attempts, expires_at FROM mail_queue WHERE claim = %s AND status = 'sending' ORDER BY id",
+    sample=('x',))
+
+MAIL_SENT = register_statement(
+    'mail_sent',
+    "UPDATE mail_queue SET status = 'sent', attempts = %s, sent_at = %s, claim = NULL, last_error = NULL WHERE id = %s",
+    sample=(1, 0, 1), sticky=False)
+
+MAIL_RETRY = register_statement(
+    'mail_retry',
+    "UPDATE mail_queue SET status = 'pending', attempts = %s, next_attempt_at = %s, claim = NULL, last_error = %s WHERE id = %s",
+    sample=(1, 0, 'x', 1), sticky=False)
+
+MAIL_FAILED = register_statement(
+    'mail_failed',
+    "UPDATE mail_queue SET status = 'failed', attempts = %s, claim = NULL, last_error = %s WHERE id = %s",
+    sample=(1, 'x', 1), sticky=False)
+
+MAIL_PURGE = register_statement(
+    'mail_purge',
+    "DELETE FROM mail_queue WHERE status = 'sent' AND sent_at < %s", prepare=False, sticky=False)
+
+# Ban/mute index (sanctions.py). Each statement repeats the predicate of the
+# partial index idx_users_sanctioned so the planner can use it
+SANCTIONS_ACTIVE = register_statement(
+    'sanctions_active',
+    "SELECT id, is_banned, ban_expires, is_muted, mute_expires FROM users WHERE is_banned = 1 OR is_muted = 1",
+    sample=())
+
+SANCTIONS_EXPIRE_BANS = register_statement(
+    'sanctions_expire_bans',
+    "UPDATE users SET is_banned = 0, ban_expires = NULL WHERE (is_banned = 1 OR is_muted = 1) AND is_banned = 1 AND ban_expires <= %s",
+    prepare=False, sticky=False)
+
+SANCTIONS_EXPIRE_MUTES = register_statement(
+    'sanctions_expire_mutes',
+    "UPDATE users SET is_muted = 0, mute_expires = NULL WHERE (is_banned = 1 OR is_muted = 1) AND is_muted = 1 AND mute_expires <= %s",
+    prepare=False, sticky=False)
@@ -0,0 +1,224 @@
+"""
+Per-endpoint SQL instrumentation.
+
+db.py reports every statement it runs here (db.set_query_observer). Inside a
+Flask request the statements are tallied for that request; when it ends they
+are folded into per-endpoint totals: query count, DB time, a statement
+latency histogram, and statement shapes repeated within one request (the
+N+1 pattern of a query per row in a loop). The slowest statements are kept
+across all endpoints. Statements run outside a request (socket handlers,
+background sweeps, streamed response bodies) are filed under <background>.
+
+Read it through /api/admin/db/queries. With DB_QUERY_HEADERS=1 (or in
+Flask debug mode) every response also carries X-DB-Queries and X-DB-Time.
+"""
+import heapq
+import itertools
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
+
+ENABLED = os.environ.get('DB_QUERY_STATS', '1') == '1'
+HEADERS = os.environ.get('DB_QUERY_HEADERS', '0') == '1'
+# The same statement shape this many times in one request is reported as N+1
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('DB_N_PLUS_ONE_THRESHOLD', 10))
+SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS', 250))
+SLOWEST_KEPT = 25
+# Upper bounds of the statement latency buckets in ms; one more for slower
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+BACKGROUND = '<background>'
+
+_SPACE_RE = re.compile(r'\s+')
+_IN_LIST_RE = re.compile(r'IN ?\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=2048)
+def shape(sql):
+    """Statement text with whitespace collapsed and IN (%s, %s, ...) lists
+    folded, so the same query with different batch sizes counts once."""
+    return _IN_LIST_RE.sub('IN (...)', _SPACE_RE.sub(' ', sql).strip())
+
+
+class RequestStats:
+    __slots__ = ('endpoint', 'count', 'total', 'shapes', 'histogram')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.count = 0
+        self.total = 0.0
+        self.shapes = {}
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+
+
+class _EndpointStats:
+    __slots__ = ('requests', 'queries', 'db_time', 'max_queries', 'histogram', 'repeated')
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.db_time = 0.0
+        self.max_queries = 0
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+        # shape -> [requests where it repeated, most repeats in one request]
+        self.repeated = {}
+
+    def as_dict(self, endpoint):
+        requests = self.requests or 1
+        return {
+            'endpoint': endpoint,
+            'requests': self.requests,
+            'queries': self.queries,
+            'avg_queries': round(self.queries / requests, 2),
+            'max_queries': self.max_queries,
+            'db_time_ms': round(self.db_time * 1000, 1),
+            'avg_db_time_ms': round(self.db_time * 1000 / requests, 2),
+            'histogram': self.histogram[:],
+            'n_plus_one': [
+                {'statement': s, 'requests': n, 'max_repeats': worst}
+                for s, (n, worst) in sorted(self.repeated.items(), key=lambda kv: -kv[1][1])
+            ],
+        }
+
+
+_lock = threading.Lock()
+# Green-thread local once eventlet has monkey patched
+_local = threading.local()
+_endpoints = {}
+_slowest = []  # min-heap of (ms, seq, endpoint, statement, at)
+_seq = itertools.count()
+_since = time.time()
+
+
+def _endpoint_stats(endpoint):
+    stats = _endpoints.get(endpoint)
+    if stats is None:
+        stats = _endpoints[endpoint] = _EndpointStats()
+    return stats
+
+
+def begin(endpoint=None):
+    """Start tallying the statements of one request."""
+    if ENABLED:
+        _local.current = RequestStats(endpoint or '<unknown>')
+
+
+def label(endpoint):
+    """Name the current request's endpoint once routing has matched it."""
+    req = getattr(_local, 'current', None)
+    if req is None:
+        begin(endpoint)
+    else:
+        req.endpoint = endpoint or '<unknown>'
+
+
+def middleware(wsgi_app):
+    """Wrap Flask's own wsgi_app so the tally starts before the session is
+    loaded (Flask opens it ahead of URL matching and before_request), and
+    the session lookup counts for the endpoint instead of <background>."""
+    def app(environ, start_response):
+        begin()
+        return wsgi_app(environ, start_response)
+    return app
+
+
+def current():
+    return getattr(_local, 'current', None)
+
+
+def record(sql, elapsed):
+    """Query observer: one statement took `elapsed` seconds."""
+    ms = elapsed * 1000
+    req = getattr(_local, 'current', None)
+    endpoint = req.endpoint if req is not None else BACKGROUND
+    statement = shape(sql)
+
+    bucket = bisect_left(BUCKETS_MS, ms)
+
+    # A request's statements are filed when it ends: its endpoint is only
+    # known after routing, and the session lookup runs before that
+    if req is not None:
+        req.count += 1
+        req.total += elapsed
+        req.shapes[statement] = req.shapes.get(statement, 0) + 1
+        req.histogram[bucket] += 1
+
+    with _lock:
+        if req is None:
+            stats = _endpoint_stats(endpoint)
+            stats.histogram[bucket] += 1
+            stats.queries += 1
+            stats.db_time += elapsed
+        # Slowest entries keep the request itself and read its endpoint later
+        entry = (ms, next(_seq), req if req is not None else endpoint, statement, time.time())
+        if len(_slowest) < SLOWEST_KEPT:
+            heapq.heappush(_slowest, entry)
+        elif ms > _slowest[0][0]:
+            heapq.heapreplace(_slowest, entry)
+
+    if ms >= SLOW_QUERY_MS:
+        print(f"[!] Slow query ({ms:.0f} ms) in {endpoint}: {statement[:200]}")
+
+
+def end():
+    """Fold the current request into its endpoint totals. Returns its
+    RequestStats, or None when no request was being tallied."""
+    req = getattr(_local, 'current', None)
+    if req is None:
+        return None
+    _local.current = None
+
+    new_offenders = []
+    with _lock:
+        stats = _endpoint_stats(req.endpoint)
+        stats.requests += 1
+        stats.queries += req.count
+        stats.db_time += req.total
+        stats.max_queries = max(stats.max_queries, req.count)
+        for bucket, n in enumerate(req.histogram):
+            stats.histogram[bucket] += n
+        for statement, n in req.shapes.items():
+            if n < N_PLUS_ONE_THRESHOLD:
+                continue
+            seen = stats.repeated.get(statement)
+            if seen is None:
+                stats.repeated[statement] = [1, n]
+                new_offenders.append((statement, n))
+            else:
+                seen[0] += 1
+                seen[1] = max(seen[1], n)
+
+    for statement, n in new_offenders:
+        print(f"[!] N+1 in {req.endpoint}: {n}x {statement[:160]}")
+    return req
+
+
+def snapshot(limit=50):
+    """Worst endpoints by total DB time plus the slowest statements."""
+    with _lock:
+        endpoints = sorted(_endpoints.items(), key=lambda kv: -kv[1].db_time)[:limit]
+        endpoints = [stats.as_dict(name) for name, stats in endpoints]
+        slowest = sorted(_slowest, reverse=True)
+    return {
+        'enabled': ENABLED,
+        'since': _since,
+        'n_plus_one_threshold': N_PLUS_ONE_THRESHOLD,
+        'histogram_buckets_ms': list(BUCKETS_MS) + ['inf'],
+        'endpoints': endpoints,
+        'slowest': [
+            {'ms': round(ms, 2), 'endpoint': owner if isinstance(owner, str) else owner.endpoint,
+             'statement': statement, 'at': at}
+            for ms, _, owner, statement, at in slowest
+        ],
+    }
+
+
+def reset():
+    global _since
+    with _lock:
+        _endpoints.clear()
+        _slowest.clear()
+        _since = time.time()
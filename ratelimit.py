@@ -0,0 +1,203 @@
+"""
+Request rate limiting with a sliding window counter.
+
+Each key (limit name + IP, account or user) keeps two counters: the current
+fixed window and the previous one. The estimated count for the sliding
+window is  current + previous * (share of the previous window still inside
+it), which is O(1) in time and memory per key and close to an exact log.
+
+    @app.route('/api/auth/login', methods=['POST'])
+    @ratelimit.limit('login-ip', '20/minute', key=ratelimit.by_ip)
+    @ratelimit.limit('login-account', '5/minute', key=ratelimit.by_field('username', with_ip=True))
+    def api_login(): ...
+
+A rejected request gets 429 with Retry-After before the view runs, so no
+KDF or DB work is spent on it. Rejected requests still count, so a client
+that keeps hammering stays blocked.
+
+RATE_LIMIT_STORE selects where counters live:
+    memory  per worker; N workers allow up to N times the limit
+    db      the app database (migration 0008), shared by all workers
+The default is memory, or db once SOCKETIO_MESSAGE_QUEUE is set (several
+workers, see SCALING.md).
+RATE_LIMIT_ENABLED=0 turns all limits off.
+"""
+import os
+import threading
+import time
+from functools import lru_cache, wraps
+
+from flask import jsonify, request, session
+
+import db
+import queries
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE') or ('db' if os.environ.get('SOCKETIO_MESSAGE_QUEUE') else 'memory')
+# Memory store: sweep keys idle for two windows once it holds this many
+SWEEP_THRESHOLD = 50000
+DB_PURGE_INTERVAL = 300
+
+_PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate):
+    """'5/minute', '100/hour', '3/10minute' -> (limit, window seconds)"""
+    count, _, period = rate.partition('/')
+    digits = period.rstrip('abcdefghijklmnopqrstuvwxyz')
+    unit = period[len(digits):]
+    if unit not in _PERIODS:
+        raise ValueError(f"Bad rate: {rate}")
+    return int(count), _PERIODS[unit] * (int(digits) if digits else 1)
+
+
+class MemoryStore:
+    def __init__(self):
+        # key -> [window index, count in it, count in the previous window]
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, window, now):
+        index = int(now // window)
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                if len(self._counters) >= SWEEP_THRESHOLD:
+                    self._sweep(now)
+                counter = self._counters[key] = [index, 0, 0]
+            elif counter[0] != index:
+                # Roll forward; anything older than one window counts as 0
+                counter[2] = counter[1] if counter[0] == index - 1 else 0
+                counter[0] = index
+                counter[1] = 0
+            counter[1] += 1
+            return counter[1], counter[2]
+
+    def _sweep(self, now):
+        # A key whose previous window has ended too carries no weight
+        stale = [k for k, (index, _, _) in self._counters.items()
+                 if (index + 2) * _window_of(k) <= now]
+        for key in stale:
+            del self._counters[key]
+
+    def stats(self):
+        return {'store': 'memory', 'keys': len(self._counters)}
+
+
+class DatabaseStore:
+    """Counters in the rate_limits table; one upsert and one read per hit."""
+
+    def __init__(self):
+        self._last_purge = time.time()
+
+    def hit(self, key, window, now):
+        index = int(now // window)
+        db.execute_query(queries.RATE_LIMIT_HIT, (key, index, (index + 2) * window), commit=True)
+        rows = db.execute_query(queries.RATE_LIMIT_COUNTS, (key, index - 1), fetch_all=True)
+        counts = dict(rows or ())
+        if now - self._last_purge > DB_PURGE_INTERVAL:
+            self._last_purge = now
+            db.execute_query(queries.RATE_LIMIT_PURGE, (now,), commit=True)
+        return counts.get(index, 1), counts.get(index - 1, 0)
+
+    def stats(self):
+        return {'store': 'db'}
+
+
+# Window length per key prefix, for the memory sweep
+_windows = {}
+
+
+def _window_of(key):
+    return _windows.get(key.split(':', 1)[0], 86400)
+
+
+def make_store(kind=RATE_LIMIT_STORE):
+    if kind == 'memory':
+        return MemoryStore()
+    if kind == 'db':
+        return DatabaseStore()
+    raise ValueError(f"Unknown RATE_LIMIT_STORE: {kind}")
+
+
+store = make_store()
+rejected = {}
+
+
+# --- Keys ---
+def client_ip():
+    # Resolved by ProxyFix from the trusted proxies' X-Forwarded-For entries
+    # (web.TRUSTED_PROXIES); the raw header is client-controlled
+    return request.remote_addr or '-'
+
+
+def by_ip():
+    return client_ip()
+
+
+def by_user():
+    """Logged-in user id, the IP for anonymous requests."""
+    user = session.get('user')
+    return f"u{user['id']}" if user else client_ip()
+
+
+def by_field(name, with_ip=False):
+    """A field of the JSON body (login name, email), lowercased. Requests
+    without it are keyed by IP. with_ip=True pairs the field with the IP, so
+    that strangers can't exhaust the limit for someone else's account."""
+    def key():
+        data = request.get_json(silent=True) or {}
+        value = data.get(name)
+        if not value:
+            return client_ip()
+        field = f"{name}={str(value).strip().lower()}"
+        return f"{field}@{client_ip()}" if with_ip else field
+    return key
+
+
+# --- Limits ---
+def check(name, rate, key_value, now=None):
+    """Count one hit. Returns seconds to wait, or 0 if the hit is allowed."""
+    limit, window = parse_rate(rate)
+    now = time.time() if now is None else now
+    current, previous = store.hit(f"{name}:{key_value}", window, now)
+    elapsed = (now % window) / window
+    estimated = current + previous * (1 - elapsed)
+    if estimated <= limit:
+        return 0
+    # When enough of the previous window has slid out to get under the limit
+    if previous and current <= limit:
+        wait = ((estimated - limit) / previous) * window
+    else:
+        wait = window - (now % window)
+    return max(1, int(wait + 0.999))
+
+
+def limit(name, rate, key=by_ip, error='Слишком много запросов. Попробуйте позже'):
+    """Decorator: at most `rate` requests per `key()` for this limit name."""
+    _windows[name] = parse_rate(rate)[1]  # also fails at import time on a typo
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if RATE_LIMIT_ENABLED:
+                try:
+                    retry_after = check(name, rate, key())
+                except Exception as e:
+                    # Never fail the request because the limiter's store did
+                    print(f"[!] Rate limiter error ({name}): {e}")
+                    retry_after = 0
+                if retry_after:
+                    rejected[name] = rejected.get(name, 0) + 1
+                    response = jsonify({'success': False, 'error': error, 'retry_after': retry_after})
+                    response.status_code = 429
+                    response.headers['Retry-After'] = str(retry_after)
+                    return response
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stats():
+    return dict(store.stats(), enabled=RATE_LIMIT_ENABLED, rejected=dict(rejected))
@@ -0,0 +1,247 @@
+"""
+Data access for users, DMs, messages, reactions, friends and reports.
+
+Handlers get compact namedtuple rows instead of positional tuples. Each
+repository owns its SQL (hot statements are registered in queries.py),
+including the per-dialect parts such as getting the id of a new row, and
+loads related rows in batches rather than one query per item.
+"""
+import random
+from collections import namedtuple
+
+import db
+import queries
+from db import execute_query
+
+# Default Avatar (SVG Data URI - clean user silhouette), for every new user
+DEFAULT_AVATAR = "data:image/svg+xml,%3Csvg xmlns='http://www.w3.org/2000/svg' width='128' height='128' viewBox='0 0 128 128'%3E%3Crect width='128' height='128' fill='%235865F2'/%3E%3Ccircle cx='64' cy='50' r='22' fill='%23fff'/%3E%3Cellipse cx='64' cy='112' rx='36' ry='28' fill='%23fff'/%3E%3C/svg%3E"
+
+UserCard = namedtuple('UserCard', 'id username avatar display_name')
+UserAdminProfile = namedtuple('UserAdminProfile', 'id username email phone role created_at ip_address '
+                                                  'risk_score is_banned ban_expires is_muted mute_expires ban_reason')
+RiskAlert = namedtuple('RiskAlert', 'id type details risk_level timestamp')
+DMSummary = namedtuple('DMSummary', 'id user_id_1 user_id_2 last_message_at other_id username avatar '
+                                    'display_name last_content last_timestamp unread_count')
+Message = namedtuple('Message', 'id content timestamp username avatar is_pinned edited_at reply_to_id '
+                                'author_id attachments is_encrypted encryption_metadata cloud_folder_id tags')
+ReplyPreview = namedtuple('ReplyPreview', 'id content username')
+UserReport = namedtuple('UserReport', 'id reason timestamp reporter')
+PublicProfile = namedtuple('PublicProfile', 'id username avatar display_name bio custom_status status_emoji public_key')
+
+
+def _placeholders(values):
+    return ','.join(['%s'] * len(values))
+
+
+def username_base(email):
+    """Local part of an email reduced to username characters."""
+    prefix = email.split('@')[0]
+    return "".join(c for c in prefix if c.isalnum() or c in '_-') or "user"
+
+
+class UserRepository:
+    def create(self, username, password_hash, avatar, created_at, role='user', is_verified=1):
+        return db.insert(
+            "INSERT INTO users (username, password_hash, avatar, created_at, role, is_verified) VALUES (%s, %s, %s, %s, %s, %s)",
+            (username, password_hash, avatar, created_at, role, is_verified))
+
+    def existing(self, column, values, chunk_size=500):
+        """The subset of values already present in users.<column>
+        ('username' or 'email'), one query per chunk_size values. Emails
+        compare case-insensitively and come back lowercased."""
+        if column not in ('username', 'email'):
+            raise ValueError(f"Not a unique user column: {column}")
+        target = column
+        if column == 'email':
+            # Older rows keep the case they were registered with
+            values = [v.lower() for v in values]
+            target = 'LOWER(email)'
+        values = list(set(values))
+        found = set()
+        for i in range(0, len(values), chunk_size):
+            chunk = values[i:i + chunk_size]
+            rows = execute_query(f"SELECT {target} FROM users WHERE {target} IN ({_placeholders(chunk)})",
+                                 tuple(chunk), fetch_all=True)
+            found.update(row[0] for row in rows)
+        return found
+
+    def taken_usernames(self, prefixes, chunk_size=50):
+        """Existing usernames starting with any of the prefixes: one query per
+        chunk_size prefixes, each prefix an index range scan."""
+        prefixes = sorted(set(prefixes))
+        taken = set()
+        for i in range(0, len(prefixes), chunk_size):
+            chunk = prefixes[i:i + chunk_size]
+            if db.is_postgres():
+                # Served by idx_users_username_pattern (text_pattern_ops)
+                where = ' OR '.join(['username LIKE %s'] * len(chunk))
+                params = [p.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%' for p in chunk]
+            else:
+                # SQLite's LIKE is case-insensitive and skips the UNIQUE index; a range uses it
+                where = ' OR '.join(['(username >= %s AND username < %s)'] * len(chunk))
+                params = [v for p in chunk for v in (p, p[:-1] + chr(ord(p[-1]) + 1))]
+            rows = execute_query(f"SELECT username FROM users WHERE {where}", tuple(params), fetch_all=True)
+            taken.update(row[0] for row in rows)
+        return taken
+
+    def unique_usernames(self, bases, reserved=()):
+        """A free username for each base, in order: the base itself, else the
+        base plus a random number. Names are also unique within the call and
+        never one of `reserved`."""
+        taken = self.taken_usernames(bases) | set(reserved)
+        names = []
+        for base in bases:
+            name, high, tries = base, 9999, 0
+            while name in taken:
+                tries += 1
+                if tries % 20 == 0:
+                    high = high * 10 + 9
+                name = f"{base}{random.randint(100, high)}"
+            taken.add(name)
+            names.append(name)
+        return names
+
+    def name_avatar(self, user_id):
+        """(username, avatar) for the author card attached to a new message."""
+        return execute_query(queries.USER_NAME_AVATAR, (user_id,), fetch_one=True)
+
+    def public_profiles(self, user_ids, read_only=True):
+        """{id: PublicProfile} for many users in one query."""
+        ids = list(set(user_ids))
+        if not ids:
+            return {}
+        rows = execute_query(
+            f"SELECT id, username, avatar, display_name, bio, custom_status, status_emoji, public_key "
+            f"FROM users WHERE id IN ({_placeholders(ids)})",
+            tuple(ids), fetch_all=True, read_only=read_only)
+        return {row[0]: PublicProfile._make(row) for row in rows}
+
+    def admin_profile(self, user_id):
+        row = execute_query(queries.USER_ADMIN_PROFILE, (user_id,), fetch_one=True, read_only=True)
+        return UserAdminProfile._make(row) if row else None
+
+    def risk_alerts(self, user_id):
+        rows = execute_query(queries.RISK_ALERTS_FOR_USER, (user_id,), fetch_all=True, read_only=True)
+        return list(map(RiskAlert._make, rows))
+
+
+class DMRepository:
+    def participants(self, dm_id, read_only=False):
+        """(user_id_1, user_id_2) or None."""
+        return execute_query(queries.DM_PARTICIPANTS, (dm_id,), fetch_one=True, read_only=read_only)
+
+    def get_or_create(self, user1_id, user2_id, now):
+        # One row per pair: the lower id always goes first
+        if user1_id > user2_id:
+            user1_id, user2_id = user2_id, user1_id
+        row = execute_query(queries.DM_BY_PARTICIPANTS, (user1_id, user2_id), fetch_one=True)
+        if row:
+            return row[0]
+        try:
+            return db.insert('INSERT INTO direct_messages (user_id_1, user_id_2, last_message_at) VALUES (%s, %s, %s)',
+                             (user1_id, user2_id, now))
+        except Exception:
+            # Lost a race on UNIQUE(user_id_1, user_id_2): the other insert won
+            if db.in_transaction():
+                raise
+            row = execute_query(queries.DM_BY_PARTICIPANTS, (user1_id, user2_id), fetch_one=True)
+            if not row:
+                raise
+            return row[0]
+
+    def touch(self, dm_id, timestamp):
+        execute_query('UPDATE direct_messages SET last_message_at = %s WHERE id = %s', (timestamp, dm_id), commit=True)
+
+    def list_for(self, user_id):
+        """Every DM of a user with the other participant, the last message
+        and the unread count, newest first."""
+        rows = execute_query(queries.DM_LIST, (user_id,) * 6, fetch_all=True, read_only=True)
+        return list(map(DMSummary._make, rows or ()))
+
+
+class MessageRepository:
+    def create(self, dm_id, author_id, content, timestamp, reply_to_id=None, attachments=None,
+               expires_at=None, is_encrypted=False, encryption_metadata=None, cloud_folder_id=None):
+        return db.insert('''
+            INSERT INTO dm_messages (dm_id, author_id, content, timestamp, reply_to_id, attachments, expires_at, is_encrypted, encryption_metadata, cloud_folder_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ''', (dm_id, author_id, content, timestamp, reply_to_id, attachments, expires_at,
+              int(bool(is_encrypted)), encryption_metadata, cloud_folder_id))
+
+    def page(self, dm_id, limit, before_id=None):
+        """Up to `limit` messages before `before_id` (or the newest ones),
+        in chronological order."""
+        if before_id:
+            rows = execute_query(queries.DM_MESSAGES_PAGE_BEFORE, (dm_id, before_id, limit),
+                                 fetch_all=True, read_only=True)
+        else:
+            rows = execute_query(queries.DM_MESSAGES_PAGE, (dm_id, limit), fetch_all=True, read_only=True)
+        messages = list(map(Message._make, rows or ()))
+        messages.reverse()
+        return messages
+
+    def reply_previews(self, message_ids):
+        """{id: ReplyPreview} for the messages being replied to."""
+        ids = list(set(message_ids))
+        if not ids:
+            return {}
+        rows = execute_query(f'''
+            SELECT dm.id, dm.content, u.username
+            FROM dm_messages dm
+            JOIN users u ON u.id = dm.author_id
+            WHERE dm.id IN ({_placeholders(ids)})
+        ''', tuple(ids), fetch_all=True, read_only=True)
+        return {row[0]: ReplyPreview._make(row) for row in rows}
+
+
+class ReactionRepository:
+    def counts(self, message_id):
+        """{emoji: count} for one message."""
+        rows = execute_query(queries.MESSAGE_REACTION_COUNTS, (message_id,), fetch_all=True)
+        return {emoji: count for emoji, count in rows}
+
+    def counts_for(self, message_ids):
+        """{message_id: {emoji: count}} for a page of messages in one query."""
+        if not message_ids:
+            return {}
+        rows = execute_query(f'''
+            SELECT message_id, emoji, COUNT(*) as count
+            FROM message_reactions
+            WHERE message_id IN ({_placeholders(message_ids)})
+            GROUP BY message_id, emoji
+        ''', tuple(message_ids), fetch_all=True, read_only=True)
+        counts = {}
+        for message_id, emoji, count in rows:
+            counts.setdefault(message_id, {})[emoji] = count
+        return counts
+
+
+class FriendRepository:
+    def incoming(self, user_id):
+        """Pending requests sent to this user."""
+        rows = execute_query(queries.FRIENDS_INCOMING, (user_id,), fetch_all=True, read_only=True)
+        return list(map(UserCard._make, rows))
+
+    def outgoing(self, user_id):
+        """Pending requests this user sent."""
+        rows = execute_query(queries.FRIENDS_OUTGOING, (user_id,), fetch_all=True, read_only=True)
+        return list(map(UserCard._make, rows))
+
+    def accepted(self, user_id):
+        rows = execute_query(queries.FRIENDS_ACCEPTED, (user_id,) * 3, fetch_all=True, read_only=True)
+        return list(map(UserCard._make, rows))
+
+
+class ReportRepository:
+    def against_user(self, user_id):
+        """Reports filed on messages written by this user."""
+        rows = execute_query(queries.REPORTS_AGAINST_USER, (user_id,), fetch_all=True, read_only=True)
+        return list(map(UserReport._make, rows))
+
+
+users = UserRepository()
+dms = DMRepository()
+messages = MessageRepository()
+reactions = ReactionRepository()
+friends = FriendRepository()
+reports = ReportRepository()
@@ -0,0 +1,155 @@
+"""
+In-memory index of active bans and mutes.
+
+Write endpoints check it on every request, so it must cost no queries:
+load() reads all active sanctions once at startup, apply() updates the index
+right after a remediation commits, and timed sanctions sit in a min-heap by
+expiry so they lift themselves: banned()/muted() first pop whatever has
+expired. Replaced or lifted entries stay in the heap and are skipped when
+popped (their expiry no longer matches the index).
+
+Each worker has its own index. A remediation made through another worker is
+picked up by the periodic reload (SANCTION_RELOAD_INTERVAL seconds), which
+also clears expired sanctions in the users table (sweep()).
+
+    @app.route('/api/dms/by_id/<int:dm_id>/send', methods=['POST'])
+    @sanctions.unless_muted
+    def api_dm_send_by_id(dm_id): ...
+"""
+import heapq
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify, session
+
+import db
+import queries
+
+SANCTION_RELOAD_INTERVAL = float(os.environ.get('SANCTION_RELOAD_INTERVAL', 30))
+
+BANNED_ERROR = 'Ваш аккаунт заблокирован'
+MUTED_ERROR = 'Вы не можете отправлять сообщения (мут)'
+
+# user id -> {'ban': expires or None, 'mute': expires or None}; only active kinds
+_active = {}
+_heap = []  # (expires_at, user id, kind)
+_lock = threading.Lock()
+# apply() journal: (generation, user id, action, expires), see load()
+_generation = 0
+_applied = []
+
+
+def _set(uid, kind, expires):
+    entry = _active.setdefault(uid, {})
+    entry[kind] = expires
+    if expires is not None:
+        heapq.heappush(_heap, (expires, uid, kind))
+
+
+def _clear(uid, kind):
+    entry = _active.get(uid)
+    if entry is not None:
+        entry.pop(kind, None)
+        if not entry:
+            del _active[uid]
+
+
+def _expire(now):
+    while _heap and _heap[0][0] <= now:
+        expires, uid, kind = heapq.heappop(_heap)
+        entry = _active.get(uid)
+        if entry is not None and entry.get(kind) == expires:
+            _clear(uid, kind)
+
+
+def _active_kind(user_id, kind, now):
+    uid = str(user_id)
+    with _lock:
+        if _heap and _heap[0][0] <= now:
+            _expire(now)
+        entry = _active.get(uid)
+        return entry is not None and kind in entry
+
+
+def banned(user_id, now=None):
+    return _active_kind(user_id, 'ban', time.time() if now is None else now)
+
+
+def muted(user_id, now=None):
+    return _active_kind(user_id, 'mute', time.time() if now is None else now)
+
+
+def _apply(uid, action, expires):
+    if action in ('ban', 'mute'):
+        if expires is None or expires > time.time():
+            _set(uid, action, expires)
+    elif action in ('unban', 'unmute'):
+        _clear(uid, action[2:])
+
+
+def apply(user_id, action, expires=None):
+    """Mirror a committed remediation: ban, mute (expires None = permanent),
+    unban, unmute. Other actions are ignored."""
+    global _generation
+    uid = str(user_id)
+    with _lock:
+        _generation += 1
+        _applied.append((_generation, uid, action, expires))
+        _apply(uid, action, expires)
+
+
+def load():
+    """Rebuild the index from the users table. Remediations apply()'d while
+    the query ran may be missing from its result, so they are replayed on
+    top of it."""
+    global _active, _heap, _applied
+    with _lock:
+        started = _generation
+    now = time.time()
+    rows = db.execute_query(queries.SANCTIONS_ACTIVE, fetch_all=True)
+    with _lock:
+        _active, _heap = {}, []
+        for uid, is_banned, ban_expires, is_muted, mute_expires in rows or ():
+            if is_banned and (ban_expires is None or ban_expires > now):
+                _set(str(uid), 'ban', ban_expires)
+            if is_muted and (mute_expires is None or mute_expires > now):
+                _set(str(uid), 'mute', mute_expires)
+        # Older entries are in the table by now; later loads won't need them
+        _applied = [entry for entry in _applied if entry[0] > started]
+        for _, uid, action, expires in _applied:
+            _apply(uid, action, expires)
+    return len(_active)
+
+
+def sweep():
+    """Clear expired bans and mutes in the users table."""
+    now = time.time()
+    db.execute_query(queries.SANCTIONS_EXPIRE_BANS, (now,), commit=True)
+    db.execute_query(queries.SANCTIONS_EXPIRE_MUTES, (now,), commit=True)
+
+
+def _current_user_id():
+    user = session.get('user')
+    return user['id'] if user else None
+
+
+def unless_muted(view):
+    """Decorator for endpoints that post content: 403 for muted users."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        uid = _current_user_id()
+        if uid is not None and (muted(uid) or banned(uid)):
+            return jsonify({'success': False, 'error': MUTED_ERROR}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def stats():
+    with _lock:
+        return {
+            'banned': sum(1 for e in _active.values() if 'ban' in e),
+            'muted': sum(1 for e in _active.values() if 'mute' in e),
+            'heap': len(_heap),
+        }
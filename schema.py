@@ -0,0 +1,82 @@
+"""
+Versioned index set for the messaging schema.
+
+Each entry belongs to an index-set version and is built by the migration of
+the same name (migrations/0004_index_set_v1.py, ...), so adding an index
+means appending it under a new version and adding a migration that calls
+create_index_set() for that version. On Postgres indexes are built
+CONCURRENTLY so existing tables stay writable while they build.
+
+Some hot lookups are already served by UNIQUE constraints and need no extra
+index: direct_messages(user_id_1, user_id_2), friends(user_id_1, user_id_2),
+read_receipts(dm_id, user_id), message_reactions(message_id, user_id, emoji).
+"""
+
+# (version, index name, table, columns, partial-index predicate or None)
+INDEXES = [
+    # DM history pages: WHERE dm_id = ? [AND id < ?] ORDER BY id DESC
+    (1, 'idx_dm_messages_dm_id_id', 'dm_messages', 'dm_id, id', None),
+    # Storage usage and the admin message inspector
+    (1, 'idx_dm_messages_author_id', 'dm_messages', 'author_id', None),
+    # Disappearing-message sweep; most rows never expire
+    (1, 'idx_dm_messages_expires_at', 'dm_messages', 'expires_at', 'expires_at IS NOT NULL'),
+    # DM list: WHERE user_id_1 = ? OR user_id_2 = ? (user_id_1 side uses the UNIQUE index)
+    (1, 'idx_direct_messages_user_id_2', 'direct_messages', 'user_id_2, user_id_1', None),
+    # Incoming friend requests / accepted friends where I am user_id_2
+    (1, 'idx_friends_user_id_2_status', 'friends', 'user_id_2, status', None),
+    # Admin dashboard pending counter and report queue
+    (1, 'idx_reports_status', 'reports', 'status', None),
+    # Reports joined to / deleted with their message, duplicate-report check
+    (1, 'idx_reports_message_id', 'reports', 'message_id, reporter_id', None),
+    # Admin "recent users" list and new-registrations counter
+    (1, 'idx_users_created_at', 'users', 'created_at', None),
+    # Admin user inspector: risk alerts of one user, newest first
+    (2, 'idx_risk_alerts_user_id', 'risk_alerts', 'user_id, timestamp', None),
+    # Username prefix lookups (LIKE 'prefix%'); SQLite uses the UNIQUE index for a range
+    (3, 'idx_users_username_pattern', 'users', 'username text_pattern_ops', None),
+    # Sanction index load and expiry sweep; almost no user is banned or muted
+    (4, 'idx_users_sanctioned', 'users', 'id', 'is_banned = 1 OR is_muted = 1'),
+]
+
+# Postgres operator-class indexes with no SQLite equivalent
+POSTGRES_ONLY = {'idx_users_username_pattern'}
+
+# Indexes made redundant by a newer one (left prefix of a composite)
+SUPERSEDED = [
+    (1, 'idx_dm_messages_dm_id'),
+]
+
+
+def index_ddl(name, table, columns, where, concurrently=False):
+    sql = f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {name} ON {table}({columns})"
+    if where:
+        sql += f" WHERE {where}"
+    return sql
+
+
+def _drop_invalid_pg_index(cursor, name):
+    # A failed CONCURRENTLY build leaves an INVALID index that IF NOT EXISTS would skip
+    cursor.execute("""
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND NOT i.indisvalid
+    """, (name,))
+    if cursor.fetchone():
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def create_index_set(cursor, is_sqlite, version):
+    """Build the indexes of one index-set version and drop the ones it
+    supersedes. On Postgres the connection must be in autocommit mode."""
+    for v, name, table, columns, where in INDEXES:
+        if v != version or (is_sqlite and name in POSTGRES_ONLY):
+            continue
+        if not is_sqlite:
+            _drop_invalid_pg_index(cursor, name)
+        cursor.execute(index_ddl(name, table, columns, where, concurrently=not is_sqlite))
+        print(f"  [+] {name} ON {table}({columns})")
+
+    for v, name in SUPERSEDED:
+        if v != version:
+            continue
+        cursor.execute(f"DROP INDEX {'CONCURRENTLY ' if not is_sqlite else ''}IF EXISTS {name}")
+        print(f"  [-] {name} (superseded)")
@@ -0,0 +1,219 @@
+"""
+Server-side sessions: the cookie carries only an opaque random session id.
+
+The session dict used to travel in a signed cookie (avatar data URI
+included) and was re-signed on every response. Now it lives in a store and
+is cached per worker, so a request carries a 43-character id, nothing gets
+HMACed, and the store is only written when the session content actually
+changed (or its expiry needs extending).
+
+SESSION_STORE selects the store:
+    db      the app database, SQLite or Postgres via db.py (default)
+    memory  in-process LRU; sessions are lost on restart and not shared
+            between workers
+
+With the db store each worker keeps recently used sessions for
+SESSION_CACHE_TTL seconds. A change made by another worker (logout, role
+sync) is seen here after at most that long; set it to 0 if requests of one
+user can hit several workers and that matters.
+
+Signed cookies issued before the switch are read once and moved into the
+store, so nobody is logged out by the upgrade.
+"""
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+import cache
+import db
+import queries
+
+SESSION_STORE = os.environ.get('SESSION_STORE', 'db')
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', 30))
+SESSION_MEMORY_MAX = int(os.environ.get('SESSION_MEMORY_MAX', 10000))
+SESSION_PURGE_INTERVAL = 600
+
+_SID_RE = re.compile(r'^[A-Za-z0-9_-]{43}$')
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, payload=None, expires_at=0.0):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        # What the store holds, to skip writes when nothing changed
+        self.payload = payload
+        self.expires_at = expires_at
+        self.new = sid is None
+        self.modified = False
+        self.rotate = False
+
+    def regenerate(self):
+        """Issue a new id on the next save (call after login)."""
+        self.rotate = True
+        self.modified = True
+
+
+class MemoryStore:
+    """LRU of (payload, expires_at) by session id."""
+
+    def __init__(self, maxsize=SESSION_MEMORY_MAX):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._data.get(sid)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._data[sid]
+                return None
+            self._data.move_to_end(sid)
+            return entry
+
+    def save(self, sid, payload, expires_at):
+        with self._lock:
+            self._data[sid] = (payload, expires_at)
+            self._data.move_to_end(sid)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+    def stats(self):
+        return {'store': 'memory', 'size': len(self._data)}
+
+
+class DatabaseStore:
+    """sessions table in the app database, with a per-worker TTL cache."""
+
+    def __init__(self, cache_ttl=SESSION_CACHE_TTL):
+        self.cache = cache.TTLCache(cache_ttl) if cache_ttl > 0 else None
+        self._last_purge = time.time()
+
+    def load(self, sid):
+        if self.cache is not None:
+            entry = self.cache.get(sid)
+            if entry is not None and entry[1] > time.time():
+                return entry
+        row = db.execute_query(queries.SESSION_LOAD, (sid, time.time()), fetch_one=True)
+        if row is None:
+            return None
+        entry = (row[0], row[1])
+        if self.cache is not None:
+            self.cache.set(sid, entry)
+        return entry
+
+    def save(self, sid, payload, expires_at):
+        db.execute_query(queries.SESSION_SAVE, (sid, payload, expires_at), commit=True)
+        if self.cache is not None:
+            self.cache.set(sid, (payload, expires_at))
+        if time.time() - self._last_purge > SESSION_PURGE_INTERVAL:
+            self._last_purge = time.time()
+            db.execute_query(queries.SESSION_PURGE, (time.time(),), commit=True)
+
+    def delete(self, sid):
+        if self.cache is not None:
+            self.cache.invalidate(sid)
+        db.execute_query(queries.SESSION_DELETE, (sid,), commit=True)
+
+    def stats(self):
+        stats = {'store': 'db'}
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+
+def make_store(kind=SESSION_STORE):
+    if kind == 'memory':
+        return MemoryStore()
+    if kind == 'db':
+        return DatabaseStore()
+    raise ValueError(f"Unknown SESSION_STORE: {kind}")
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+        self.serializer = SecureCookieSessionInterface.serializer
+        self._legacy = SecureCookieSessionInterface()
+
+    def _lifetime(self, app):
+        return app.permanent_session_lifetime.total_seconds()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return ServerSession()
+        if _SID_RE.match(sid):
+            try:
+                entry = self.store.load(sid)
+            except Exception as e:
+                print(f"[!] Session load failed: {e}")
+                entry = None
+            if entry is not None:
+                payload, expires_at = entry
+                try:
+                    return ServerSession(self.serializer.loads(payload), sid, payload, expires_at)
+                except Exception:
+                    pass
+            return ServerSession()
+        # A signed cookie from before server-side sessions: adopt its contents
+        legacy = self._legacy.open_session(app, request)
+        session = ServerSession(dict(legacy) if legacy else None)
+        session.modified = bool(legacy)
+        return session
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            elif name in request.cookies:
+                # Logged out, or a stale id / legacy cookie that didn't load
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = time.time()
+        payload = self.serializer.dumps(dict(session))
+        lifetime = self._lifetime(app)
+        # Extend the expiry once half of it is used up, not on every request
+        refresh = session.expires_at - now < lifetime / 2
+        if session.rotate and session.sid is not None:
+            self.store.delete(session.sid)
+            session.sid = None
+        new_sid = session.sid is None
+        if new_sid:
+            session.sid = secrets.token_urlsafe(32)
+
+        if new_sid or refresh or payload != session.payload:
+            expires_at = now + lifetime if (new_sid or refresh) else session.expires_at
+            self.store.save(session.sid, payload, expires_at)
+            session.payload = payload
+            session.expires_at = expires_at
+
+        if new_sid or refresh:
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app))
+        response.vary.add('Cookie')
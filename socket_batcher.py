@@ -0,0 +1,51 @@
+"""
+Coalescing queues for the Socket.IO batcher (web.bg_socket_batcher).
+
+Events queued within one flush window are collapsed per key with the newest
+one winning (status per user, typing per (dm, user)) and emitted together
+at the end of the window, at most SOCKET_BATCH_MAX events per message.
+
+Each queue is an insertion-ordered dict, so enqueue is one pop and one
+insert, O(1). A key queued again moves to the end, so events still leave in
+the order of each key's latest update, as with the old list rebuild. A flush
+swaps in a fresh dict instead of copying under a lock. That is safe because
+every producer (socket handlers, request views) runs on the eventlet hub's
+single OS thread and put() never yields.
+
+    python bench_socket_batcher.py   # 10k events per window, old vs. new
+"""
+import os
+
+SOCKET_BATCH_INTERVAL = float(os.environ.get('SOCKET_BATCH_INTERVAL', 0.5))
+SOCKET_BATCH_MAX = int(os.environ.get('SOCKET_BATCH_MAX', 500))
+
+
+class CoalescingQueue:
+    def __init__(self):
+        self._pending = {}
+        self.enqueued = 0
+        self.coalesced = 0
+
+    def put(self, key, event):
+        pending = self._pending
+        if pending.pop(key, None) is not None:
+            self.coalesced += 1
+        pending[key] = event
+        self.enqueued += 1
+
+    def drain(self):
+        """The queued events, oldest first; the queue starts over empty."""
+        pending, self._pending = self._pending, {}
+        return list(pending.values())
+
+    def __len__(self):
+        return len(self._pending)
+
+    def stats(self):
+        return {'pending': len(self._pending), 'enqueued': self.enqueued, 'coalesced': self.coalesced}
+
+
+def chunks(events, size=None):
+    size = size or SOCKET_BATCH_MAX
+    for i in range(0, len(events), size):
+        yield events[i:i + size]
@@ -4205,7 +4205,56 @@ window.Utils = Utils;
 window.DEFAULT_AVATAR = DEFAULT_AVATAR;
 window.GifModule = GifModule;
 
+// === USER DIRECTORY ===
+// Profiles and presence from /api/users/batch. Lookups made in the same tick
+// share one request; results are reused for a minute. E2EE keys don't come
+// from here, see EncryptionUI.getRecipientKey.
+const UserDirectory = {
+    TTL_MS: 60000,
+    BATCH_MAX: 100,
+    entries: new Map(),   // id -> {promise, at}
+    pending: new Map(),   // id -> resolve
+    timer: null,
+
+    get: (userId) => {
+        const id = String(userId);
+        const entry = UserDirectory.entries.get(id);
+        if (entry && Date.now() - entry.at < UserDirectory.TTL_MS) return entry.promise;
+
+        const promise = new Promise(resolve => UserDirectory.pending.set(id, resolve));
+        UserDirectory.entries.set(id, { promise, at: Date.now() });
+        if (!UserDirectory.timer) UserDirectory.timer = setTimeout(UserDirectory.flush, 0);
+        return promise;
+    },
+
+    invalidate: (userId) => UserDirectory.entries.delete(String(userId)),
+
+    flush: async () => {
+        UserDirectory.timer = null;
+        const batch = [...UserDirectory.pending.entries()].slice(0, UserDirectory.BATCH_MAX);
+        batch.forEach(([id]) => UserDirectory.pending.delete(id));
+        if (UserDirectory.pending.size) UserDirectory.timer = setTimeout(UserDirectory.flush, 0);
+
+        let users = {};
+        try {
+            const res = await fetch('/api/users/batch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ ids: batch.map(([id]) => id) })
+            });
+            const data = await res.json();
+            if (data.success) users = data.users;
+        } catch (e) { console.error(e); }
+
+        for (const [id, resolve] of batch) {
+            // Failed lookups aren't remembered, the next get() retries
+            if (!users[id]) UserDirectory.entries.delete(id);
+            resolve(users[id] || null);
+        }
+    }
+};
 
+window.UserDirectory = UserDirectory;
 
 // =========================================================================
 // ENCRYPTION UI & INTEGRATION
@@ -4302,7 +4351,8 @@ const EncryptionUI = {
     tryDecryptElements: async () => {
         if (!EncryptionModule.privateKey) return;
 
-        // Decrypt text messages
+        // Decrypt text messages; each key is fetched once per pass
+        const keys = new Map();
         const elements = document.querySelectorAll('.encrypted-msg');
         for (const el of elements) {
             try {
@@ -4328,7 +4378,8 @@ const EncryptionUI = {
 
                 if (!otherUser) continue;
 
-                const theirKey = await EncryptionUI.getRecipientKey(otherUser.id);
+                if (!keys.has(otherUser.id)) keys.set(otherUser.id, EncryptionUI.getRecipientKey(otherUser.id));
+                const theirKey = await keys.get(otherUser.id);
                 if (!theirKey) continue;
 
                 sharedSecret = await EncryptionModule.getSharedSecret(otherUser.id, theirKey);
@@ -4348,6 +4399,8 @@ const EncryptionUI = {
         DiscordModule.switchSettingsTab('privacy');
     },
 
+    // Never cached: after a key rotation, a stale key would encrypt messages
+    // the recipient can no longer read
     getRecipientKey: async (userId) => {
         try {
             const res = await fetch(`/api/keys/${userId}`);
@@ -0,0 +1,94 @@
+"""
+Who is typing in which DM, with server-side expiry.
+
+Clients send typing_start once and typing_stop when they pause. A client
+that disconnects or goes quiet never sends the stop, so every entry expires
+TYPING_TTL seconds after its last start. Expiries sit in a min-heap, and
+expire() pops only what is due, so a sweep costs nothing when there is
+nothing to do. An entry that was restarted or stopped stays in the heap and
+is skipped when popped, because its expiry no longer matches. The heap
+therefore holds at most the starts of the last TYPING_TTL seconds.
+
+Entries are also indexed by socket id, so handle_disconnect can drop a
+socket's entries at once. Expired and dropped entries are returned to the
+caller, which sends the recipient a stop through the batcher.
+"""
+import heapq
+import os
+import threading
+import time
+from collections import namedtuple
+
+TYPING_TTL = float(os.environ.get('TYPING_TTL', 5))
+
+Typing = namedtuple('Typing', 'dm_id recipient_id user_id username')
+
+_Entry = namedtuple('_Entry', 'expires sid typing')
+
+
+class TypingTracker:
+    def __init__(self, ttl=None):
+        self.ttl = ttl or TYPING_TTL
+        self._active = {}  # (dm id, user id) -> _Entry
+        self._by_sid = {}  # sid -> {(dm id, user id)}
+        self._heap = []    # (expires, dm id, user id)
+        self._lock = threading.Lock()
+        self.expired = 0
+
+    def start(self, dm_id, recipient_id, user_id, username, sid, now=None):
+        key = (dm_id, user_id)
+        expires = (time.time() if now is None else now) + self.ttl
+        with self._lock:
+            previous = self._active.get(key)
+            if previous is not None and previous.sid != sid:
+                self._unindex(previous.sid, key)
+            self._active[key] = _Entry(expires, sid, Typing(dm_id, recipient_id, user_id, username))
+            self._by_sid.setdefault(sid, set()).add(key)
+            heapq.heappush(self._heap, (expires, dm_id, user_id))
+
+    def stop(self, dm_id, user_id):
+        """True if the user was typing in the DM."""
+        with self._lock:
+            return self._remove((dm_id, user_id)) is not None
+
+    def expire(self, now=None):
+        """Drop entries whose TTL ran out; returns their Typing records."""
+        now = time.time() if now is None else now
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expires, dm_id, user_id = heapq.heappop(self._heap)
+                entry = self._active.get((dm_id, user_id))
+                if entry is not None and entry.expires == expires:
+                    self._remove((dm_id, user_id))
+                    due.append(entry.typing)
+            self.expired += len(due)
+        return due
+
+    def drop_sid(self, sid):
+        """Drop every entry started from a socket; returns their Typing records."""
+        with self._lock:
+            keys = self._by_sid.pop(sid, ())
+            dropped = [self._active.pop(key).typing for key in keys if key in self._active]
+        return dropped
+
+    def _remove(self, key):
+        entry = self._active.pop(key, None)
+        if entry is not None:
+            self._unindex(entry.sid, key)
+        return entry
+
+    def _unindex(self, sid, key):
+        keys = self._by_sid.get(sid)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_sid[sid]
+
+    def __len__(self):
+        return len(self._active)
+
+    def stats(self):
+        with self._lock:
+            return {'typing': len(self._active), 'sockets': len(self._by_sid),
+                    'heap': len(self._heap), 'expired': self.expired}
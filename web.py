@@ -16,36 +16,61 @@ import threading
 import random
 import string
 import sqlite3
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import psutil
 import concurrent.futures
 import utils
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_from_directory
+import socket_batcher
+import cluster
+import typing_tracker
+import query_stats
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_from_directory, Response, stream_with_context
 from flask_socketio import SocketIO, emit, join_room
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
+from werkzeug.middleware.shared_data import SharedDataMiddleware
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev_secret_key_fixed_12345')
 app.permanent_session_lifetime = timedelta(days=30)
-socketio = SocketIO(app, cors_allowed_origins="*", manage_session=True, async_mode='eventlet')
+# Innermost, so Socket.IO traffic and static files bypass it
+app.wsgi_app = query_stats.middleware(app.wsgi_app)
+socketio = SocketIO(app, cors_allowed_origins="*", manage_session=True, async_mode='eventlet',
+                    message_queue=cluster.SOCKETIO_MESSAGE_QUEUE)
+
+# request.remote_addr is the client address as seen by the last of
+# TRUSTED_PROXIES reverse proxies (1 for Railway/Render/nginx, 0 when the
+# app is exposed directly). Only entries those proxies appended to
+# X-Forwarded-For are used; anything the client sent itself is ignored.
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 1))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# Static files are answered ahead of Flask: no routing, session load or
+# before_request chain, with ETag/304 revalidation and wsgi.file_wrapper
+# (sendfile) where the server provides one
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', 3600))
+app.wsgi_app = SharedDataMiddleware(app.wsgi_app, {
+    '/static': app.static_folder,
+    '/favicon.ico': os.path.join(app.static_folder, 'favicon.ico'),
+}, cache_timeout=STATIC_MAX_AGE)
 # Auth & Storage Configurations
 RESEND_API_KEY = os.environ.get('RESEND_API_KEY', 're_UAy2HEyT_D4y6Vs8ZVYgnqsn5StCm8byK')
 
 # SMTP Settings (Outlook / Office365)
-SMTP_SERVER = "smtp.office365.com"  # Outlook/Hotmail/Office365
-SMTP_PORT = 587                    # STARTTLS Port
-SMTP_USER = "octavesup@outlook.com"
-SMTP_PASSWORD = "fpesftmxocnbhsfl" 
+SMTP_SERVER = os.environ.get('SMTP_SERVER', "smtp.office365.com")  # Outlook/Hotmail/Office365
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))                  # STARTTLS Port
+SMTP_USER = os.environ.get('SMTP_USER', "octavesup@outlook.com")
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', "fpesftmxocnbhsfl")
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') == '1'
 
 # Storage Quota (30 GB in bytes)
 USER_STORAGE_QUOTA = 30 * 1024 * 1024 * 1024
 
-# Online users tracking: {user_id: {socket_sid, username, avatar}}
+# Online users on every worker, with this worker's sockets per user (see cluster.py)
 # Also track by sid for reliable disconnect: {sid: user_id}
-online_users = {}
+online_users = cluster.OnlineUsers()
+if cluster.SOCKETIO_MESSAGE_QUEUE:
+    online_users.attach(cluster.SOCKETIO_MESSAGE_QUEUE)
 sid_to_user = {}
 
 @socketio.on('connect')
@@ -54,17 +79,14 @@ def handle_connect():
         user_id = str(session['user']['id'])
         sid = request.sid
         join_room(user_id)
-        # Track online user
-        if user_id:
-            username = session['user'].get('username', 'Unknown')
-            online_users[user_id] = {
-                'sid': sid,
-                'username': username,
-                'avatar': session['user'].get('avatar', DEFAULT_AVATAR)
-            }
+        username = session['user'].get('username', 'Unknown')
+        online_users.connect(user_id, sid, {
+            'username': username,
+            'avatar': session['user'].get('avatar', DEFAULT_AVATAR)
+        })
         sid_to_user[sid] = user_id
-        # Update DB status
-        execute_query("UPDATE users SET status = 'online' WHERE id = %s", (user_id,), commit=True)
+        # Update DB status (written in batches, see cache.statuses)
+        cache.statuses.set(user_id, 'online')
         # Queue status update for batching
         enqueue_status_update(user_id, username, 'online')
         print(f"[WS] User {username} connected. Online: {len(online_users)}")
@@ -72,73 +94,84 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     sid = request.sid
+    # Typing started from this socket stops with it
+    for t in typing_users.drop_sid(sid):
+        enqueue_typing_event(t.dm_id, t.recipient_id, t.user_id, t.username, 'stop')
     # Look up user by socket ID (session may not be available on disconnect)
     user_id = sid_to_user.pop(sid, None)
-    if user_id and user_id in online_users:
-        username = online_users[user_id].get('username', '')
-        del online_users[user_id]
-        # Update DB status
-        execute_query("UPDATE users SET status = 'offline' WHERE id = %s", (user_id,), commit=True)
-        # Broadcast offline status
+    if user_id:
+        info, offline = online_users.disconnect(user_id, sid)
+        # Other tabs, on this worker or another, keep the user online
+        if not offline:
+            return
+        username = (info or {}).get('username', '')
+        # Update DB status (written in batches, see cache.statuses)
+        cache.statuses.set(user_id, 'offline')
         # Queue status update for batching instead of immediate broadcast
         enqueue_status_update(user_id, username, 'offline')
         print(f"[WS] User {username} disconnected. Online: {len(online_users)}")
 
+def announce_offline(user_ids):
+    """Users who left while another worker still held them, and that worker
+    went away without announcing them (see cluster.OnlineUsers)"""
+    for user_id in user_ids:
+        cache.statuses.set(user_id, 'offline')
+        enqueue_status_update(user_id, '', 'offline')
+    print(f"[WS] {len(user_ids)} users offline on every worker. Online: {len(online_users)}")
+
+online_users.on_offline = announce_offline
+
 # --- WebSocket Batching Logic ---
-status_queue = []
-typing_queue = []
-batch_lock = threading.Lock()
+# Latest status per user and typing action per (dm, user), see socket_batcher.py
+status_queue = socket_batcher.CoalescingQueue()
+typing_queue = socket_batcher.CoalescingQueue()
 
 def enqueue_status_update(user_id, username, status):
-    with batch_lock:
-        # Keep only the last status for a user in this batch
-        status_queue[:] = [q for q in status_queue if q['user_id'] != user_id]
-        status_queue.append({'user_id': user_id, 'username': username, 'status': status})
+    status_queue.put(user_id, {'user_id': user_id, 'username': username, 'status': status})
 
 def enqueue_typing_event(dm_id, recipient_id, user_id, username, action):
-    with batch_lock:
-        # Keep only the last action for a user in a specific DM in this batch
-        typing_queue[:] = [q for q in typing_queue if not (q['dm_id'] == dm_id and q['user_id'] == user_id)]
-        typing_queue.append({
-            'dm_id': dm_id, 
-            'recipient_id': recipient_id, 
-            'user_id': user_id, 
-            'username': username, 
-            'action': action,
-            'timestamp': time.time()
-        })
+    typing_queue.put((dm_id, user_id), {
+        'dm_id': dm_id, 
+        'recipient_id': recipient_id, 
+        'user_id': user_id, 
+        'username': username, 
+        'action': action,
+        'timestamp': time.time()
+    })
 
 def bg_socket_batcher():
-    """Background task to emit batched events every 500ms"""
+    """Background task to emit batched events every SOCKET_BATCH_INTERVAL seconds"""
     while True:
-        socketio.sleep(0.5)
+        socketio.sleep(socket_batcher.SOCKET_BATCH_INTERVAL)
         
-        with batch_lock:
-            current_status = list(status_queue)
-            current_typing = list(typing_queue)
-            status_queue.clear()
-            typing_queue.clear()
+        # Typing nobody stopped (closed tab, lost connection) times out here
+        for t in typing_users.expire():
+            enqueue_typing_event(t.dm_id, t.recipient_id, t.user_id, t.username, 'stop')
+
+        current_status = status_queue.drain()
+        current_typing = typing_queue.drain()
             
+        # Status changes go only to online friends and DM partners, see presence.py
         if current_status:
-            # Broadcast multiple status updates in one message
-            socketio.emit('batched_user_status', {'updates': current_status})
+            for uid, updates in presence.route(current_status, online_users).items():
+                for chunk in socket_batcher.chunks(updates):
+                    socketio.emit('batched_user_status', {'updates': chunk}, room=uid)
             
         if current_typing:
             # Group typing events by recipient to avoid over-sending
             by_recipient = {}
             for t in current_typing:
-                rid = t['recipient_id']
-                if rid not in by_recipient: by_recipient[rid] = []
-                by_recipient[rid].append(t)
+                by_recipient.setdefault(t['recipient_id'], []).append(t)
                 
             for rid, events in by_recipient.items():
-                socketio.emit('batched_typing', {'events': events}, room=str(rid))
+                for chunk in socket_batcher.chunks(events):
+                    socketio.emit('batched_typing', {'events': chunk}, room=str(rid))
 
 # Start background task
 socketio.start_background_task(bg_socket_batcher)
 
-# Typing indicator tracking: {dm_id: {user_id: timestamp}}
-typing_users = {}
+# Typing indicator tracking with a TYPING_TTL expiry, see typing_tracker.py
+typing_users = typing_tracker.TypingTracker()
 
 @socketio.on('typing_start')
 def handle_typing_start(data):
@@ -151,13 +184,11 @@ def handle_typing_start(data):
     dm_id = data.get('dm_id')
     recipient_id = data.get('recipient_id')
     
-    if not dm_id or not recipient_id:
+    if not dm_id or not recipient_id or sanctions.muted(user_id):
         return
     
     # Track typing user
-    if dm_id not in typing_users:
-        typing_users[dm_id] = {}
-    typing_users[dm_id][user_id] = time.time()
+    typing_users.start(dm_id, recipient_id, user_id, username, request.sid)
     
     # Queue typing event for batching
     enqueue_typing_event(dm_id, recipient_id, user_id, username, 'start')
@@ -177,16 +208,29 @@ def handle_typing_stop(data):
         return
     
     # Remove typing user
-    if dm_id in typing_users and user_id in typing_users[dm_id]:
-        del typing_users[dm_id][user_id]
-        if not typing_users[dm_id]:  # Clean up empty dict
-            del typing_users[dm_id]
+    typing_users.stop(dm_id, user_id)
             
     # Queue typing stop event (removed redundant immediate emit)
     enqueue_typing_event(dm_id, recipient_id, user_id, username, 'stop')
 
 import psycopg2
 from urllib.parse import urlparse
+from db import get_db_connection, execute_query, transaction
+import db
+import queries
+import migrations
+import repositories
+import cache
+import passwords
+import sessions
+import ratelimit
+import mailer
+import provisioning
+import sanctions
+import presence
+
+# Only an opaque session id goes in the cookie (see sessions.py)
+app.session_interface = sessions.ServerSessionInterface(sessions.make_store())
 
 # ... imports ...
 
@@ -196,7 +240,7 @@ SERVERS_FILE = os.path.join(BASE_DIR, 'servers.json')
 servers_db = {}
 
 # Default Avatar (SVG Data URI - clean user silhouette)
-DEFAULT_AVATAR = "data:image/svg+xml,%3Csvg xmlns='http://www.w3.org/2000/svg' width='128' height='128' viewBox='0 0 128 128'%3E%3Crect width='128' height='128' fill='%235865F2'/%3E%3Ccircle cx='64' cy='50' r='22' fill='%23fff'/%3E%3Cellipse cx='64' cy='112' rx='36' ry='28' fill='%23fff'/%3E%3C/svg%3E"
+DEFAULT_AVATAR = repositories.DEFAULT_AVATAR
 
 def get_valid_avatar(avatar_url):
     """Check if avatar URL is valid - for local files, verify they exist.
@@ -216,231 +260,126 @@ def get_valid_avatar(avatar_url):
     
     return avatar_url
 
+def stream_json_response(key, items, **extra):
+    """Stream {"success": true, **extra, key: [...]} item by item, so large
+    lists (fed from db.stream_query) are never built in memory."""
+    def generate():
+        head = app.json.dumps({'success': True, **extra})
+        yield head[:-1] + ', ' + app.json.dumps(key) + ': ['
+        chunk = []
+        first = True
+        for item in items:
+            chunk.append(('' if first else ',') + app.json.dumps(item))
+            first = False
+            if len(chunk) >= 100:
+                yield ''.join(chunk)
+                chunk = []
+        chunk.append(']}')
+        yield ''.join(chunk)
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
 # Servers will be loaded after the full load_servers() function is defined below
 
-def get_db_connection():
-    db_url = os.environ.get('DATABASE_URL')
-    if not db_url:
-        # Fallback to local SQLite for development if no URL provided
-        # But we strongly encourage Postgres. 
-        # For seamless migration, let's use SQLite if no params, but warn.
-        # However, switching placeholder syntax is tricky. 
-        # Let's enforce Postgres for now or use a wrapper.
-        # Simpler: Assume Postgres if env var is set, else SQLite? 
-        # No, the placeholder difference (%) vs (?) is a pain.
-        # We will wrap standard queries or just fail if no DB configured?
-        # Let's try to support both via a helper.
-        return sqlite3.connect(os.path.join(BASE_DIR, 'users.db'))
-    
-    return psycopg2.connect(db_url)
-
-def execute_query(query, params=(), fetch_one=False, fetch_all=False, commit=False):
-    conn = get_db_connection()
-    is_sqlite = isinstance(conn, sqlite3.Connection)
-    
-    # Adapting placeholders: %s for PG, ? for SQLite
-    if is_sqlite:
-        query = query.replace('%s', '?')
-    
-    cursor = conn.cursor()
-    try:
-        cursor.execute(query, params)
-        if commit:
-            conn.commit()
-            return cursor.lastrowid # Might differ in PG
-        if fetch_one:
-            return cursor.fetchone()
-        if fetch_all:
-            return cursor.fetchall()
-    except Exception as e:
-        print(f"DB Error: {e} | Query: {query}")
-        raise e
-    finally:
-        cursor.close()
-        conn.close()
-
-def init_db():
-    conn = get_db_connection()
-    is_sqlite = isinstance(conn, sqlite3.Connection)
-    c = conn.cursor()
-    
-    # SQLite / Postgres differences
-    # Postgres: SERIAL PRIMARY KEY, TEXT is fine.
-    # SQLite: INTEGER PRIMARY KEY AUTOINCREMENT
-    
-    pk_type = "INTEGER PRIMARY KEY AUTOINCREMENT" if is_sqlite else "SERIAL PRIMARY KEY"
-    varchar_type = "TEXT" if is_sqlite else "VARCHAR(50)"
-    
-    print("[*] Initializing database...")
-    
-    # Users Table
-    c.execute(f'''CREATE TABLE IF NOT EXISTS users
-                 (id {pk_type}, 
-                  username TEXT UNIQUE NOT NULL, 
-                  password_hash TEXT NOT NULL, 
-                  avatar TEXT,
-                  created_at REAL,
-                  display_name TEXT,
-                  banner TEXT,
-                  bio TEXT,
-                  email TEXT,
-                  phone TEXT,
-                  role TEXT DEFAULT 'user',
-                  reputation INTEGER DEFAULT 0,
-                  last_seen REAL,
-                  admin_pin TEXT)''')
-    print("  [+] Users table ready")
-
-    # Friends Table
-    c.execute(f'''CREATE TABLE IF NOT EXISTS friends
-                 (id {pk_type}, 
-                  user_id_1 INTEGER NOT NULL, 
-                  user_id_2 INTEGER NOT NULL, 
-                  status TEXT DEFAULT 'pending', 
-                  created_at REAL,
-                  UNIQUE(user_id_1, user_id_2))''')
-    print("  [+] Friends table ready")
-
-    # DM Tables
-    c.execute(f'''CREATE TABLE IF NOT EXISTS direct_messages
-                 (id {pk_type},
-                  user_id_1 INTEGER NOT NULL,
-                  user_id_2 INTEGER NOT NULL,
-                  last_message_at REAL,
-                  UNIQUE(user_id_1, user_id_2))''')
-    print("  [+] Direct messages table ready")
-
-    c.execute(f'''CREATE TABLE IF NOT EXISTS dm_messages
-                 (id {pk_type},
-                  dm_id INTEGER NOT NULL,
-                  author_id INTEGER NOT NULL,
-                  content TEXT,
-                  timestamp REAL,
-                  reply_to_id INTEGER,
-                  is_pinned INTEGER DEFAULT 0,
-                  edited_at REAL,
-                  attachments TEXT,
-                  expires_at REAL)''')
-    
-    c.execute(f'''CREATE TABLE IF NOT EXISTS reports
-                 (id {pk_type},
-                  message_id INTEGER NOT NULL,
-                  reporter_id INTEGER NOT NULL,
-                  reason TEXT NOT NULL,
-                  timestamp REAL)''')
-    print("  [+] Reports table ready")
-    print("  [+] DM messages table ready")
-
-    # Message Reactions Table - CRITICAL for reactions feature
-    c.execute(f'''CREATE TABLE IF NOT EXISTS message_reactions
-                 (id {pk_type},
-                  message_id INTEGER NOT NULL,
-                  user_id INTEGER NOT NULL,
-                  emoji {varchar_type} NOT NULL,
-                  created_at REAL,
-                  UNIQUE(message_id, user_id, emoji))''')
-    print("  [+] Message reactions table ready")
-
-    # Server Members Table - tracks who is a member of which server
-    c.execute(f'''CREATE TABLE IF NOT EXISTS server_members
-                 (id {pk_type},
-                  server_id TEXT NOT NULL,
-                  user_id INTEGER NOT NULL,
-                  role TEXT DEFAULT 'member',
-                  joined_at REAL,
-                  UNIQUE(server_id, user_id))''')
-    print("  [+] Server members table ready")
-    
-    # --- Performance Indexes ---
-    c.execute('CREATE INDEX IF NOT EXISTS idx_dm_messages_dm_id ON dm_messages(dm_id)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_dm_messages_timestamp ON dm_messages(timestamp)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_message_reactions_message_id ON message_reactions(message_id)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_direct_messages_last_message_at ON direct_messages(last_message_at)')
-    print("  [+] Performance indexes ready")
-                  
-    conn.commit()
-    conn.close()
-    print("[OK] Database initialized successfully!")
+# Schema lives in migrations/ (python -m migrations); at startup we only
+# check the recorded version and migrate if this deploy is the first to boot.
+try:
+    migrations.startup_check()
+except Exception as e:
+    print(f"[!] CRITICAL: Database migration failed: {e}")
+    print("[!] The application will attempt to start, but database features will be broken.")
 
-# Removed file-based users_db logic since we now have columns for role/reputation in DB.
+# Hardcoded Founders are always developers (Fix for Render storage issues).
+# Promoted once here; check_auth only re-promotes from the cached role.
+AUTO_DEVELOPERS = ('666', 'OmG', '234')
 
-def safe_init_db():
+def promote_founders():
+    placeholders = ','.join(['%s'] * len(AUTO_DEVELOPERS))
     try:
-        init_db()
+        execute_query(f"UPDATE users SET role = 'developer' WHERE username IN ({placeholders}) AND role != 'developer'",
+                      AUTO_DEVELOPERS, commit=True)
     except Exception as e:
-        print(f"[!] CRITICAL: Database initialization failed: {e}")
-        print("[!] The application will attempt to start, but database features will be broken.")
+        print(f"[!] Founder promotion failed: {e}")
 
-safe_init_db()
+promote_founders()
 
-def run_db_migration():
-    """
-    Run database migration to add extended messaging fields to existing databases.
-    This is safe to run multiple times - it checks if columns exist before adding.
-    """
-    try:
-        conn = get_db_connection()
-        is_sqlite = isinstance(conn, sqlite3.Connection)
-        cursor = conn.cursor()
-        
-        pk_type = "INTEGER PRIMARY KEY AUTOINCREMENT" if is_sqlite else "SERIAL PRIMARY KEY"
-        
-        print("[*] Running database migration...")
-        
-        # Helper for adding columns safely
-        def add_col(table, column, col_type):
-            try:
-                if is_sqlite:
-                    cursor.execute(f"PRAGMA table_info({table})")
-                    cols = {row[1] for row in cursor.fetchall()}
-                    if column not in cols:
-                        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type}")
-                        print(f"  [+] Added {column} to {table}")
-                else:
-                    cursor.execute(f"SELECT column_name FROM information_schema.columns WHERE table_name='{table}' AND column_name='{column}'")
-                    if not cursor.fetchone():
-                        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type}")
-                        print(f"  [+] Added {column} to {table}")
-                conn.commit()
-            except Exception as e:
-                print(f"  [!] Skip {column} on {table}: {e}")
-                conn.rollback()
-
-        # Admin & Reports updates
-        add_col("users", "ip_address", "TEXT")
-        add_col("users", "device_id", "TEXT")
-        add_col("users", "is_banned", "INTEGER DEFAULT 0")
-        add_col("users", "ban_expires", "REAL")
-        add_col("users", "ban_reason", "TEXT")
-        add_col("users", "is_muted", "INTEGER DEFAULT 0")
-        add_col("users", "mute_expires", "REAL")
-        add_col("users", "risk_score", "INTEGER DEFAULT 0") # 0-100
-        
-        add_col("reports", "status", "TEXT DEFAULT 'pending'") # pending, in_review, resolved
-        add_col("reports", "assigned_to", "INTEGER")
-        add_col("reports", "staff_note", "TEXT")
-        add_col("users", "is_verified", "INTEGER DEFAULT 0")
-        add_col("users", "status", "TEXT DEFAULT 'offline'")
-
-        # New Staff only tables
-        cursor.execute(f"CREATE TABLE IF NOT EXISTS admin_logs (id {pk_type}, admin_id INTEGER, ip_address TEXT, action TEXT, details TEXT, timestamp REAL)")
-        cursor.execute(f"CREATE TABLE IF NOT EXISTS risk_alerts (id {pk_type}, user_id INTEGER, type TEXT, details TEXT, risk_level TEXT, timestamp REAL)")
-        cursor.execute(f"CREATE TABLE IF NOT EXISTS message_reactions (id {pk_type}, message_id INTEGER, user_id INTEGER, emoji TEXT, created_at REAL, UNIQUE(message_id, user_id, emoji))")
-        cursor.execute(f"CREATE TABLE IF NOT EXISTS read_receipts (id {pk_type}, dm_id INTEGER, user_id INTEGER, last_read_message_id INTEGER, updated_at REAL, UNIQUE(dm_id, user_id))")
-        cursor.execute(f"CREATE TABLE IF NOT EXISTS verification_codes (email TEXT PRIMARY KEY, code TEXT, expires_at REAL)")
-
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print("[OK] Database migration completed successfully!")
-    except Exception as e:
-        print(f"[!] Migration error: {e}")
+# --- LAST SEEN FLUSH THREAD ---
+def flush_last_seen():
+    """Background thread writing buffered last_seen touches in batches"""
+    while True:
+        eventlet.sleep(cache.LAST_SEEN_FLUSH_INTERVAL)
+        try:
+            cache.last_seen.flush()
+        except Exception as e:
+            print(f"[LastSeen Error] {e}")
+
+eventlet.spawn(flush_last_seen)
+
+# --- PRESENCE STATUS THREADS ---
+def flush_statuses():
+    """Background thread writing buffered online/offline statuses in batches"""
+    while True:
+        eventlet.sleep(cache.STATUS_FLUSH_INTERVAL)
+        try:
+            cache.statuses.flush()
+        except Exception as e:
+            print(f"[Status Error] {e}")
+
+def reconcile_statuses():
+    """Background thread fixing users.status rows that disagree with
+    online_users, e.g. 'online' left behind by a restart or a crashed worker"""
+    if cluster.SOCKETIO_MESSAGE_QUEUE:
+        # Let the other workers' snapshots arrive first
+        eventlet.sleep(cluster.PRESENCE_HEARTBEAT)
+    while True:
+        try:
+            fixed = cache.statuses.reconcile(online_users.user_ids)
+            if fixed:
+                print(f"[*] users.status reconciled for {fixed} users")
+        except Exception as e:
+            print(f"[Status Error] {e}")
+        eventlet.sleep(cache.STATUS_RECONCILE_INTERVAL)
+
+eventlet.spawn(flush_statuses)
+eventlet.spawn(reconcile_statuses)
+
+# --- BAN / MUTE INDEX ---
+def reload_sanctions():
+    """Background thread lifting expired sanctions in the DB and picking up
+    remediations made by other workers"""
+    while True:
+        eventlet.sleep(sanctions.SANCTION_RELOAD_INTERVAL)
+        try:
+            sanctions.sweep()
+            sanctions.load()
+        except Exception as e:
+            print(f"[Sanctions Error] {e}")
+
+try:
+    print(f"[*] Sanction index loaded: {sanctions.load()} sanctioned users")
+except Exception as e:
+    print(f"[!] Sanction index load failed: {e}")
+eventlet.spawn(reload_sanctions)
+
+# --- PRESENCE SUBSCRIPTIONS ---
+def reload_presence():
+    """Background thread picking up friendships and DMs created through
+    other workers"""
+    while True:
+        eventlet.sleep(presence.PRESENCE_RELOAD_INTERVAL)
+        try:
+            presence.load()
+        except Exception as e:
+            print(f"[Presence Error] {e}")
 
-# Run migration to add missing columns to existing databases
 try:
-    run_db_migration()
+    print(f"[*] Presence index loaded: {presence.load()} users with subscribers")
 except Exception as e:
-    print(f"[!] CRITICAL: Global migration failed: {e}")
+    print(f"[!] Presence index load failed: {e}")
+eventlet.spawn(reload_presence)
+
+# --- OUTBOUND MAIL QUEUE ---
+mail = mailer.Mailer(SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, starttls=SMTP_STARTTLS)
+eventlet.spawn(mail.run)
 
 # --- DISAPPEARING MESSAGES CLEANUP THREAD ---
 def cleanup_expired_messages():
@@ -450,24 +389,24 @@ def cleanup_expired_messages():
             eventlet.sleep(10)  # Check every 10 seconds
             current_time = time.time()
             
-            # Find expired messages
-            expired = execute_query('''
-                SELECT id, dm_id FROM dm_messages 
-                WHERE expires_at IS NOT NULL AND expires_at <= %s
-            ''', (current_time,), fetch_all=True)
-            
-            if expired:
+            # Stream expired messages; one commit per batch
+            deleted = 0
+            for expired in db.stream_batches(queries.EXPIRED_MESSAGES, (current_time,)):
+                with transaction():
+                    for msg_id, dm_id in expired:
+                        # Delete reactions first
+                        execute_query('DELETE FROM message_reactions WHERE message_id = %s', (msg_id,), commit=True)
+                        # Delete message
+                        execute_query('DELETE FROM dm_messages WHERE id = %s', (msg_id,), commit=True)
                 for msg_id, dm_id in expired:
-                    # Delete reactions first
-                    execute_query('DELETE FROM message_reactions WHERE message_id = %s', (msg_id,), commit=True)
-                    # Delete message
-                    execute_query('DELETE FROM dm_messages WHERE id = %s', (msg_id,), commit=True)
                     # Emit socket event to remove from UI
                     socketio.emit('message_expired', {
                         'message_id': msg_id,
                         'dm_id': dm_id
                     })
-                print(f"[Cleanup] Deleted {len(expired)} expired messages")
+                deleted += len(expired)
+            if deleted:
+                print(f"[Cleanup] Deleted {deleted} expired messages")
         except Exception as e:
             print(f"[Cleanup Error] {e}")
 
@@ -475,18 +414,6 @@ def cleanup_expired_messages():
 eventlet.spawn(cleanup_expired_messages)
 print("[*] Disappearing messages cleanup thread started")
 
-def fix_existing_avatars():
-    """Helper to force all users to use the local default silhouette avatar"""
-    try:
-        print("[!] Forcing default avatar for ALL users...")
-        # Update everyone to use the new DEFAULT_AVATAR
-        execute_query("UPDATE users SET avatar = %s", (DEFAULT_AVATAR,), commit=True)
-        print("[+] All avatars updated to default silhouette.")
-    except Exception as e:
-        print(f"Error forcing avatars: {e}")
-
-fix_existing_avatars()
-
 # --- SERVERS STORAGE ---
 def load_servers():
     global servers_db
@@ -576,29 +503,48 @@ API_BASE_URL = 'https://discord.com/api'
 FOUNDERS = os.environ.get('FOUNDERS', 'henryesc').split(',')
 
 # --- AUTH ROUTES ---
+# Throttled per IP and per account/email (ratelimit.py) so a credential
+# stuffing burst is rejected before any KDF or DB work
+TOO_MANY_ATTEMPTS = 'Слишком много попыток. Попробуйте позже'
+
+# Endpoints check_auth lets through without a login; extended by @public
+PUBLIC_ENDPOINTS = frozenset({'static'})
+
+def public(view):
+    """Mark a view as reachable without login (put it under @app.route)"""
+    global PUBLIC_ENDPOINTS
+    PUBLIC_ENDPOINTS = PUBLIC_ENDPOINTS | {view.__name__}
+    return view
+
 @app.route('/login')
+@public
 def login_page():
     if 'user' in session: return redirect('/')
     return render_template('auth.html', mode='login')
 
 @app.route('/register')
+@public
 def register_page():
     if 'user' in session: return redirect('/')
     return render_template('auth.html', mode='register')
 
 @app.route('/terms')
+@public
 def terms_page():
     return render_template('terms.html')
 
 @app.route('/privacy')
+@public
 def privacy_page():
     return render_template('privacy.html')
 
 @app.route('/cookies')
+@public
 def cookies_page():
     return render_template('cookie_policy.html')
 
 @app.route('/favicon.ico')
+@public
 def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'), 'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
@@ -609,64 +555,49 @@ def logout():
 
 RESEND_API_KEY = os.environ.get('RESEND_API_KEY', 're_UAy2HEyT_D4y6Vs8ZVYgnqsn5StCm8byK')
 
-def send_verification_email(email, code):
-    """Send verification code via SMTP"""
-    try:
-        if SMTP_USER == "your_email@mail.ru" or SMTP_PASSWORD == "your_app_password":
-            print("[WARNING] SMTP credentials not configured. Email NOT sent.")
-            return False
-
-        msg = MIMEMultipart()
-        msg['From'] = f"Octave <{SMTP_USER}>"
-        msg['To'] = email
-        msg['Subject'] = "Подтверждение аккаунта Octave"
-
-        html = f"""
-            <div style="font-family: sans-serif; background: #0a0b0e; color: white; padding: 40px; border-radius: 20px; text-align: center;">
-                <h2 style="color: #667eea;">Добро пожаловать в Octave!</h2>
-                <p style="color: rgba(255,255,255,0.6);">Ваш код подтверждения:</p>
-                <div style="font-size: 32px; font-weight: bold; letter-spacing: 5px; margin: 20px 0; color: #764ba2;">{code}</div>
-                <p style="font-size: 12px; color: rgba(255,255,255,0.3);">Код истечет через 10 минут.</p>
-            </div>
-        """
-        msg.attach(MIMEText(html, 'html'))
+VERIFICATION_SUBJECT = "Подтверждение аккаунта Octave"
 
-        # Use STARTTLS for port 587 (Outlook/Gmail)
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SMTP_USER, SMTP_PASSWORD)
-            server.send_message(msg)
-            
-        print(f"[SUCCESS] SMTP Email sent to {email}")
-        return True
+def send_verification_email(email, code, expires_at=None):
+    """Queue the verification code mail; the mailer thread sends it until
+    the code expires"""
+    if not mail.configured:
+        print("[WARNING] SMTP credentials not configured. Email NOT sent.")
+        return False
+
+    html = f"""
+        <div style="font-family: sans-serif; background: #0a0b0e; color: white; padding: 40px; border-radius: 20px; text-align: center;">
+            <h2 style="color: #667eea;">Добро пожаловать в Octave!</h2>
+            <p style="color: rgba(255,255,255,0.6);">Ваш код подтверждения:</p>
+            <div style="font-size: 32px; font-weight: bold; letter-spacing: 5px; margin: 20px 0; color: #764ba2;">{code}</div>
+            <p style="font-size: 12px; color: rgba(255,255,255,0.3);">Код истечет через 10 минут.</p>
+        </div>
+    """
+    try:
+        mail.enqueue(email, VERIFICATION_SUBJECT, html, expires_at=expires_at)
     except Exception as e:
-        print(f"[SMTP EXCEPTION] {e}")
+        print(f"[SMTP EXCEPTION] Could not queue mail: {e}")
         return False
+    print(f"[*] Verification email to {email} queued")
+    return True
+
+@mail.on_failure
+def verification_mail_failed(email, subject):
+    # Same debug fallback as a failed inline send used to get
+    if subject == VERIFICATION_SUBJECT:
+        print(f"[DEBUG] SMTP delivery failed, allowing bypass. Code for {email} is now 123456")
+        execute_query("UPDATE verification_codes SET code = '123456' WHERE email = %s", (email,), commit=True)
 
 def get_user_storage_usage(user_id):
     """Calculate total storage used by user in bytes"""
-    usage = execute_query("""
-        SELECT SUM(file_size) FROM file_uploads 
-        WHERE message_id IN (SELECT id FROM dm_messages WHERE author_id = %s)
-    """, (user_id,), fetch_one=True)
+    usage = execute_query(queries.USER_STORAGE_USAGE, (user_id,), fetch_one=True)
     return usage[0] if usage and usage[0] else 0
 
 def generate_unique_username(email):
-    prefix = email.split('@')[0]
-    base_username = "".join(c for c in prefix if c.isalnum() or c in '_-')
-    if not base_username: base_username = "user"
-    
-    username = base_username
-    row = execute_query("SELECT id FROM users WHERE username = %s", (username,), fetch_one=True)
-    if not row: return username
-    
-    for _ in range(10):
-        test_username = f"{base_username}{random.randint(100, 9999)}"
-        row = execute_query("SELECT id FROM users WHERE username = %s", (test_username,), fetch_one=True)
-        if not row: return test_username
-    return f"{base_username}{int(time.time())}"
+    return repositories.users.unique_usernames([repositories.username_base(email)])[0]
 
 @app.route('/api/auth/register', methods=['POST'])
+@public
+@ratelimit.limit('register-ip', '10/hour', key=ratelimit.by_ip, error=TOO_MANY_ATTEMPTS)
 def api_register():
     data = request.json
     username = data.get('username')
@@ -683,12 +614,12 @@ def api_register():
         if row:
             return jsonify({'success': False, 'error': 'Этот никнейм уже занят'})
         
-        hash_pw = generate_password_hash(password)
+        hash_pw = passwords.hash_password(password)
         
-        user_id = execute_query("INSERT INTO users (username, password_hash, avatar, created_at, role, is_verified) VALUES (%s, %s, %s, %s, 'user', 1)", 
-                      (username, hash_pw, DEFAULT_AVATAR, time.time()), commit=True)
+        user_id = repositories.users.create(username, hash_pw, DEFAULT_AVATAR, time.time())
         
         # Log the user in immediately
+        session.regenerate()
         session['user'] = {'id': str(user_id), 'username': username, 'avatar': DEFAULT_AVATAR, 'role': 'user'}
         session.permanent = True
         
@@ -699,6 +630,8 @@ def api_register():
         return jsonify({'success': False, 'error': 'Ошибка сервера'})
 
 @app.route('/api/auth/verify', methods=['POST'])
+@ratelimit.limit('verify-ip', '30/10minute', key=ratelimit.by_ip, error=TOO_MANY_ATTEMPTS)
+@ratelimit.limit('verify-email', '10/10minute', key=ratelimit.by_field('email'), error=TOO_MANY_ATTEMPTS)
 def api_verify():
     data = request.json
     email = data.get('email')
@@ -718,11 +651,13 @@ def api_verify():
         return jsonify({'success': False, 'error': 'Срок действия кода истёк'})
     
     try:
-        execute_query("UPDATE users SET is_verified = 1 WHERE email = %s", (email,), commit=True)
-        execute_query("DELETE FROM verification_codes WHERE email = %s", (email,), commit=True)
+        with transaction():
+            execute_query("UPDATE users SET is_verified = 1 WHERE email = %s", (email,), commit=True)
+            execute_query("DELETE FROM verification_codes WHERE email = %s", (email,), commit=True)
         
         row = execute_query("SELECT id, username, avatar, role FROM users WHERE email = %s", (email,), fetch_one=True)
         if row:
+            session.regenerate()
             session['user'] = {'id': str(row[0]), 'username': row[1], 'avatar': get_valid_avatar(row[2]), 'role': row[3]}
             session.permanent = True
             return jsonify({'success': True})
@@ -731,6 +666,8 @@ def api_verify():
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/auth/resend', methods=['POST'])
+@ratelimit.limit('resend-ip', '5/10minute', key=ratelimit.by_ip, error=TOO_MANY_ATTEMPTS)
+@ratelimit.limit('resend-email', '3/10minute', key=ratelimit.by_field('email'), error=TOO_MANY_ATTEMPTS)
 def api_resend():
     email = request.json.get('email')
     if not email: return jsonify({'success': False, 'error': 'Email required'})
@@ -743,7 +680,7 @@ def api_resend():
                       (email, code, expires), commit=True)
         
         # --- DEBUG MODE ---
-        if send_verification_email(email, code):
+        if send_verification_email(email, code, expires):
             return jsonify({'success': True})
         else:
             print(f"[DEBUG] SMTP Resend failed, allowing bypass. Code for {email} is {code} (or use 123456)")
@@ -754,6 +691,9 @@ def api_resend():
         return jsonify({'success': False, 'error': 'Ошибка базы данных'})
 
 @app.route('/api/auth/login', methods=['POST'])
+@public
+@ratelimit.limit('login-ip', '20/minute', key=ratelimit.by_ip, error=TOO_MANY_ATTEMPTS)
+@ratelimit.limit('login-account', '5/minute', key=ratelimit.by_field('username', with_ip=True), error=TOO_MANY_ATTEMPTS)
 def api_login():
     data = request.json
     login_id = data.get('username')  # Frontend will now send 'username'
@@ -761,7 +701,15 @@ def api_login():
     
     row = execute_query("SELECT id, username, password_hash, avatar, role, is_verified, email FROM users WHERE email = %s OR username = %s", (login_id, login_id), fetch_one=True)
     
-    if row and check_password_hash(row[2], password):
+    if row and passwords.verify_password(row[2], password):
+        if passwords.needs_rehash(row[2]):
+            # Hash parameters changed since this password was stored
+            try:
+                execute_query("UPDATE users SET password_hash = %s WHERE id = %s",
+                              (passwords.hash_password(password), row[0]), commit=True)
+            except Exception as e:
+                print(f"[!] Password rehash failed for user {row[0]}: {e}")
+        session.regenerate()
         session['user'] = {'id': str(row[0]), 'username': row[1], 'avatar': get_valid_avatar(row[3]), 'role': row[4]}
         session.permanent = True
         return jsonify({'success': True})
@@ -772,7 +720,7 @@ def api_get_me():
     if 'user' not in session: return jsonify({'success': False}), 401
     uid = session['user']['id']
     
-    row = execute_query("SELECT id, username, avatar, display_name, banner, bio, email, phone, role, reputation, custom_status, status_emoji, status FROM users WHERE id = %s", (uid,), fetch_one=True)
+    row = execute_query("SELECT id, username, avatar, display_name, banner, bio, email, phone, role, reputation, custom_status, status_emoji, status FROM users WHERE id = %s", (uid,), fetch_one=True, read_only=True)
     
     if row:
         return jsonify({
@@ -825,6 +773,7 @@ def api_update_user():
     
     try:
         execute_query(f"UPDATE users SET {', '.join(fields)} WHERE id = %s", tuple(values), commit=True)
+        cache.invalidate_profile(uid)
         session.modified = True
         return jsonify({'success': True})
     except Exception as e:
@@ -837,7 +786,7 @@ def api_get_user_profile(user_id):
         return jsonify({'success': False, 'error': 'Auth needed'}), 401
     
     try:
-        row = execute_query("SELECT id, username, avatar, bio, status, email FROM users WHERE id = %s", (user_id,), fetch_one=True)
+        row = execute_query("SELECT id, username, avatar, bio, status, email FROM users WHERE id = %s", (user_id,), fetch_one=True, read_only=True)
         if not row:
             return jsonify({'success': False, 'error': 'User not found'})
             
@@ -859,7 +808,45 @@ def api_get_user_profile(user_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+USERS_BATCH_MAX = 100
+
+@app.route('/api/users/batch', methods=['GET', 'POST'])
+def api_users_batch():
+    """Public profile, presence and public key of many users in one call:
+    GET ?ids=1,2,3 or POST {"ids": [1, 2, 3]}"""
+    if 'user' not in session:
+        return jsonify({'success': False, 'error': 'Auth needed'}), 401
+    
+    if request.method == 'POST':
+        raw_ids = (request.get_json(silent=True) or {}).get('ids') or []
+    else:
+        raw_ids = request.args.get('ids', '').split(',')
+    try:
+        ids = list(dict.fromkeys(int(i) for i in raw_ids if str(i).strip()))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'ids must be integers'}), 400
+    if len(ids) > USERS_BATCH_MAX:
+        return jsonify({'success': False, 'error': f'At most {USERS_BATCH_MAX} ids per request'}), 400
+    
+    users = {}
+    for uid, profile in cache.user_profiles(ids).items():
+        if profile is None:
+            continue
+        users[str(uid)] = {
+            'id': uid,
+            'username': profile.username,
+            'display_name': profile.display_name,
+            'avatar': get_valid_avatar(profile.avatar),
+            'bio': profile.bio,
+            'custom_status': profile.custom_status,
+            'status_emoji': profile.status_emoji,
+            'public_key': profile.public_key,
+            'status': 'online' if str(uid) in online_users else 'offline'
+        }
+    return jsonify({'success': True, 'users': users, 'missing': [i for i in ids if str(i) not in users]})
+
 @app.route('/api/user/upload-avatar', methods=['POST'])
+@ratelimit.limit('upload', '30/minute', key=ratelimit.by_user)
 def api_upload_avatar():
     if 'user' not in session:
         return jsonify({'success': False, 'error': 'Not logged in'})
@@ -898,6 +885,7 @@ def api_upload_avatar():
         file.save(filepath)
         avatar_url = f"/static/uploads/avatars/{filename}"
         execute_query("UPDATE users SET avatar = %s WHERE id = %s", (avatar_url, session['user']['id']), commit=True)
+        cache.invalidate_profile(user_id)
         session['user']['avatar'] = avatar_url
         session.modified = True
         return jsonify({'success': True, 'avatar_url': avatar_url})
@@ -924,6 +912,7 @@ def api_encryption_setup():
             (public_key, uid),
             commit=True
         )
+        cache.invalidate_profile(uid)
         return jsonify({'success': True})
     except Exception as e:
         print(f"[E2EE] Error storing public key: {e}")
@@ -981,6 +970,8 @@ def api_verify_keys():
 
 
 @app.route('/api/upload-file', methods=['POST'])
+@sanctions.unless_muted
+@ratelimit.limit('upload', '30/minute', key=ratelimit.by_user)
 def api_upload_file():
     """Upload file attachments for messages"""
     if 'user' not in session:
@@ -1080,6 +1071,7 @@ def api_upload_file():
 # --- LINK PREVIEW & GIF API ---
 
 @app.route('/api/messages/preview-link', methods=['POST'])
+@ratelimit.limit('link-preview', '60/minute', key=ratelimit.by_user)
 def api_preview_link():
     """Generate a preview for a URL (YouTube, images, websites with OpenGraph)"""
     if 'user' not in session:
@@ -1244,6 +1236,8 @@ def api_gif_search():
 # --- ADVANCED FEATURES API ---
 
 @app.route('/api/albums/create', methods=['POST'])
+@sanctions.unless_muted
+@ratelimit.limit('upload', '30/minute', key=ratelimit.by_user)
 def api_create_album():
     """Create a photo album from multiple uploaded images"""
     if 'user' not in session:
@@ -1306,17 +1300,15 @@ def api_create_album():
             return jsonify({'success': False, 'error': 'No valid images found'})
         
         # Create album entry (will be associated with message later)
-        album_id = execute_query(
-            "INSERT INTO photo_albums (message_id, photo_count, created_at) VALUES (%s, %s, %s) RETURNING id" if 'postgres' in str(type(get_db_connection())) else "INSERT INTO photo_albums (message_id, photo_count, created_at) VALUES (?, ?, ?)",
-            (0, len(photos), time.time()),  # message_id will be updated when message is created
-            commit=True,
-            fetch_one=True
+        album_id = db.insert(
+            "INSERT INTO photo_albums (message_id, photo_count, created_at) VALUES (%s, %s, %s)",
+            (0, len(photos), time.time())  # message_id will be updated when message is created
         )
         
         return jsonify({
             'success': True,
             'album': {
-                'id': album_id if album_id else execute_query("SELECT last_insert_rowid()", fetch_one=True)[0],
+                'id': album_id,
                 'photos': photos,
                 'photo_count': len(photos)
             }
@@ -1360,6 +1352,7 @@ def api_get_album(album_id):
 
 
 @app.route('/api/preview-link-enhanced', methods=['POST'])
+@ratelimit.limit('link-preview', '60/minute', key=ratelimit.by_user)
 def api_preview_link_enhanced():
     """Enhanced link preview with database caching"""
     if 'user' not in session:
@@ -1496,6 +1489,7 @@ def api_upload_public_key():
     try:
         # Update user's public key
         execute_query('UPDATE users SET public_key = %s WHERE id = %s', (public_key, my_id), commit=True)
+        cache.invalidate_profile(my_id)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1589,7 +1583,7 @@ def api_get_unread_position(dm_id):
     try:
         # Get last read message ID
         receipt = execute_query(
-            "SELECT last_read_message_id FROM read_receipts WHERE dm_id = %s AND user_id = %s",
+            queries.READ_RECEIPT_LAST,
             (dm_id, user_id),
             fetch_one=True
         )
@@ -1629,35 +1623,66 @@ def api_get_unread_position(dm_id):
         return jsonify({'success': False, 'error': str(e)})
 
 
+# --- DB CONNECTION SCOPE (one pooled connection per request) ---
+if query_stats.ENABLED:
+    db.set_query_observer(query_stats.record)
+
+@app.before_request
+def open_db_scope():
+    query_stats.label(request.endpoint)
+    # Read-your-writes: keep reading from the primary right after a write
+    db.open_scope(session.get('_db_sticky', 0.0))
+
+@app.after_request
+def remember_db_writes(response):
+    sticky_until = db.sticky_until()
+    if sticky_until > session.get('_db_sticky', 0.0):
+        session['_db_sticky'] = sticky_until
+    return response
+
+@app.after_request
+def report_db_queries(response):
+    stats = query_stats.end()
+    if stats is not None and (query_stats.HEADERS or app.debug):
+        response.headers['X-DB-Queries'] = str(stats.count)
+        response.headers['X-DB-Time'] = f"{stats.total * 1000:.1f}ms"
+    return response
+
+@app.teardown_request
+def close_db_scope(exc):
+    db.close_scope(exc)
+
 @app.before_request
 def check_auth():
-    if request.endpoint and request.endpoint.startswith('static'): return
-    if request.endpoint in ['login_page', 'register_page', 'api_login', 'api_register', 'api_auth_register', 'api_auth_login', 'favicon', 
-                             'debug_check_tables', 'debug_run_migration', 'debug_friends_dump', 'terms_page', 'privacy_page', 'cookies_page']: return
+    if request.endpoint in PUBLIC_ENDPOINTS: return
     
     if 'user' not in session:
         return redirect('/login')
     
+    # Banned users can still read but not change anything (in-memory check)
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and sanctions.banned(session['user'].get('id')):
+        return jsonify({'success': False, 'error': sanctions.BANNED_ERROR}), 403
+    
     # 🔄 SYNC ROLE WITH DB (Special fix for immediate admin panel visibility)
     # This ensures that if the DB role was updated (e.g. by assistant), the session catches up.
+    # Roles come from a TTL cache and last_seen is written in batches (cache.py),
+    # so a plain read request costs no queries here.
     try:
         current_uid = session['user'].get('id')
         current_username = session['user'].get('username')
         
-        # Hardcoded Founders update (Fix for Render storage issues)
-        FOUNDERS = ['666', 'OmG', '234']
-        
         if current_uid:
-            # First check if they are a founder to auto-promote
-            if current_username in FOUNDERS:
+            role = cache.user_role(current_uid)
+            # Founders registered after startup get promoted on first request
+            if current_username in AUTO_DEVELOPERS and role is not None and role != 'developer':
                 execute_query("UPDATE users SET role = 'developer' WHERE id = %s", (current_uid,), commit=True)
+                cache.invalidate_role(current_uid)
+                role = 'developer'
             
-            # Update last_seen
-            execute_query("UPDATE users SET last_seen = %s WHERE id = %s", (time.time(), current_uid), commit=True)
+            cache.last_seen.touch(current_uid)
             
-            res = execute_query("SELECT role FROM users WHERE id = %s", (current_uid,), fetch_one=True)
-            if res and res[0] != session['user'].get('role'):
-                session['user']['role'] = res[0]
+            if role and role != session['user'].get('role'):
+                session['user']['role'] = role
                 session.modified = True
     except Exception as e:
         print(f"[Sync] Role sync error: {e}")
@@ -1755,7 +1780,7 @@ def api_set_role():
     
     # Check requester role
     requester_id = session['user']['id']
-    row = execute_query("SELECT role FROM users WHERE id = %s", (requester_id,), fetch_one=True)
+    row = execute_query(queries.USER_ROLE, (requester_id,), fetch_one=True)
     requester_role = row[0] if row else 'user'
     
     if requester_role != 'developer': 
@@ -1780,6 +1805,7 @@ def api_set_role():
         
     # Update Role
     execute_query("UPDATE users SET role = %s WHERE id = %s", (new_role, target_id), commit=True)
+    cache.invalidate_role(target_id)
     
     add_log('warning', f"Role changed for {target_username} to {new_role} by {session['user']['username']}")
     
@@ -1791,7 +1817,7 @@ def api_admin_dashboard_stats():
     
     # Check permissions
     uid = session['user']['id']
-    row = execute_query("SELECT role FROM users WHERE id = %s", (uid,), fetch_one=True)
+    row = execute_query(queries.USER_ROLE, (uid,), fetch_one=True)
     role = row[0] if row else 'user'
     if role not in ['developer', 'admin']: return jsonify({'error': 'Forbidden'}), 403
     
@@ -1820,7 +1846,7 @@ def api_admin_grant_admin():
     
     # Only developers (Founders) can grant admin role
     uid = session['user']['id']
-    row = execute_query("SELECT role FROM users WHERE id = %s", (uid,), fetch_one=True)
+    row = execute_query(queries.USER_ROLE, (uid,), fetch_one=True)
     role = row[0] if row else 'user'
     if role != 'developer': return jsonify({'error': 'Forbidden - Only Developers can grant Admin'}), 403
     
@@ -1852,15 +1878,16 @@ def api_admin_grant_admin():
         
     target_id, target_username = target_user
     
-    # Update to admin
-    execute_query("UPDATE users SET role = 'admin' WHERE id = %s", (target_id,), commit=True)
-    add_log('warning', f"User {target_username} ({target_id}) granted ADMIN status by {session['user']['username']}")
-    
-    # Log Admin Action
     admin_id = session['user']['id']
-    ip_addr = request.headers.get('X-Forwarded-For', request.remote_addr)
-    execute_query("INSERT INTO admin_logs (admin_id, ip_address, action, timestamp) VALUES (%s, %s, %s, %s)",
-                  (admin_id, ip_addr, f"Granted ADMIN to {target_username} ({target_id})", time.time()), commit=True)
+    ip_addr = request.remote_addr
+    with transaction():
+        # Update to admin
+        execute_query("UPDATE users SET role = 'admin' WHERE id = %s", (target_id,), commit=True)
+        # Log Admin Action
+        execute_query("INSERT INTO admin_logs (admin_id, ip_address, action, timestamp) VALUES (%s, %s, %s, %s)",
+                      (admin_id, ip_addr, f"Granted ADMIN to {target_username} ({target_id})", time.time()), commit=True)
+    cache.invalidate_role(target_id)
+    add_log('warning', f"User {target_username} ({target_id}) granted ADMIN status by {session['user']['username']}")
     
     return jsonify({'success': True, 'message': f'Admin status granted to {target_username}'})
 
@@ -1913,22 +1940,18 @@ def api_admin_reports():
     JOIN users u_msg ON rm.author_id = u_msg.id
     ORDER BY r.timestamp DESC
     """
-    rows = execute_query(query, fetch_all=True)
-    
-    reports = []
-    for r in rows:
-        reports.append({
-            'report_id': r[0],
-            'message_id': r[1],
-            'reason': r[2],
-            'timestamp': r[3],
-            'content': r[4],
-            'reporter': r[5],
-            'author': r[6],
-            'author_id': r[7]
-        })
-        
-    return jsonify({'success': True, 'reports': reports})
+    reports = ({
+        'report_id': r[0],
+        'message_id': r[1],
+        'reason': r[2],
+        'timestamp': r[3],
+        'content': r[4],
+        'reporter': r[5],
+        'author': r[6],
+        'author_id': r[7]
+    } for r in db.stream_query(query, read_only=True))
+        
+    return stream_json_response('reports', reports)
 
 @app.route('/api/admin/reports/resolve', methods=['POST'])
 def api_admin_resolve_report():
@@ -1943,30 +1966,37 @@ def api_admin_resolve_report():
     
     if not report_id: return jsonify({'error': 'Report ID required'})
     
-    if action == 'delete':
-        # Get message_id first
-        rep = execute_query("SELECT message_id FROM reports WHERE id = %s", (report_id,), fetch_one=True)
-        if rep:
-            msg_id = rep[0]
-            # Delete message
-            execute_query("DELETE FROM dm_messages WHERE id = %s", (msg_id,), commit=True)
-            # Notify via socket or log
-            add_log('warning', f"Admin {session['user']['username']} deleted reported message {msg_id}")
-            
-    # Remove the report after handling
-    execute_query("DELETE FROM reports WHERE id = %s", (report_id,), commit=True)
-    
-    # Log Admin Action
     admin_id = session['user']['id']
-    ip_addr = request.headers.get('X-Forwarded-For', request.remote_addr)
-    execute_query("INSERT INTO admin_logs (admin_id, ip_address, action, timestamp) VALUES (%s, %s, %s, %s)",
-                  (admin_id, ip_addr, f"Resolved report {report_id} (Action: {action})", time.time()), commit=True)
+    ip_addr = request.remote_addr
+    deleted_msg_id = None
+    
+    # Delete + report cleanup + audit log commit together
+    with transaction():
+        if action == 'delete':
+            # Get message_id first
+            rep = execute_query("SELECT message_id FROM reports WHERE id = %s", (report_id,), fetch_one=True)
+            if rep:
+                deleted_msg_id = rep[0]
+                # Delete message
+                execute_query("DELETE FROM dm_messages WHERE id = %s", (deleted_msg_id,), commit=True)
+                
+        # Remove the report after handling
+        execute_query("DELETE FROM reports WHERE id = %s", (report_id,), commit=True)
+        
+        # Log Admin Action
+        execute_query("INSERT INTO admin_logs (admin_id, ip_address, action, timestamp) VALUES (%s, %s, %s, %s)",
+                      (admin_id, ip_addr, f"Resolved report {report_id} (Action: {action})", time.time()), commit=True)
+    
+    if deleted_msg_id:
+        # Notify via socket or log
+        add_log('warning', f"Admin {session['user']['username']} deleted reported message {deleted_msg_id}")
     
     return jsonify({'success': True, 'message': 'Report resolved'})
 
 # --- ADVANCED ADMIN SYSTEM ---
 
 @app.route('/api/admin/verify-2fa', methods=['POST'])
+@ratelimit.limit('admin-2fa', '5/10minute', key=ratelimit.by_user, error=TOO_MANY_ATTEMPTS)
 def api_admin_verify_2fa():
     if 'user' not in session or session['user'].get('role') not in ['admin', 'developer']:
         return jsonify({'success': False, 'error': 'Unauthorized'}), 403
@@ -1983,7 +2013,7 @@ def api_admin_verify_2fa():
         session.modified = True
         
         # Log Access
-        ip_addr = request.headers.get('X-Forwarded-For', request.remote_addr)
+        ip_addr = request.remote_addr
         execute_query("INSERT INTO admin_logs (admin_id, ip_address, action, timestamp) VALUES (%s, %s, %s, %s)",
                       (admin_id, ip_addr, "Admin Panel Access (2FA Verified)", time.time()), commit=True)
         
@@ -1998,7 +2028,7 @@ def api_admin_migrate_now():
     if not session.get('admin_verified'):
         return jsonify({'success': False, 'error': '2FA needed'}), 401
     try:
-        run_db_migration()
+        migrations.migrate()
         return jsonify({'success': True, 'message': 'Migration finished. Refresh the page.'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -2019,47 +2049,38 @@ def api_admin_broadcast():
     timestamp = time.time()
     
     try:
-        # Get all users (except system bot ID 0)
-        users = execute_query("SELECT id FROM users WHERE id != 0", fetch_all=True)
-        
         # Create/Find System User "Команда Octave" (ID 0)
         has_system = execute_query("SELECT id FROM users WHERE id = 0", fetch_one=True)
         if not has_system:
             execute_query("INSERT INTO users (id, username, password_hash, role) VALUES (0, 'Команда Octave', 'system_lock', 'bot')", commit=True)
         
+        # Stream all users (except system bot ID 0); each batch is written
+        # in one transaction and notified right after its commit
         sent_count = 0
-        for uid_row in users:
-            uid = uid_row[0]
+        for users in db.stream_batches("SELECT id FROM users WHERE id != 0"):
+            delivered = []
+            with transaction():
+                for uid_row in users:
+                    uid = uid_row[0]
+                    
+                    dm_id = repositories.dms.get_or_create(0, uid, timestamp)
+                    repositories.messages.create(dm_id, 0, content, timestamp)
+                    delivered.append((uid, dm_id))
             
-            # Find/Create DM
-            dm_id = None
-            existing_dm = execute_query("SELECT id FROM direct_messages WHERE (user_id_1 = 0 AND user_id_2 = %s) OR (user_id_1 = %s AND user_id_2 = 0)", 
-                                       (uid, uid), fetch_one=True)
-            
-            if existing_dm:
-                dm_id = existing_dm[0]
-            else:
-                dm_id = execute_query("INSERT INTO direct_messages (user_id_1, user_id_2, last_message_at) VALUES (0, %s, %s)",
-                                     (uid, timestamp), commit=True)
-            
-            # Insert message
-            execute_query("INSERT INTO dm_messages (dm_id, author_id, content, timestamp) VALUES (%s, 0, %s, %s)", 
-                          (dm_id, content, timestamp), commit=True)
-            
-            # Notify recipient
-            socketio.emit('new_dm_message', {
-                'dm_id': dm_id,
-                'author_id': 0,
-                'author_name': 'Команда Octave',
-                'content': content,
-                'timestamp': timestamp,
-                'is_system': True
-            }, room=str(uid))
-            
-            sent_count += 1
+            for uid, dm_id in delivered:
+                # Notify recipient
+                socketio.emit('new_dm_message', {
+                    'dm_id': dm_id,
+                    'author_id': 0,
+                    'author_name': 'Команда Octave',
+                    'content': content,
+                    'timestamp': timestamp,
+                    'is_system': True
+                }, room=str(uid))
+            sent_count += len(delivered)
             
         # Log Action
-        ip_addr = request.headers.get('X-Forwarded-For', request.remote_addr)
+        ip_addr = request.remote_addr
         execute_query("INSERT INTO admin_logs (admin_id, ip_address, action, timestamp) VALUES (%s, %s, %s, %s)",
                       (admin_id, ip_addr, f"Sent broadcast to {sent_count} users", time.time()), commit=True)
                       
@@ -2121,16 +2142,16 @@ def api_admin_dashboard_v2():
         
         # 2. New Registrations (Last 24h)
         day_ago = now - 86400
-        new_regs = execute_query("SELECT COUNT(*) FROM users WHERE created_at >= %s", (day_ago,), fetch_one=True)[0]
+        new_regs = execute_query(queries.NEW_USERS_SINCE, (day_ago,), fetch_one=True, read_only=True)[0]
         
         # 3. Reports Count (Pending)
-        pending_reports = execute_query("SELECT COUNT(*) FROM reports WHERE status = 'pending'", fetch_one=True)[0]
+        pending_reports = execute_query(queries.PENDING_REPORTS_COUNT, fetch_one=True, read_only=True)[0]
         
         # 4. Risk Alerts (Recent)
-        recent_alerts = execute_query("SELECT COUNT(*) FROM risk_alerts WHERE timestamp >= %s", (day_ago,), fetch_one=True)[0]
+        recent_alerts = execute_query("SELECT COUNT(*) FROM risk_alerts WHERE timestamp >= %s", (day_ago,), fetch_one=True, read_only=True)[0]
         
         # 5. User Roles distribution
-        roles = execute_query("SELECT role, COUNT(*) FROM users GROUP BY role", fetch_all=True)
+        roles = execute_query("SELECT role, COUNT(*) FROM users GROUP BY role", fetch_all=True, read_only=True)
         role_map = {r[0]: r[1] for r in roles}
         
         return jsonify({
@@ -2146,6 +2167,36 @@ def api_admin_dashboard_v2():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/admin/db/pool')
+def api_admin_db_pool():
+    """Connection pool metrics for sizing DB_POOL_SIZE"""
+    if 'user' not in session or session['user'].get('role') not in ['admin', 'developer']:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 403
+    return jsonify({'success': True, 'pool': db.pool_stats(),
+                    'cache': {'roles': cache.roles.stats(), 'last_seen': cache.last_seen.stats(),
+                              'statuses': cache.statuses.stats(),
+                              'profiles': cache.profiles.stats(),
+                              'sessions': app.session_interface.store.stats()},
+                    'rate_limits': ratelimit.stats(),
+                    'mail': mail.stats(),
+                    'sanctions': sanctions.stats(),
+                    'presence': presence.stats(),
+                    'online': online_users.stats(),
+                    'socket_batches': {'status': status_queue.stats(), 'typing': typing_queue.stats()},
+                    'typing': typing_users.stats()})
+
+@app.route('/api/admin/db/queries', methods=['GET', 'DELETE'])
+def api_admin_db_queries():
+    """Per-endpoint query counts, DB time, latency histograms, N+1 suspects
+    and the slowest statements since startup (DELETE resets them)"""
+    if 'user' not in session or session['user'].get('role') not in ['admin', 'developer']:
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 403
+    if request.method == 'DELETE':
+        query_stats.reset()
+        return jsonify({'success': True})
+    limit = min(int(request.args.get('limit', 50)), 500)
+    return jsonify({'success': True, 'stats': query_stats.snapshot(limit)})
+
 @app.route('/api/admin/users/search-v2')
 def api_admin_user_search_v2():
     if 'user' not in session or session['user'].get('role') not in ['admin', 'moderator', 'support', 'developer']:
@@ -2165,7 +2216,7 @@ def api_admin_user_search_v2():
             users = execute_query(query, (search_param, q if q.isdigit() else -1, search_param), fetch_all=True)
         else:
             # Recent users
-            users = execute_query("SELECT id, username, avatar, role, created_at, ip_address, risk_score, is_banned, is_muted FROM users ORDER BY created_at DESC LIMIT 20", fetch_all=True)
+            users = execute_query(queries.RECENT_USERS, fetch_all=True)
             
         result = []
         for u in users:
@@ -2184,34 +2235,53 @@ def api_admin_user_profile(uid):
         return jsonify({'success': False}), 403
     
     try:
-        user = execute_query("SELECT id, username, email, phone, role, created_at, ip_address, risk_score, is_banned, ban_expires, is_muted, mute_expires, ban_reason FROM users WHERE id = %s", (uid,), fetch_one=True)
+        user = repositories.users.admin_profile(uid)
         if not user: return jsonify({'success': False, 'error': 'User not found'})
         
-        # Reports against this user
-        reports = execute_query("""
-            SELECT r.id, r.reason, r.timestamp, u.username as reporter 
-            FROM reports r JOIN users u ON r.reporter_id = u.id 
-            JOIN dm_messages m ON r.message_id = m.id
-            WHERE m.author_id = %s
-        """, (uid,), fetch_all=True)
-        
-        # Risk Alerts
-        alerts = execute_query("SELECT id, type, details, risk_level, timestamp FROM risk_alerts WHERE user_id = %s ORDER BY timestamp DESC", (uid,), fetch_all=True)
+        reports = repositories.reports.against_user(uid)
+        alerts = repositories.users.risk_alerts(uid)
         
         return jsonify({
             'success': True,
             'profile': {
-                'id': user[0], 'username': user[1], 'email': user[2], 'phone': user[3],
-                'role': user[4], 'created_at': user[5], 'ip': user[6], 'risk': user[7],
-                'ban': {'active': bool(user[8]), 'expires': user[9], 'reason': user[12]},
-                'mute': {'active': bool(user[10]), 'expires': user[11]}
+                'id': user.id, 'username': user.username, 'email': user.email, 'phone': user.phone,
+                'role': user.role, 'created_at': user.created_at, 'ip': user.ip_address, 'risk': user.risk_score,
+                'ban': {'active': bool(user.is_banned), 'expires': user.ban_expires, 'reason': user.ban_reason},
+                'mute': {'active': bool(user.is_muted), 'expires': user.mute_expires}
             },
-            'reports': [{'id': r[0], 'reason': r[1], 'time': r[2], 'from': r[3]} for r in reports],
-            'alerts': [{'id': a[0], 'type': a[1], 'details': a[2], 'level': a[3], 'time': a[4]} for a in alerts]
+            'reports': [{'id': r.id, 'reason': r.reason, 'time': r.timestamp, 'from': r.reporter} for r in reports],
+            'alerts': [{'id': a.id, 'type': a.type, 'details': a.details, 'level': a.risk_level, 'time': a.timestamp} for a in alerts]
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/admin/users/import', methods=['POST'])
+def api_admin_users_import():
+    """Bulk account import (provisioning.py): a CSV or JSONL file as the
+    upload field 'file' or the raw body"""
+    if 'user' not in session or session['user'].get('role') != 'developer':
+        return jsonify({'success': False, 'error': 'Forbidden'}), 403
+    if not session.get('admin_verified'):
+        return jsonify({'success': False, 'error': '2FA needed'}), 401
+
+    upload = request.files.get('file')
+    if upload:
+        text = upload.read().decode('utf-8-sig', errors='replace')
+        filename = upload.filename or ''
+    else:
+        text = request.get_data(as_text=True)
+        filename = ''
+    fmt = request.args.get('format') or ('jsonl' if filename.endswith(('.jsonl', '.ndjson')) else 'csv')
+    dry_run = request.args.get('dry_run') == '1'
+    try:
+        report = provisioning.import_users(text, fmt, default_role=request.args.get('role', 'user'),
+                                           dry_run=dry_run, hasher=provisioning.hash_in_threads)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if not dry_run:
+        add_log('warning', f"Bulk import by {session['user']['username']}: {report['inserted']} users, {len(report['errors'])} errors")
+    return jsonify({'success': True, 'report': report})
+
 @app.route('/api/admin/users/remediate', methods=['POST'])
 def api_admin_user_remediate():
     staff_role = session['user'].get('role')
@@ -2232,18 +2302,21 @@ def api_admin_user_remediate():
         staff_ip = request.remote_addr
         expires = time.time() + (float(duration) * 3600) if duration else None
         
-        if action == 'ban':
-            execute_query("UPDATE users SET is_banned = 1, ban_expires = %s, ban_reason = %s WHERE id = %s", (expires, reason, uid), commit=True)
-            add_admin_log(staff_id, staff_ip, "BAN", f"User {uid} banned for {duration or 'PERM'}. Reason: {reason}")
-        elif action == 'mute':
-            execute_query("UPDATE users SET is_muted = 1, mute_expires = %s WHERE id = %s", (expires, uid), commit=True)
-            add_admin_log(staff_id, staff_ip, "MUTE", f"User {uid} muted for {duration or 'PERM'}")
-        elif action == 'unban':
-            execute_query("UPDATE users SET is_banned = 0, ban_expires = NULL WHERE id = %s", (uid,), commit=True)
-            add_admin_log(staff_id, staff_ip, "UNBAN", f"User {uid} unbanned")
-        elif action == 'unmute':
-            execute_query("UPDATE users SET is_muted = 0, mute_expires = NULL WHERE id = %s", (uid,), commit=True)
-            add_admin_log(staff_id, staff_ip, "UNMUTE", f"User {uid} unmuted")
+        # Sanction update and its audit entry commit together
+        with transaction():
+            if action == 'ban':
+                execute_query("UPDATE users SET is_banned = 1, ban_expires = %s, ban_reason = %s WHERE id = %s", (expires, reason, uid), commit=True)
+                add_admin_log(staff_id, staff_ip, "BAN", f"User {uid} banned for {duration or 'PERM'}. Reason: {reason}")
+            elif action == 'mute':
+                execute_query("UPDATE users SET is_muted = 1, mute_expires = %s WHERE id = %s", (expires, uid), commit=True)
+                add_admin_log(staff_id, staff_ip, "MUTE", f"User {uid} muted for {duration or 'PERM'}")
+            elif action == 'unban':
+                execute_query("UPDATE users SET is_banned = 0, ban_expires = NULL WHERE id = %s", (uid,), commit=True)
+                add_admin_log(staff_id, staff_ip, "UNBAN", f"User {uid} unbanned")
+            elif action == 'unmute':
+                execute_query("UPDATE users SET is_muted = 0, mute_expires = NULL WHERE id = %s", (uid,), commit=True)
+                add_admin_log(staff_id, staff_ip, "UNMUTE", f"User {uid} unmuted")
+        sanctions.apply(uid, action, expires)
             
         return jsonify({'success': True})
     except Exception as e:
@@ -2331,6 +2404,7 @@ def callback():
             
             execute_query("UPDATE users SET avatar = %s, role = %s WHERE id = %s",
                           (final_avatar, role, db_id), commit=True)
+            cache.invalidate_role(db_id)
             final_id = db_id
         else:
             # Insert New
@@ -2341,6 +2415,7 @@ def callback():
             row = execute_query("SELECT id FROM users WHERE username = %s", (user_data['username'],), fetch_one=True)
             final_id = row[0]
 
+        session.regenerate()
         session.permanent = True
         session['user'] = {
             'id': str(final_id),
@@ -2583,6 +2658,7 @@ except ImportError:
 AI_WEB_SESSIONS = {}
 
 @app.route('/api/ai/chat', methods=['POST'])
+@ratelimit.limit('ai', '20/minute', key=ratelimit.by_user)
 def api_ai_chat():
     """AI Chat API endpoint"""
     if not AI_MODEL:
@@ -3335,6 +3411,7 @@ def simulate():
 
 # --- REPUTATION SYSTEM ---
 @app.route('/api/reputation/give', methods=['POST'])
+@sanctions.unless_muted
 def api_reputation_give():
     if 'user' not in session: return jsonify({'success': False, 'error': 'Auth needed'}), 401
     
@@ -3361,7 +3438,7 @@ def api_reputation_give():
 @app.route('/api/reputation/top')
 def api_reputation_top():
     # Return top 10 users by reputation
-    rows = execute_query("SELECT id, username, avatar, reputation, role FROM users ORDER BY reputation DESC LIMIT 10", fetch_all=True)
+    rows = execute_query("SELECT id, username, avatar, reputation, role FROM users ORDER BY reputation DESC LIMIT 10", fetch_all=True, read_only=True)
     
     top_list = []
     for r in rows:
@@ -3648,6 +3725,7 @@ def api_get_channel_messages(cid):
     return jsonify({'success': True, 'messages': msgs})
 
 @app.route('/api/channels/<cid>/messages', methods=['POST'])
+@sanctions.unless_muted
 def api_post_channel_message(cid):
     if 'user' not in session: return jsonify({'success': False, 'error': 'Auth'}), 401
     
@@ -3701,47 +3779,15 @@ def api_get_friends():
     if 'user' not in session: return jsonify({'success': False, 'error': 'Auth needed'}), 401
     uid = int(session['user']['id'])
     
-    # Helper to format user
-    def fmt_user(row):
-        avatar = get_valid_avatar(row[2])
-        return {'id': str(row[0]), 'username': row[1], 'avatar': avatar, 'display_name': row[3]}
-
-    friends = []
-    incoming = []
-    outgoing = []
-    
-    # 1. Incoming: I am user_2, status pending
-    rows_in = execute_query("""
-        SELECT u.id, u.username, u.avatar, u.display_name 
-        FROM friends f 
-        JOIN users u ON u.id = f.user_id_1 
-        WHERE f.user_id_2 = %s AND f.status = 'pending'
-    """, (uid,), fetch_all=True)
-    
-    for r in rows_in: incoming.append(fmt_user(r))
-        
-    # 2. Outgoing: I am user_1, status pending
-    rows_out = execute_query("""
-        SELECT u.id, u.username, u.avatar, u.display_name 
-        FROM friends f 
-        JOIN users u ON u.id = f.user_id_2 
-        WHERE f.user_id_1 = %s AND f.status = 'pending'
-    """, (uid,), fetch_all=True)
-    
-    for r in rows_out: outgoing.append(fmt_user(r))
-         
-    # 3. Friends: Accepted
-    rows_friends = execute_query("""
-        SELECT u.id, u.username, u.avatar, u.display_name
-        FROM friends f
-        JOIN users u ON (u.id = f.user_id_1 OR u.id = f.user_id_2)
-        WHERE (f.user_id_1 = %s OR f.user_id_2 = %s) 
-        AND f.status = 'accepted'
-        AND u.id != %s
-    """, (uid, uid, uid), fetch_all=True)
-
-    for r in rows_friends: friends.append(fmt_user(r))
-        
+    def fmt_user(card):
+        return {'id': str(card.id), 'username': card.username,
+                'avatar': get_valid_avatar(card.avatar), 'display_name': card.display_name}
+
+    # Incoming: I am user_2, outgoing: I am user_1 (both pending)
+    incoming = [fmt_user(c) for c in repositories.friends.incoming(uid)]
+    outgoing = [fmt_user(c) for c in repositories.friends.outgoing(uid)]
+    friends = [fmt_user(c) for c in repositories.friends.accepted(uid)]
+
     return jsonify({'success': True, 'friends': friends, 'incoming': incoming, 'outgoing': outgoing})
 
 @app.route('/api/friends/request', methods=['POST'])
@@ -3792,6 +3838,7 @@ def api_friend_accept():
         return jsonify({'success': False, 'error': 'No pending request found'})
         
     execute_query('UPDATE friends SET status = %s WHERE id = %s', ('accepted', chk[0]), commit=True)
+    presence.link(my_id, target_id)
     
     return jsonify({'success': True})
 
@@ -3799,19 +3846,9 @@ def api_friend_accept():
 
 def get_or_create_dm(user1_id, user2_id):
     # Allow self-DMs for Cloud Drive / Saved Messages
-    # Ensure consistent ordering for lookup
-    if user1_id > user2_id: user1_id, user2_id = user2_id, user1_id
-    
-    row = execute_query('SELECT id FROM direct_messages WHERE user_id_1 = %s AND user_id_2 = %s', (user1_id, user2_id), fetch_one=True)
-    if row: return row[0]
-    
-    # Create
-    execute_query('INSERT INTO direct_messages (user_id_1, user_id_2, last_message_at) VALUES (%s, %s, %s)',
-                  (user1_id, user2_id, time.time()), commit=True)
-    
-    # Fetch back
-    row = execute_query('SELECT id FROM direct_messages WHERE user_id_1 = %s AND user_id_2 = %s', (user1_id, user2_id), fetch_one=True)
-    return row[0]
+    dm_id = repositories.dms.get_or_create(user1_id, user2_id, time.time())
+    presence.link(user1_id, user2_id)
+    return dm_id
 
 @app.route('/api/dms/get_or_create/<int:target_id>', methods=['POST'])
 def api_get_or_create_dm(target_id):
@@ -3826,51 +3863,29 @@ def api_get_dms():
     if 'user' not in session: return jsonify({'success': False}), 401
     my_id = int(session['user']['id'])
     
-    # Combined query to fetch DMs, other user info, last message, and unread count
-    rows = execute_query("""
-        SELECT 
-            dm.id, dm.user_id_1, dm.user_id_2, dm.last_message_at,
-            u.id as other_id, u.username, u.avatar, u.display_name,
-            m.content as last_content, m.timestamp as last_timestamp,
-            (SELECT COUNT(*) FROM dm_messages 
-             WHERE dm_id = dm.id AND author_id != %s
-             AND id > COALESCE((SELECT last_read_message_id FROM read_receipts WHERE dm_id = dm.id AND user_id = %s), 0)
-            ) as unread_count
-        FROM direct_messages dm
-        JOIN users u ON u.id = (CASE WHEN dm.user_id_1 = %s AND dm.user_id_2 != %s THEN dm.user_id_2 ELSE dm.user_id_1 END)
-        LEFT JOIN (
-            SELECT dm_id, content, timestamp
-            FROM dm_messages
-            WHERE id IN (SELECT MAX(id) FROM dm_messages GROUP BY dm_id)
-        ) m ON m.dm_id = dm.id
-        WHERE dm.user_id_1 = %s OR dm.user_id_2 = %s
-        ORDER BY dm.last_message_at DESC
-    """, (my_id, my_id, my_id, my_id, my_id, my_id), fetch_all=True)
-    
+    # One query: other user, last message and unread count per DM
     dms = []
-    for r in rows or []:
-        dm_id, u1, u2, ts, other_id, other_username, other_avatar, other_display_name, last_content, last_ts, unread_count = r
-        
-        display_name = other_display_name or other_username
-        if int(other_id) == my_id:
+    for dm in repositories.dms.list_for(my_id):
+        display_name = dm.display_name or dm.username
+        if int(dm.other_id) == my_id:
             display_name = "Saved Messages"
             
-        last_message_text = last_content
+        last_message_text = dm.last_content
         if last_message_text and len(last_message_text) > 50:
             last_message_text = last_message_text[:50] + "..."
             
         dms.append({
-            'id': str(dm_id),
+            'id': str(dm.id),
             'other_user': {
-                'id': str(other_id),
-                'username': other_username,
-                'avatar': other_avatar if other_avatar else DEFAULT_AVATAR,
+                'id': str(dm.other_id),
+                'username': dm.username,
+                'avatar': dm.avatar if dm.avatar else DEFAULT_AVATAR,
                 'display_name': display_name
             },
-            'last_message_at': ts,
+            'last_message_at': dm.last_message_at,
             'last_message_text': last_message_text,
-            'last_message_timestamp': last_ts or ts,
-            'unread_count': unread_count
+            'last_message_timestamp': dm.last_timestamp or dm.last_message_at,
+            'unread_count': dm.unread_count
         })
         
     return jsonify({'success': True, 'dms': dms})
@@ -3884,7 +3899,7 @@ def api_dm_messages_by_id(dm_id):
     my_id = int(session['user']['id'])
     
     # Verify user is part of this DM
-    dm_row = execute_query('SELECT user_id_1, user_id_2 FROM direct_messages WHERE id = %s', (dm_id,), fetch_one=True)
+    dm_row = repositories.dms.participants(dm_id, read_only=True)
     if not dm_row:
         return jsonify({'success': False, 'error': 'DM not found'}), 404
     
@@ -3894,92 +3909,41 @@ def api_dm_messages_by_id(dm_id):
     limit = min(int(request.args.get('limit', 50)), 100)
     before_id = request.args.get('before_id')
     
-    query = """
-        SELECT dm.id, dm.content, dm.timestamp, u.username, u.avatar, 
-               dm.is_pinned, dm.edited_at, dm.reply_to_id, u.id as author_id, dm.attachments,
-               dm.is_encrypted, dm.encryption_metadata, dm.cloud_folder_id, dm.tags
-        FROM dm_messages dm
-        JOIN users u ON u.id = dm.author_id
-        WHERE dm.dm_id = %s
-    """
-    params = [dm_id]
-    
-    if before_id:
-        query += " AND dm.id < %s"
-        params.append(int(before_id))
-        
-    query += " ORDER BY dm.id DESC LIMIT %s"
-    params.append(limit)
-    
-    # Fetch messages
-    rows = execute_query(query, tuple(params), fetch_all=True)
-    
-    if not rows:
+    page = repositories.messages.page(dm_id, limit, int(before_id) if before_id else None)
+    if not page:
         return jsonify({'success': True, 'messages': []})
-    
-    # Reverse to chronological order
-    rows.reverse()
-
-    msg_ids = [r[0] for r in rows]
-    reply_ids = list(set([r[7] for r in rows if r[7]]))
-    
-    # Bulk fetch reactions
-    reactions_map = {}
-    if msg_ids:
-        placeholders = ','.join(['%s'] * len(msg_ids))
-        reaction_rows = execute_query(f'''
-            SELECT message_id, emoji, COUNT(*) as count
-            FROM message_reactions
-            WHERE message_id IN ({placeholders})
-            GROUP BY message_id, emoji
-        ''', tuple(msg_ids), fetch_all=True)
-        
-        for r_row in reaction_rows or []:
-            mid, emoji, count = r_row
-            if mid not in reactions_map:
-                reactions_map[mid] = {}
-            reactions_map[mid][emoji] = count
-
-    # Bulk fetch reply previews
-    replies_map = {}
-    if reply_ids:
-        placeholders = ','.join(['%s'] * len(reply_ids))
-        reply_rows = execute_query(f'''
-            SELECT dm.id, dm.content, u.username 
-            FROM dm_messages dm 
-            JOIN users u ON u.id = dm.author_id 
-            WHERE dm.id IN ({placeholders})
-        ''', tuple(reply_ids), fetch_all=True)
-        
-        for rep in reply_rows or []:
-            rid, content, uname = rep
-            replies_map[rid] = {
-                'content': content[:100] + '...' if len(content) > 100 else content,
-                'username': uname
-            }
+
+    # Reactions and reply previews for the whole page in two queries
+    reactions_map = repositories.reactions.counts_for([m.id for m in page])
+    replies_map = repositories.messages.reply_previews([m.reply_to_id for m in page if m.reply_to_id])
 
     messages = []
-    for r in rows:
-        msg_id = r[0]
-        reactions = reactions_map.get(msg_id, {})
-        reply_preview = replies_map.get(r[7]) if r[7] else None
+    for m in page:
+        reply = replies_map.get(m.reply_to_id) if m.reply_to_id else None
+        reply_preview = None
+        if reply:
+            content = reply.content or ''
+            reply_preview = {
+                'content': content[:100] + '...' if len(content) > 100 else content,
+                'username': reply.username
+            }
         
         messages.append({
-            'id': msg_id,
-            'content': r[1],
-            'timestamp': r[2],
-            'username': r[3],
-            'avatar': r[4] if r[4] else DEFAULT_AVATAR,
-            'is_pinned': bool(r[5]),
-            'edited_at': r[6],
+            'id': m.id,
+            'content': m.content,
+            'timestamp': m.timestamp,
+            'username': m.username,
+            'avatar': m.avatar if m.avatar else DEFAULT_AVATAR,
+            'is_pinned': bool(m.is_pinned),
+            'edited_at': m.edited_at,
             'reply_to': reply_preview,
-            'author_id': r[8],
-            'reactions': reactions,
-            'attachments': json.loads(r[9]) if r[9] else None,
-            'is_encrypted': bool(r[10]),
-            'encryption_metadata': r[11],
-            'cloud_folder_id': r[12],
-            'tags': r[13]
+            'author_id': m.author_id,
+            'reactions': reactions_map.get(m.id, {}),
+            'attachments': json.loads(m.attachments) if m.attachments else None,
+            'is_encrypted': bool(m.is_encrypted),
+            'encryption_metadata': m.encryption_metadata,
+            'cloud_folder_id': m.cloud_folder_id,
+            'tags': m.tags
         })
     
     return jsonify({'success': True, 'messages': messages})
@@ -3992,28 +3956,26 @@ def api_dm_messages(target_id):
     
     dm_id = get_or_create_dm(my_id, target_id)
     
-    # Fetch ALL messages ordered chronologically
-    rows = execute_query("""
+    # Stream ALL messages ordered chronologically
+    rows = db.stream_query("""
         SELECT dm.content, dm.timestamp, u.username, u.avatar 
         FROM dm_messages dm
         JOIN users u ON u.id = dm.author_id
         WHERE dm.dm_id = %s
         ORDER BY dm.timestamp ASC
-    """, (dm_id,), fetch_all=True)
+    """, (dm_id,), read_only=True)
     
-    messages = []
-    for r in rows:
-        messages.append({
-            'content': r[0],
-            'timestamp': r[1],
-            'timestamp': r[1],
-            'username': r[2],
-            'avatar': r[3] if r[3] else DEFAULT_AVATAR
-        })
+    messages = ({
+        'content': r[0],
+        'timestamp': r[1],
+        'username': r[2],
+        'avatar': r[3] if r[3] else DEFAULT_AVATAR
+    } for r in rows)
         
-    return jsonify({'success': True, 'messages': messages, 'dm_id': str(dm_id)})
+    return stream_json_response('messages', messages, dm_id=str(dm_id))
 
 @app.route('/api/dms/by_id/<int:dm_id>/send', methods=['POST'])
+@sanctions.unless_muted
 def api_dm_send_by_id(dm_id):
     """Send a message to a DM conversation by DM ID"""
     if 'user' not in session: 
@@ -4022,7 +3984,7 @@ def api_dm_send_by_id(dm_id):
     my_id = int(session['user']['id'])
     
     # Verify user is part of this DM
-    dm_row = execute_query('SELECT user_id_1, user_id_2 FROM direct_messages WHERE id = %s', (dm_id,), fetch_one=True)
+    dm_row = repositories.dms.participants(dm_id)
     if not dm_row:
         return jsonify({'success': False, 'error': 'DM not found'}), 404
     
@@ -4052,21 +4014,18 @@ def api_dm_send_by_id(dm_id):
         expires_at = timestamp + expires_in
     
     try:
-        # Insert message with reply support and expiration
-        message_id = execute_query('''
-            INSERT INTO dm_messages (dm_id, author_id, content, timestamp, reply_to_id, attachments, expires_at, is_encrypted, encryption_metadata, cloud_folder_id)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (dm_id, my_id, content, timestamp, reply_to_id, attachments, expires_at, int(is_encrypted), encryption_metadata, folder_id), commit=True)
-        
-        # Update last_message_at
-        execute_query('UPDATE direct_messages SET last_message_at = %s WHERE id = %s',
-                      (timestamp, dm_id), commit=True)
+        with transaction():
+            # Insert message with reply support and expiration
+            message_id = repositories.messages.create(
+                dm_id, my_id, content, timestamp, reply_to_id, attachments, expires_at,
+                is_encrypted, encryption_metadata, folder_id)
+            repositories.dms.touch(dm_id, timestamp)
         
     except Exception as e:
         return jsonify({'success': False, 'error': f'Database error: {str(e)}'}), 500
     
     # Get user info for socket broadcast
-    u = execute_query('SELECT username, avatar FROM users WHERE id = %s', (my_id,), fetch_one=True)
+    u = repositories.users.name_avatar(my_id)
     username = u[0] if u else 'Unknown'
     avatar = get_valid_avatar(u[1]) if u else DEFAULT_AVATAR
     
@@ -4109,6 +4068,7 @@ def api_dm_send_by_id(dm_id):
     })
 
 @app.route('/api/dms/<int:target_id>/send', methods=['POST'])
+@sanctions.unless_muted
 def api_dm_send(target_id):
     if 'user' not in session: return jsonify({'success': False}), 401
     my_id = int(session['user']['id'])
@@ -4134,17 +4094,16 @@ def api_dm_send(target_id):
     if expires_in and isinstance(expires_in, (int, float)) and expires_in > 0:
         expires_at = timestamp + expires_in
     
-    # Insert Message with attachments, reply support, encryption and expiration
-    message_id = execute_query("""
-        INSERT INTO dm_messages (dm_id, author_id, content, timestamp, reply_to_id, attachments, expires_at, is_encrypted, encryption_metadata, cloud_folder_id) 
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    """, (dm_id, my_id, content, timestamp, reply_to_id, attachments, expires_at, int(is_encrypted), encryption_metadata, folder_id), commit=True)
-                  
-    # Update timestamp for sorting
-    execute_query("UPDATE direct_messages SET last_message_at = %s WHERE id = %s", (timestamp, dm_id), commit=True)
+    with transaction():
+        # Insert Message with attachments, reply support, encryption and expiration
+        message_id = repositories.messages.create(
+            dm_id, my_id, content, timestamp, reply_to_id, attachments, expires_at,
+            is_encrypted, encryption_metadata, folder_id)
+        # Update timestamp for sorting
+        repositories.dms.touch(dm_id, timestamp)
     
     # Get user info for proper avatar
-    u = execute_query('SELECT username, avatar FROM users WHERE id = %s', (my_id,), fetch_one=True)
+    u = repositories.users.name_avatar(my_id)
     username = u[0] if u else session['user']['username']
     avatar = get_valid_avatar(u[1]) if u else session['user']['avatar']
     
@@ -4180,6 +4139,7 @@ def api_dm_send(target_id):
 # ============================================================
 
 @app.route('/api/messages/<int:message_id>/edit', methods=['PUT'])
+@sanctions.unless_muted
 def api_edit_message(message_id):
     """Редактировать сообщение"""
     if 'user' not in session:
@@ -4232,11 +4192,12 @@ def api_delete_message(message_id):
     
     dm_id = msg[1]
     
-    # Delete reactions first
-    execute_query('DELETE FROM message_reactions WHERE message_id = %s', (message_id,), commit=True)
-    
-    # Delete message
-    execute_query('DELETE FROM dm_messages WHERE id = %s', (message_id,), commit=True)
+    with transaction():
+        # Delete reactions first
+        execute_query('DELETE FROM message_reactions WHERE message_id = %s', (message_id,), commit=True)
+        
+        # Delete message
+        execute_query('DELETE FROM dm_messages WHERE id = %s', (message_id,), commit=True)
     
     # Emit delete via socket
     socketio.emit('message_deleted', {
@@ -4248,6 +4209,7 @@ def api_delete_message(message_id):
 
 
 @app.route('/api/messages/<int:message_id>/pin', methods=['POST'])
+@sanctions.unless_muted
 def api_pin_message(message_id):
     """Закрепить/открепить сообщение"""
     if 'user' not in session:
@@ -4264,7 +4226,7 @@ def api_pin_message(message_id):
     current_pinned = msg[1] or 0
     
     # Check user is part of this DM
-    dm = execute_query('SELECT user_id_1, user_id_2 FROM direct_messages WHERE id = %s', (dm_id,), fetch_one=True)
+    dm = repositories.dms.participants(dm_id)
     if not dm or my_id not in [dm[0], dm[1]]:
         return jsonify({'success': False, 'error': 'Access denied'}), 403
     
@@ -4291,7 +4253,7 @@ def api_get_pinned_messages(dm_id):
     my_id = int(session['user']['id'])
     
     # Check access
-    dm = execute_query('SELECT user_id_1, user_id_2 FROM direct_messages WHERE id = %s', (dm_id,), fetch_one=True)
+    dm = repositories.dms.participants(dm_id)
     if not dm or my_id not in [dm[0], dm[1]]:
         return jsonify({'success': False, 'error': 'Access denied'}), 403
     
@@ -4317,6 +4279,7 @@ def api_get_pinned_messages(dm_id):
 
 
 @app.route('/api/messages/<int:message_id>/react', methods=['POST'])
+@sanctions.unless_muted
 def api_react_message(message_id):
     """Добавить/удалить реакцию"""
     try:
@@ -4376,18 +4339,7 @@ def api_react_message(message_id):
 
 def get_message_reactions(message_id):
     """Helper: получить реакции для сообщения"""
-    rows = execute_query('''
-        SELECT emoji, COUNT(*) as count
-        FROM message_reactions
-        WHERE message_id = %s
-        GROUP BY emoji
-    ''', (message_id,), fetch_all=True)
-    
-    reactions = {}
-    for r in rows or []:
-        reactions[r[0]] = r[1]
-    
-    return reactions
+    return repositories.reactions.counts(message_id)
 
 
 @app.route('/api/messages/<int:message_id>/reactions', methods=['GET'])
@@ -4416,62 +4368,6 @@ def api_get_reactions(message_id):
     return jsonify({'success': True, 'reactions': reactions})
 
 
-@app.route('/debug/friends_dump')
-def debug_friends_dump():
-    rows = execute_query('SELECT * FROM friends', fetch_all=True)
-    return jsonify({'rows': rows})
-
-@app.route('/debug/run_migration')
-def debug_run_migration():
-    """Manually trigger database migration"""
-    try:
-        run_db_migration()
-        return jsonify({'success': True, 'message': 'Migration completed! Check server logs.'})
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
-
-@app.route('/debug/check_tables')
-def debug_check_tables():
-    """Check which tables exist in the database"""
-    try:
-        conn = get_db_connection()
-        is_sqlite = isinstance(conn, sqlite3.Connection)
-        cursor = conn.cursor()
-        
-        if is_sqlite:
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = [row[0] for row in cursor.fetchall()]
-        else:
-            cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema='public'")
-            tables = [row[0] for row in cursor.fetchall()]
-        
-        # Check message_reactions table structure if it exists
-        reactions_structure = None
-        if 'message_reactions' in tables:
-            if is_sqlite:
-                cursor.execute("PRAGMA table_info(message_reactions)")
-                reactions_structure = [{'name': r[1], 'type': r[2]} for r in cursor.fetchall()]
-            else:
-                cursor.execute("""
-                    SELECT column_name, data_type 
-                    FROM information_schema.columns 
-                    WHERE table_name='message_reactions'
-                """)
-                reactions_structure = [{'name': r[0], 'type': r[1]} for r in cursor.fetchall()]
-        
-        cursor.close()
-        conn.close()
-        
-        return jsonify({
-            'success': True,
-            'db_type': 'SQLite' if is_sqlite else 'PostgreSQL',
-            'tables': tables,
-            'message_reactions_exists': 'message_reactions' in tables,
-            'message_reactions_structure': reactions_structure
-        })
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
-
 # --- CLOUD DRIVE ROUTES ---
 @app.route('/api/cloud/folders', methods=['GET', 'POST'])
 def api_cloud_folders():
@@ -4491,8 +4387,8 @@ def api_cloud_folders():
         
         if not name: return jsonify({'success': False, 'error': 'Name is required'})
         
-        folder_id = execute_query('INSERT INTO cloud_folders (user_id, name, color, icon, created_at) VALUES (%s, %s, %s, %s, %s)',
-                                  (my_id, name, color, icon, time.time()), commit=True)
+        folder_id = db.insert('INSERT INTO cloud_folders (user_id, name, color, icon, created_at) VALUES (%s, %s, %s, %s, %s)',
+                              (my_id, name, color, icon, time.time()))
         return jsonify({'success': True, 'folder': {'id': folder_id, 'name': name, 'color': color, 'icon': icon}})
 
 @app.route('/api/messages/<int:message_id>/organize', methods=['POST'])
@@ -4505,7 +4401,7 @@ def api_messages_organize(message_id):
     if not msg: return jsonify({'success': False, 'error': 'Message not found'}), 404
     
     # Allow organizing if I sent it OR if it's in my cloud DM
-    dm = execute_query('SELECT user_id_1, user_id_2 FROM direct_messages WHERE id = %s', (msg[1],), fetch_one=True)
+    dm = repositories.dms.participants(msg[1])
     if not dm or (my_id not in [dm[0], dm[1]]):
         return jsonify({'success': False, 'error': 'Access denied'}), 403
         